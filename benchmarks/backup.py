@@ -0,0 +1,71 @@
+"""
+    benchmarks.backup
+    ~~~~~~~~~~~~~~~~~
+
+    Measures time and peak memory of the ``backup`` command and of the
+    restore of the whole archive and of a single user, for growing
+    corpora.
+
+    Usage: python -m benchmarks.backup [--bookmarks N [N ...]]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import gc
+import time
+import argparse
+import tempfile
+import tracemalloc
+from qstode import db
+from .common import benchmark_app, generate_corpus
+
+
+def run(runner, args):
+    """Returns the time in ms and the peak memory in KiB of the command"""
+
+    db.Session.remove()
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = runner.invoke(args=args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert result.exit_code == 0, result.output
+    return elapsed * 1000, peak / 1024
+
+
+def report(runner, num_bookmarks, name, args, filename):
+    ms, peak = run(runner, args)
+    size = os.path.getsize(filename) / 1024
+    print("%-10d %-10s %10.1f %12.1f %10.1f" % (num_bookmarks, name, ms, peak, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, nargs="+", default=[10000, 50000])
+    args = parser.parse_args()
+
+    print("%-10s %-10s %10s %12s %10s" % ("bookmarks", "command", "ms", "peak KiB", "KiB"))
+    for num_bookmarks in args.bookmarks:
+        with benchmark_app() as app, tempfile.TemporaryDirectory() as tmp_dir:
+            generate_corpus(num_bookmarks)
+            runner = app.test_cli_runner()
+            filename = os.path.join(tmp_dir, "backup.jsonl.gz")
+            commands = [
+                ("backup", ["backup", filename]),
+                ("restore-1", ["import-file", filename, "--user", "user1"]),
+                ("restore", ["import-file", filename]),
+            ]
+            for name, cmd in commands:
+                if name.startswith("restore"):
+                    # restore on an empty database
+                    db.Session.remove()
+                    db.drop_all()
+                    db.create_all()
+                report(runner, num_bookmarks, name, cmd, filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+    benchmarks.batch
+    ~~~~~~~~~~~~~~~~
+
+    Measures the throughput of the batch write API: requests creating,
+    updating and deleting 1000 bookmarks each, on top of a synthetic corpus.
+
+    Usage: python -m benchmarks.batch [--bookmarks N] [--batch-size N]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import argparse
+from qstode import db
+from .common import benchmark_app, generate_corpus, count_statements
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--batches", type=int, default=5)
+    args = parser.parse_args()
+
+    with benchmark_app() as app:
+        print("Generating %d bookmarks..." % args.bookmarks)
+        generate_corpus(args.bookmarks)
+        app.config["API_BATCH_MAX_ITEMS"] = args.batch_size
+        client = app.test_client()
+        with client.session_transaction() as session:
+            # logged in as the first user; the key changed name in Flask-Login 0.5
+            session["user_id"] = session["_user_id"] = "1"
+
+        def post(name, data):
+            db.Session.remove()
+            with count_statements() as statements:
+                start = time.perf_counter()
+                rv = client.post("/api/bookmarks/batch", json=data)
+                elapsed = time.perf_counter() - start
+            assert rv.status_code == 200, rv.data
+            rate = args.batch_size / elapsed
+            print(
+                "%-8s %6d items %9.1f ms %9.0f items/s %6d statements"
+                % (name, args.batch_size, elapsed * 1000, rate, len(statements))
+            )
+            return rv.get_json()
+
+        for batch in range(args.batches):
+            items = [
+                {
+                    "url": "http://batch%d.example.com/page/%d" % (batch, i),
+                    "title": "Batch %d bookmark %d" % (batch, i),
+                    "notes": "created by the batch benchmark",
+                    "tags": ["python", "batch", "tag%d" % (i % 500)],
+                }
+                for i in range(args.batch_size)
+            ]
+            results = post("create", {"create": items})
+            ids = [result["id"] for result in results["create"]]
+
+            updates = [
+                {"id": bookmark_id, "title": "Updated %d" % bookmark_id, "tags": ["web", "batch"]}
+                for bookmark_id in ids
+            ]
+            post("update", {"update": updates})
+            post("delete", {"delete": ids})
+
+
+if __name__ == "__main__":
+    main()
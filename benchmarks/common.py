@@ -0,0 +1,138 @@
+"""
+    benchmarks.common
+    ~~~~~~~~~~~~~~~~~
+
+    Helpers shared by the benchmark scripts: a throw-away SQLite database
+    filled with a synthetic corpus of users, links, bookmarks and tags.
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import random
+import shutil
+import tempfile
+import statistics
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from qstode import main, db
+from qstode.model.bookmark import Bookmark, Tag, Link, bookmark_tags
+from qstode.model.bookmark import rebuild_tag_counters, rebuild_tag_pairs, rebuild_link_tags
+from qstode.model.bookmark import url_hash
+from qstode.model.user import User
+
+
+WORDS = (
+    "python web linux news music video design programming security database "
+    "javascript science history games art photo travel food books politics "
+    "android apple windows cloud docker network hardware math physics golang"
+).split()
+
+
+@contextmanager
+def benchmark_app(db_path=None):
+    """Creates a Flask application bound to a temporary SQLite database"""
+
+    tmp_dir = tempfile.mkdtemp()
+    if db_path is None:
+        db_path = os.path.join(tmp_dir, "bench.sqlite")
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///%s" % db_path,
+        "SECRET_KEY": "bench",
+        "TESTING": True,
+    }
+    app = main.create_app(config)
+    db.create_all()
+    try:
+        yield app
+    finally:
+        db.Session.remove()
+        shutil.rmtree(tmp_dir)
+
+
+def generate_corpus(num_bookmarks, num_users=50, num_tags=2000, tags_per_bookmark=4, seed=42):
+    """Fills the database with a synthetic corpus using bulk inserts; tag
+    popularity follows a power law so that a few tags are very common."""
+
+    rng = random.Random(seed)
+    conn = db.Session.connection()
+    start = datetime(2012, 1, 1)
+
+    conn.execute(
+        User.__table__.insert(),
+        [
+            {
+                "username": "user%d" % i,
+                "email": "user%d@example.com" % i,
+                "display_name": "User %d" % i,
+                "password": "x",
+                "active": True,
+                "admin": False,
+            }
+            for i in range(1, num_users + 1)
+        ],
+    )
+
+    tag_names = list(WORDS) + ["tag%d" % i for i in range(num_tags - len(WORDS))]
+    conn.execute(Tag.__table__.insert(), [{"name": name} for name in tag_names])
+    hrefs = ["http://example%d.com/page/%d" % (i % 997, i) for i in range(num_bookmarks)]
+    conn.execute(
+        Link.__table__.insert(), [{"href": href, "href_hash": url_hash(href)} for href in hrefs]
+    )
+
+    bookmarks, pairs = [], []
+    weights = [1.0 / (rank + 1) for rank in range(len(tag_names))]
+    for i in range(1, num_bookmarks + 1):
+        created_on = start + timedelta(minutes=i)
+        bookmarks.append(
+            {
+                "id": i,
+                "title": " ".join(rng.sample(WORDS, 5)),
+                "user_id": rng.randint(1, num_users),
+                "link_id": i,
+                "private": rng.random() < 0.1,
+                "created_on": created_on,
+                "modified_on": created_on,
+                "notes": " ".join(rng.choices(WORDS, k=20)),
+            }
+        )
+        tag_ids = set(rng.choices(range(1, len(tag_names) + 1), weights, k=tags_per_bookmark))
+        pairs.extend({"bookmark_id": i, "tag_id": tag_id} for tag_id in tag_ids)
+
+    conn.execute(Bookmark.__table__.insert(), bookmarks)
+    conn.execute(bookmark_tags.insert(), pairs)
+    rebuild_tag_counters()
+    rebuild_tag_pairs()
+    rebuild_link_tags()
+    db.Session.commit()
+
+
+@contextmanager
+def count_statements():
+    """Collects the SQL statements executed inside the `with` block"""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.Session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def measure(fn, repeat=20):
+    """Runs `fn` `repeat` times and returns the median wall clock time in
+    milliseconds"""
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
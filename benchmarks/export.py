@@ -0,0 +1,81 @@
+"""
+    benchmarks.export
+    ~~~~~~~~~~~~~~~~~
+
+    Measures time and peak memory of the export of the bookmarks of a
+    single user: the template rendered at once over the ORM objects and
+    the streamed exports in each format, for growing collections.
+
+    Usage: python -m benchmarks.export [--bookmarks N [N ...]]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import gc
+import time
+import argparse
+import tracemalloc
+from datetime import datetime
+from flask import render_template
+from sqlalchemy.orm import selectinload
+from qstode import db, export
+from qstode.model.bookmark import Bookmark
+from qstode.model.records import iter_records
+from .common import benchmark_app, generate_corpus
+
+
+def rendered():
+    bookmarks = Bookmark.by_user(1, include_private=True).options(selectinload(Bookmark.tags))
+    return [render_template("_export.html", bookmarks=bookmarks, today=datetime.now())]
+
+
+def streamed(name, compress=False):
+    def run():
+        return export.stream_export(name, iter_records(Bookmark.user_id == 1), compress)
+
+    return run
+
+
+def consume(fn):
+    """Returns the time in ms, the size in KiB and the peak memory in KiB
+    of the export made by `fn`"""
+
+    db.Session.remove()
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = 0
+    for chunk in fn():
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed * 1000, size / 1024, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, nargs="+", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    for num_bookmarks in args.bookmarks:
+        with benchmark_app() as app:
+            print("Generating %d bookmarks..." % num_bookmarks)
+            generate_corpus(num_bookmarks, num_users=1)
+
+            with app.test_request_context():
+                app.preprocess_request()
+                print("%-10s %10s %10s %12s" % ("path", "ms", "KiB", "peak KiB"))
+                paths = [
+                    ("rendered", rendered),
+                    ("html", streamed("html")),
+                    ("html.gz", streamed("html", compress=True)),
+                    ("jsonl", streamed("jsonl")),
+                    ("csv", streamed("csv")),
+                ]
+                for name, fn in paths:
+                    print("%-10s %10.1f %10.1f %12.1f" % ((name,) + consume(fn)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+    benchmarks.pagination
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the two-query pagination (items + `count()` subquery) with the
+    single statement `COUNT(*) OVER ()` pagination on tag queries.
+
+    Usage: python -m benchmarks.pagination [--bookmarks N]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+from unittest import mock
+from qstode.model.bookmark import Bookmark
+from .common import benchmark_app, generate_corpus, count_statements, measure
+
+
+def run(tags, page, per_page, window):
+    def paginate():
+        Bookmark.by_tags(tags).paginate(page, per_page, error_out=False)
+
+    with mock.patch("qstode.db.supports_window_functions", return_value=window):
+        with count_statements() as statements:
+            paginate()
+        latency = measure(paginate)
+    return len(statements), latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, default=200000)
+    parser.add_argument("--per-page", type=int, default=10)
+    args = parser.parse_args()
+
+    with benchmark_app() as app:
+        print("Generating %d bookmarks..." % args.bookmarks)
+        generate_corpus(args.bookmarks)
+
+        print(
+            "%-22s %5s %12s %12s %12s"
+            % ("query", "page", "statements", "before (ms)", "after (ms)")
+        )
+        with app.test_request_context():
+            for tags in (["python"], ["python", "web"], ["tag500"]):
+                for page in (2, 50):
+                    before = run(tags, page, args.per_page, window=False)
+                    after = run(tags, page, args.per_page, window=True)
+                    print(
+                        "%-22s %5d %5d -> %-4d %12.2f %12.2f"
+                        % (",".join(tags), page, before[0], after[0], before[1], after[1])
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+    benchmarks.postings
+    ~~~~~~~~~~~~~~~~~~~
+
+    Compares tag searches done with SQL (`Bookmark.by_tags()` paginated)
+    with searches on the in-memory tag posting lists.
+
+    Usage: python -m benchmarks.postings [--bookmarks N]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import argparse
+import functools
+import tempfile
+from qstode import postings
+from qstode.model.bookmark import Bookmark
+from .common import benchmark_app, generate_corpus, measure
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, default=200000)
+    parser.add_argument("--per-page", type=int, default=10)
+    args = parser.parse_args()
+
+    with benchmark_app() as app:
+        print("Generating %d bookmarks..." % args.bookmarks)
+        generate_corpus(args.bookmarks)
+        postings.manager.path = os.path.join(tempfile.mkdtemp(), "postings")
+        postings.manager.save()
+        print("Snapshot size: %d KB" % (os.path.getsize(postings.manager.path) // 1024))
+
+        def sql(tags, exclude):
+            query = Bookmark.by_tags(tags, exclude)
+            return [b.id for b in query.paginate(1, args.per_page).items]
+
+        def engine(tags, exclude):
+            ids = postings.manager.search(tags, exclude)[: args.per_page]
+            return [b.id for b in Bookmark.query.filter(Bookmark.id.in_(ids))]
+
+        print("%-30s %12s %12s" % ("query", "sql (ms)", "postings (ms)"))
+        with app.test_request_context():
+            queries = (
+                (["python"], []),
+                (["python", "web"], []),
+                (["python", "web", "linux"], []),
+                (["tag500"], []),
+                (["python"], ["web", "linux", "news"]),
+            )
+            for tags, exclude in queries:
+                before = measure(functools.partial(sql, tags, exclude), repeat=5)
+                after = measure(functools.partial(engine, tags, exclude), repeat=5)
+                label = ",".join(tags + ["-" + t for t in exclude])
+                print("%-30s %12.2f %12.2f" % (label, before, after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+    benchmarks.records
+    ~~~~~~~~~~~~~~~~~~
+
+    Compares loading and serializing a page of bookmarks as ORM objects
+    and as read-only records (`qstode.model.records`): latency and memory
+    allocated per page, for pages of 10, 50 and 200 items.
+
+    Usage: python -m benchmarks.records [--bookmarks N]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import gc
+import argparse
+import functools
+import tracemalloc
+from sqlalchemy.orm import selectinload
+from qstode import db
+from qstode.model.bookmark import Bookmark
+from qstode.model.records import load_records
+from .common import benchmark_app, generate_corpus, measure
+
+
+PAGE_SIZES = (10, 50, 200)
+
+
+def orm_page(per_page, offset):
+    query = Bookmark.get_latest().options(selectinload(Bookmark.tags))
+    return query.limit(per_page).offset(offset).all()
+
+
+def records_page(per_page, offset):
+    query = Bookmark.get_latest().with_entities(Bookmark.id)
+    ids = [row.id for row in query.limit(per_page).offset(offset)]
+    return load_records(ids)
+
+
+def fresh_page(load, per_page):
+    # a new session for each page, like a request
+    db.Session.remove()
+    return load(per_page, per_page * 3)
+
+
+def serialize(page):
+    return [item.to_dict() for item in page()]
+
+
+def allocated(fn):
+    """Returns the peak and the retained memory allocated by `fn`, in KiB"""
+
+    gc.collect()
+    tracemalloc.start()
+    rv = fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rv
+    return peak / 1024, retained / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, default=20000)
+    args = parser.parse_args()
+
+    with benchmark_app() as app:
+        print("Generating %d bookmarks..." % args.bookmarks)
+        generate_corpus(args.bookmarks)
+
+        with app.test_request_context():
+            print(
+                "%-6s %-8s %10s %10s %12s %12s"
+                % ("items", "path", "load ms", "json ms", "peak KiB", "kept KiB")
+            )
+            for per_page in PAGE_SIZES:
+                for name, load in (("orm", orm_page), ("records", records_page)):
+                    page = functools.partial(fresh_page, load, per_page)
+                    page()  # warm up the compiled statement caches
+                    peak, kept = allocated(page)
+                    print(
+                        "%-6d %-8s %10.2f %10.2f %12.1f %12.1f"
+                        % (
+                            per_page,
+                            name,
+                            measure(page),
+                            measure(functools.partial(serialize, page)),
+                            peak,
+                            kept,
+                        )
+                    )
+
+
+if __name__ == "__main__":
+    main()
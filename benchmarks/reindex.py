@@ -0,0 +1,59 @@
+"""
+    benchmarks.reindex
+    ~~~~~~~~~~~~~~~~~~
+
+    Measures the documents per second of a full index rebuild: documents
+    built from ORM objects versus the streamed rows of `iter_documents`,
+    and rebuilds using one or more indexing processes.
+
+    Usage: python -m benchmarks.reindex [--bookmarks N] [--procs N]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import argparse
+import functools
+import tempfile
+from qstode.model.bookmark import Bookmark
+from qstode.searcher import WhooshSearcher, create_document, iter_documents, rebuild_index
+from .common import benchmark_app, generate_corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, default=50000)
+    parser.add_argument("--procs", type=int, default=4)
+    args = parser.parse_args()
+
+    with benchmark_app() as app:
+        print("Generating %d bookmarks..." % args.bookmarks)
+        generate_corpus(args.bookmarks)
+        app.config["WHOOSH_INDEX_PATH"] = os.path.join(tempfile.mkdtemp(), "index")
+        searcher = WhooshSearcher()
+        searcher.init_app(app)
+
+        def rate(fn):
+            started = time.monotonic()
+            count = fn()
+            return count / (time.monotonic() - started)
+
+        def orm_documents():
+            return sum(1 for b in Bookmark.query.order_by(Bookmark.id) if create_document(b))
+
+        def streamed_documents():
+            return sum(len(documents) for documents in iter_documents())
+
+        with app.test_request_context():
+            print("%-30s %12s" % ("", "docs/s"))
+            print("%-30s %12.0f" % ("documents from ORM objects", rate(orm_documents)))
+            print("%-30s %12.0f" % ("documents from rows", rate(streamed_documents)))
+            for procs in sorted(set((1, args.procs))):
+                label = "rebuild, %d process(es)" % procs
+                rebuild = functools.partial(rebuild_index, searcher, procs=procs)
+                print("%-30s %12.0f" % (label, rate(rebuild)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+    benchmarks.related_tags
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the single SQL query computing related tags with the lookups
+    on the `tag_pairs` co-occurrence table.
+
+    Usage: python -m benchmarks.related_tags [--bookmarks N]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import functools
+from qstode.model.bookmark import Tag
+from .common import benchmark_app, generate_corpus, measure
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, default=200000)
+    args = parser.parse_args()
+
+    with benchmark_app() as app:
+        print("Generating %d bookmarks..." % args.bookmarks)
+        generate_corpus(args.bookmarks)
+
+        print("%-22s %12s %12s %6s" % ("tags", "before (ms)", "after (ms)", "same"))
+        with app.test_request_context():
+            for tags in (["python"], ["tag500"], ["python", "web"], ["python", "tag500"]):
+                ids = sorted(tag.id for tag in Tag.get_many(tags))
+                before = measure(functools.partial(Tag._get_related_sql, ids), repeat=5)
+                after = measure(functools.partial(Tag.get_related, tags), repeat=5)
+                same = Tag._get_related_sql(ids) == Tag.get_related(tags)
+                print("%-22s %12.2f %12.2f %6s" % (",".join(tags), before, after, same))
+
+
+if __name__ == "__main__":
+    main()
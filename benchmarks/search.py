@@ -0,0 +1,65 @@
+"""
+    benchmarks.search
+    ~~~~~~~~~~~~~~~~~
+
+    Compares the Whoosh and the SQLite FTS5 search backends on the same
+    corpus: indexing throughput of a full rebuild and query latency, with
+    the result cache of the Whoosh backend disabled.
+
+    Usage: python -m benchmarks.search [--bookmarks N]
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import argparse
+import functools
+import tempfile
+from qstode.fts import FTSSearcher
+from qstode.searcher import WhooshSearcher, rebuild_index
+from .common import benchmark_app, generate_corpus, measure
+
+
+QUERIES = ("python", "python web", "python OR golang", "tags:tag50", "linux NOT windows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bookmarks", type=int, default=50000)
+    args = parser.parse_args()
+
+    with benchmark_app() as app:
+        print("Generating %d bookmarks..." % args.bookmarks)
+        generate_corpus(args.bookmarks)
+        app.config["WHOOSH_INDEX_PATH"] = os.path.join(tempfile.mkdtemp(), "index")
+
+        with app.test_request_context():
+            whoosh = WhooshSearcher()
+            whoosh.init_app(app)
+            fts = FTSSearcher()
+            fts.init_app(app)
+
+            def rate(fn):
+                started = time.monotonic()
+                count = fn()
+                return count / (time.monotonic() - started)
+
+            print("%-30s %12s %12s" % ("", "whoosh", "fts5"))
+            print(
+                "%-30s %12.0f %12.0f"
+                % ("indexing (docs/s)", rate(lambda: rebuild_index(whoosh)), rate(fts.rebuild))
+            )
+
+            def uncached(query):
+                whoosh._results.clear()
+                return whoosh.search(query)
+
+            for query in QUERIES:
+                before = measure(functools.partial(uncached, query), repeat=5)
+                after = measure(functools.partial(fts.search, query), repeat=5)
+                print("%-30s %12.2f %12.2f" % (query + " (ms)", before, after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+    qstode.archive
+    ~~~~~~~~~~~~~~
+
+    The backup archive: a gzip file of JSON Lines written as a stream.
+
+    The archive is made of independent gzip members, so that it can still be
+    read with ``zcat``: a header, one member for each user holding the user
+    followed by its bookmarks, an index with the offset of the member of each
+    user and a small fixed size footer with the offset of the index. A single
+    user can be restored by reading the footer, the index and its member,
+    without decompressing the rest of the archive.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import gzip
+import json
+import zlib
+from qstode.export import BUFFER_SIZE, buffered
+
+
+FORMAT = "qstode-backup"
+VERSION = 2
+
+
+def _footer(index_offset):
+    # stored uncompressed and padded, so that its size doesn't depend on the offset
+    line = json.dumps({"index_offset": index_offset}).ljust(47) + "\n"
+    return gzip.compress(line.encode("utf-8"), compresslevel=0, mtime=0)
+
+
+FOOTER_SIZE = len(_footer(0))
+
+
+def is_archive(fd):
+    """Returns True if the file `fd`, open in binary mode, starts like a gzip
+    file; the position of `fd` is not changed."""
+
+    position = fd.tell()
+    magic = fd.read(2)
+    fd.seek(position)
+    return magic == b"\x1f\x8b"
+
+
+class ArchiveWriter(object):
+    """Writes an archive to the file `fd`, open in binary mode and seekable"""
+
+    def __init__(self, fd, level=6):
+        self.fd = fd
+        self.level = level
+        self.index = []
+        self._write_member([{"format": FORMAT, "version": VERSION}])
+
+    def _write_member(self, items):
+        offset = self.fd.tell()
+        lines = (json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+        with gzip.GzipFile(fileobj=self.fd, mode="wb", compresslevel=self.level, mtime=0) as gz:
+            for chunk in buffered(lines):
+                gz.write(chunk)
+        return offset
+
+    def write_user(self, user, bookmarks):
+        """Writes the dict `user` followed by each dict of the iterable
+        `bookmarks` in a new member"""
+
+        count = 0
+
+        def items():
+            nonlocal count
+            yield {"user": user}
+            for bookmark in bookmarks:
+                count += 1
+                yield {"bookmark": bookmark}
+
+        offset = self._write_member(items())
+        self.index.append(
+            {
+                "username": user["username"],
+                "email": user["email"],
+                "offset": offset,
+                "bookmarks": count,
+            }
+        )
+
+    def close(self):
+        """Writes the index and the footer"""
+
+        offset = self._write_member([{"index": self.index}])
+        self.fd.write(_footer(offset))
+
+
+def _read_member(fd, offset):
+    """Yields the items of the member at `offset`"""
+
+    fd.seek(offset)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b""
+    while not decompressor.eof:
+        data = fd.read(BUFFER_SIZE)
+        if not data:
+            raise ValueError("Truncated backup archive")
+        *lines, pending = (pending + decompressor.decompress(data)).split(b"\n")
+        for line in lines:
+            yield json.loads(line.decode("utf-8"))
+
+
+def read_index(fd):
+    """Returns the index of the archive `fd`: a list of dicts with the
+    username, the email, the number of bookmarks and the offset of the
+    member of each user.
+
+    Raises `ValueError` if `fd` is not a valid archive.
+    """
+
+    try:
+        header = next(_read_member(fd, 0))
+        if (header.get("format"), header.get("version")) != (FORMAT, VERSION):
+            raise ValueError("Not a backup archive")
+        fd.seek(-FOOTER_SIZE, os.SEEK_END)
+        footer = json.loads(gzip.decompress(fd.read(FOOTER_SIZE)).decode("utf-8"))
+        return next(_read_member(fd, footer["index_offset"]))["index"]
+    except (OSError, StopIteration, zlib.error, LookupError, TypeError, AttributeError) as ex:
+        raise ValueError("Invalid backup archive: {}".format(ex))
+
+
+def read_user(fd, entry):
+    """Returns the user of the index `entry` as a tuple (user, bookmarks),
+    where `bookmarks` is an iterator of dicts reading the archive lazily"""
+
+    items = _read_member(fd, entry["offset"])
+    user = next(items)["user"]
+    return user, (item["bookmark"] for item in items)
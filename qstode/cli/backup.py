@@ -9,38 +9,21 @@
 """
 import sys
 import json
+from itertools import islice
 import iso8601
 import click
 from qstode.app import app
 from ..model.bookmark import Link, Tag, Bookmark
+from ..model.records import iter_records
 from ..model.user import User
-from qstode import db
+from qstode import db, archive
 
 
 # Default password for users
 DEFAULT_PASSWORD = "change this password"
 
-
-class Cache(object):
-
-    instance_class = None
-
-    def __init__(self):
-        self.items = {}
-
-    def get_item(self, name):
-        if name not in self.items:
-            item = self.instance_class(name)
-            self.items[name] = item
-        return self.items[name]
-
-
-class LinkCache(Cache):
-    instance_class = Link
-
-
-class TagCache(Cache):
-    instance_class = Tag
+# Number of users or bookmarks read or written at a time
+CHUNK_SIZE = 500
 
 
 def _parse_date(d):
@@ -52,97 +35,141 @@ def _parse_date(d):
     return d
 
 
-@app.cli.command()
-@click.argument("filename")
-def backup(filename):
-    users = []
+def _iter_users(chunk_size=CHUNK_SIZE):
+    """Yields all the users, reading them `chunk_size` at a time"""
 
-    for user in User.query.all():
-        user_dict = {
-            "username": user.username,
-            "email": user.email,
-            "password": user.password,
-            "created_at": user.created_at.isoformat(),
-            "active": user.active,
-            "bookmarks": [],
-        }
+    last_id = 0
+    while True:
+        users = User.query.filter(User.id > last_id).order_by(User.id).limit(chunk_size).all()
+        for user in users:
+            yield user
+        if len(users) < chunk_size:
+            return
+        last_id = users[-1].id
 
-        if hasattr(user, "roles"):
-            user_dict["roles"] = [role.name for role in user.roles]
 
-        query = Bookmark.by_user(user.id, include_private=True).order_by(Bookmark.created_on.asc())
-        for bookmark in query.all():
-            bookmark_dict = bookmark.to_dict()
-            user_dict["bookmarks"].append(bookmark_dict)
-
-        users.append(user_dict)
-
-    click.echo("Writing backup to: {}".format(filename))
-    with open(filename, "w", encoding="utf-8") as fd:
-        json.dump(dict(backup=users), fd, ensure_ascii=False, indent=4)
+def _user_dict(user):
+    return {
+        "username": user.username,
+        "display_name": user.display_name,
+        "email": user.email,
+        "password": user.password,
+        "created_at": user.created_at.isoformat(),
+        "active": user.active,
+        "admin": bool(user.admin),
+    }
 
 
 @app.cli.command()
 @click.argument("filename")
-def import_file(filename):
-    tag_cache = TagCache()
-    link_cache = LinkCache()
-    data = None
+@click.option("--level", type=click.IntRange(0, 9), default=6, help="gzip compression level.")
+def backup(filename, level):
+    """Write a backup of the users and of their bookmarks"""
 
-    with open(filename, "rb", encoding="utf-8") as fd:
-        data = json.load(fd)
+    click.echo("Writing backup to: {}".format(filename))
+    with open(filename, "wb") as fd, db.read_snapshot():
+        writer = archive.ArchiveWriter(fd, level)
+        for user in _iter_users():
+            records = iter_records(Bookmark.user_id == user.id, chunk_size=CHUNK_SIZE)
+            writer.write_user(_user_dict(user), (record.to_dict() for record in records))
+        writer.close()
+    click.echo("Saved {} users.".format(len(writer.index)))
 
-    if data is None:
-        click.echo("Error: Invalid bakcup file")
-        sys.exit(1)
 
-    users_data = data.get("backup")
-    if users_data is None:
-        click.echo("Error: Invalid backup file format")
-        sys.exit(1)
+def _restore_user(user_data, bookmarks):
+    """Creates the user of `user_data`, if missing, and adds the bookmarks
+    of the iterable `bookmarks`, committing them `CHUNK_SIZE` at a time"""
 
-    for user_data in users_data:
-        user = User.query.filter_by(email=user_data["email"]).first()
-        if user is None:
-            user = User(user_data["username"], user_data["email"], password=DEFAULT_PASSWORD)
-            user.created_at = _parse_date(user_data["created_at"])
-            user.active = user_data.get("active", True)
-            db.Session.add(user)
-
-        user.password = user_data["password"]
-
-        # roles
-        roles = user_data.get("roles", [])
-        if "admin" in roles:
-            user.admin = True
-
-        # bookmarks
-        for bm in user_data["bookmarks"]:
-            link = link_cache.get_item(bm["url"])
-
-            if "last_modified" in bm:
-                mod_date = _parse_date(bm["last_modified"])
-            else:
-                mod_date = _parse_date(bm["modified_on"])
-
-            if "creation_date" in bm:
-                create_date = _parse_date(bm["creation_date"])
-            else:
-                create_date = _parse_date(bm["created_on"])
+    user = User.query.filter_by(email=user_data["email"]).first()
+    if user is None:
+        user = User(user_data["username"], user_data["email"], password=DEFAULT_PASSWORD)
+        user.display_name = user_data.get("display_name")
+        user.created_at = _parse_date(user_data["created_at"])
+        user.active = user_data.get("active", True)
+        db.Session.add(user)
+
+    user.password = user_data["password"]
 
+    # version 1 backups have a list of roles
+    if user_data.get("admin") or "admin" in user_data.get("roles", []):
+        user.admin = True
+
+    db.Session.commit()
+    user_id = user.id
+
+    bookmarks = iter(bookmarks)
+    while True:
+        chunk = list(islice(bookmarks, CHUNK_SIZE))
+        if not chunk:
+            break
+
+        links = Link.get_or_create_many([bm["url"] for bm in chunk])
+        names = [name for bm in chunk for name in bm["tags"]]
+        tags = {tag.name: tag for tag in Tag.get_or_create_many(names)}
+        for bm, link in zip(chunk, links):
             bookmark = Bookmark(
                 title=bm["title"],
                 private=bm["private"],
-                created_on=create_date,
-                modified_on=mod_date,
+                # version 1 backups may use the names of the old columns
+                created_on=_parse_date(bm.get("creation_date", bm.get("created_on"))),
+                modified_on=_parse_date(bm.get("last_modified", bm.get("modified_on"))),
                 notes=bm["notes"],
             )
+            bookmark.user_id = user_id
             bookmark.link = link
+            bookmark.tags = [tags[name] for name in dict.fromkeys(n.lower() for n in bm["tags"])]
+            db.Session.add(bookmark)
 
-            for name in bm["tags"]:
-                tag = tag_cache.get_item(name)
-                bookmark.tags.append(tag)
+        db.Session.commit()
 
-            user.bookmarks.append(bookmark)
 
-    db.Session.commit()
+def _read_json(fd):
+    """Yields the users of a version 1 backup, a single JSON document"""
+
+    try:
+        data = json.loads(fd.read().decode("utf-8"))
+        users_data = data["backup"]
+    except (ValueError, TypeError, KeyError):
+        click.echo("Error: Invalid backup file format")
+        sys.exit(1)
+
+    for user_data in users_data:
+        yield user_data, user_data["bookmarks"]
+
+
+def _read_archive(fd, username):
+    """Yields the users of a backup archive, or only the user `username`"""
+
+    try:
+        index = archive.read_index(fd)
+    except ValueError as ex:
+        click.echo("Error: {}".format(ex))
+        sys.exit(1)
+
+    for entry in index:
+        if username is None or username in (entry["username"], entry["email"]):
+            yield archive.read_user(fd, entry)
+
+
+@app.cli.command()
+@click.argument("filename")
+@click.option("--user", "username", help="Restore only the user with this username or email.")
+def import_file(filename, username):
+    """Restore the users and the bookmarks of a backup"""
+
+    restored = 0
+    with open(filename, "rb") as fd:
+        if archive.is_archive(fd):
+            users = _read_archive(fd, username)
+        else:
+            users = _read_json(fd)
+
+        for user_data, bookmarks in users:
+            if username is None or username in (user_data["username"], user_data["email"]):
+                _restore_user(user_data, bookmarks)
+                restored += 1
+
+    if username is not None and not restored:
+        click.echo("Error: user {} not found in the backup".format(username))
+        sys.exit(1)
+    click.echo("Restored {} users.".format(restored))
@@ -0,0 +1,21 @@
+"""
+    qstode.cli.links
+    ~~~~~~~~~~~~~~~~
+
+    Maintenance commands for links.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import click
+from qstode.app import app
+from ..model.bookmark import backfill_link_hashes
+
+
+@app.cli.command("link-hashes")
+@click.option("--batch-size", default=1000, show_default=True, help="Links updated per commit.")
+def link_hashes(batch_size):
+    """Fill in the lookup hash of links, merging duplicate URLs"""
+
+    updated, merged = backfill_link_hashes(batch_size)
+    click.echo("Updated {} links, merged {} duplicate links.".format(updated, merged))
@@ -9,7 +9,7 @@
 """
 import json
 import click
-from ..model.bookmark import Bookmark, Tag, Link, TAG_MIN, TAG_MAX, tag_name_re
+from ..model.bookmark import Bookmark, Tag, Link, TAG_MIN, TAG_MAX, tag_name_re, url_hash
 from ..model.user import User
 from qstode.app import app, db
 from qstode.cli.helpers import ObjectCache, parse_datetime, unescape
@@ -22,11 +22,25 @@ SCUTTLE_PRIVATE = 2
 
 # Cache for Tags and Links
 class TagCache(ObjectCache):
-    model_class = Tag
+    """Tags are resolved in bulk, with a single lookup for the names that
+    aren't cached yet"""
+
+    def get_many(self, keys):
+        keys = list(dict.fromkeys(key.lower() for key in keys))
+        missing = [key for key in keys if key not in self._cache]
+        if missing:
+            self._cache.update((tag.name, tag) for tag in Tag.get_or_create_many(missing))
+        return [self._cache[key] for key in keys]
 
 
 class LinkCache(ObjectCache):
-    model_class = Link
+    """Links are looked up, or inserted, by the hash of their normalized URL"""
+
+    def get(self, key):
+        href_hash = url_hash(key)
+        if href_hash not in self._cache:
+            self._cache[href_hash] = Link.get_or_create(key)
+        return self._cache[href_hash]
 
 
 def list_duplicate_emails(data):
@@ -119,9 +133,7 @@ def import_scuttle(filename):
             )
             bookmark.link = link_cache.get(db_bookmark["url"])
 
-            tags = cleanup_tags(db_bookmark["tags"])
-            for tag_name in tags:
-                tag = tag_cache.get(tag_name)
+            for tag in tag_cache.get_many(cleanup_tags(db_bookmark["tags"])):
                 bookmark.tags.append(tag)
 
             user.bookmarks.append(bookmark)
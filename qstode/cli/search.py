@@ -0,0 +1,146 @@
+"""
+    qstode.cli.search
+    ~~~~~~~~~~~~~~~~~
+
+    Search engine maintenance commands.
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import time
+import click
+from qstode.app import app
+
+
+def get_searcher():
+    """Returns the search engine or exits if search is disabled"""
+
+    searcher = app.extensions.get("searcher")
+    if searcher is None:
+        click.echo("Full text search is disabled, set ENABLE_SEARCH.", err=True)
+        sys.exit(1)
+    return searcher
+
+
+@app.cli.command("index-worker")
+@click.option(
+    "--batch-size", default=100, show_default=True, help="Maximum operations per index commit."
+)
+@click.option(
+    "--interval",
+    default=1000,
+    show_default=True,
+    help="Maximum milliseconds to wait for a batch to fill up.",
+)
+@click.option("--once", is_flag=True, help="Exit when the queue is empty.")
+def index_worker(batch_size, interval, once):
+    """Apply the indexing queue to the search engine index"""
+
+    searcher = get_searcher()
+    if app.config["SEARCH_BACKEND"] == "fts5":
+        click.echo("The search backend doesn't use an indexing queue.")
+        return
+
+    from ..searcher import IndexWorker, LockError
+
+    worker = IndexWorker(searcher, batch_size, interval / 1000.0)
+    try:
+        total = worker.run(once)
+    except LockError as ex:
+        click.echo("Error: {}".format(ex), err=True)
+        sys.exit(1)
+    click.echo("Processed {} bookmarks.".format(total))
+
+
+@app.cli.command("reindex")
+@click.option("--full", is_flag=True, help="Rebuild the whole index and swap it in when done.")
+@click.option(
+    "--procs", default=1, show_default=True, help="Indexing processes used by a full rebuild."
+)
+@click.option(
+    "--chunk-size", default=500, show_default=True, help="Bookmarks read from the database at once."
+)
+@click.option(
+    "--commit-every", default=10000, show_default=True, help="Bookmarks per index commit."
+)
+def reindex(full, procs, chunk_size, commit_every):
+    """Index the bookmarks modified since they were last indexed, or
+    rebuild the whole index with --full
+
+    An interrupted run is resumed by running the same command again.
+    """
+
+    def progress(count, elapsed):
+        click.echo("Indexed {} bookmarks ({:.0f} docs/s)".format(count, count / max(elapsed, 1e-6)))
+
+    searcher = get_searcher()
+    started = time.monotonic()
+    if app.config["SEARCH_BACKEND"] == "fts5":
+        # the FTS5 index is updated with the bookmarks, there's nothing to catch up with
+        if not full:
+            click.echo("The search backend is always up to date, use --full to rebuild it.")
+            return
+        total = searcher.rebuild(chunk_size, progress)
+    elif full:
+        from ..searcher import rebuild_index
+
+        total = rebuild_index(searcher, chunk_size, commit_every, procs, progress)
+    else:
+        from ..searcher import reindex_modified
+
+        total = reindex_modified(searcher, chunk_size, commit_every, progress)
+    elapsed = time.monotonic() - started
+    click.echo("Done: {} bookmarks in {:.1f}s.".format(total, elapsed))
+
+
+def get_index_searcher():
+    """Returns the search engine if it keeps its own index, or exits"""
+
+    searcher = get_searcher()
+    if app.config["SEARCH_BACKEND"] == "fts5":
+        click.echo("The search backend keeps its index in the database.", err=True)
+        sys.exit(1)
+    return searcher
+
+
+@app.cli.command("index-export")
+@click.argument("filename", type=click.Path(dir_okay=False))
+def index_export(filename):
+    """Export a snapshot of the search engine index"""
+
+    from ..searcher import export_snapshot
+
+    watermark = export_snapshot(get_index_searcher(), filename)
+    click.echo("Exported the index up to {}.".format(watermark.isoformat()))
+
+
+@app.cli.command("index-import")
+@click.argument("filename", type=click.Path(exists=True, dir_okay=False))
+def index_import(filename):
+    """Replace the search engine index with a snapshot and index the
+    bookmarks changed after it
+
+    The index worker must be stopped during the import.
+    """
+
+    from ..searcher import import_snapshot, replay_snapshot
+
+    searcher = get_index_searcher()
+    # the worker would write to the index being replaced
+    if not searcher.queue.lock():
+        click.echo("Stop the index worker before importing a snapshot.", err=True)
+        sys.exit(1)
+    try:
+        watermark = import_snapshot(searcher, filename)
+        total = replay_snapshot(searcher)
+    except ValueError as ex:
+        click.echo(str(ex), err=True)
+        sys.exit(1)
+    finally:
+        searcher.queue.unlock()
+    click.echo(
+        "Imported the index up to {} and indexed {} bookmarks changed after it.".format(
+            watermark.isoformat(), total
+        )
+    )
@@ -0,0 +1,26 @@
+"""
+    qstode.cli.sync
+    ~~~~~~~~~~~~~~~
+
+    Maintenance commands for the delta sync API.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import timedelta
+import click
+from qstode.app import app
+from qstode import db
+from ..model.bookmark import prune_tombstones
+
+
+@app.cli.command("prune-tombstones")
+@click.option("--days", type=int, help="Age of the tombstones to delete [SYNC_TOMBSTONE_DAYS].")
+def prune(days):
+    """Delete the old tombstones of the deleted bookmarks"""
+
+    if days is None:
+        days = app.config["SYNC_TOMBSTONE_DAYS"]
+    deleted = prune_tombstones(timedelta(days=days))
+    db.Session.commit()
+    click.echo("Deleted {} tombstones.".format(deleted))
@@ -0,0 +1,101 @@
+"""
+    qstode.cli.tags
+    ~~~~~~~~~~~~~~~
+
+    Maintenance commands for tags.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import click
+from qstode.app import app
+from ..model.bookmark import tag_counters_drift, rebuild_tag_counters, sweep_tag_orphans
+from ..model.bookmark import tag_pairs_drift, rebuild_tag_pairs, link_tags_drift, rebuild_link_tags
+from ..model.bookmark import retag_bookmarks
+from ..model.user import User
+from qstode import db, postings
+
+
+@app.cli.command("tag-counters")
+@click.option("--check", is_flag=True, help="Only report the tags with wrong counters.")
+def tag_counters(check):
+    """Rebuild the usage counters, co-occurrences and per-link counts of tags, or check them for
+    drift"""
+
+    drift = tag_counters_drift()
+    for name, public, real_public, total, real_total in drift:
+        click.echo(
+            "{}: public {} (expected {}), total {} (expected {})".format(
+                name, public, real_public, total, real_total
+            )
+        )
+
+    if check:
+        pairs_drift = tag_pairs_drift()
+        links_drift = link_tags_drift()
+        click.echo("{} tags with wrong counters.".format(len(drift)))
+        click.echo("{} wrong tag pairs.".format(pairs_drift))
+        click.echo("{} wrong link tag counts.".format(links_drift))
+        if drift or pairs_drift or links_drift:
+            sys.exit(1)
+        return
+
+    updated = rebuild_tag_counters()
+    pairs = rebuild_tag_pairs()
+    links = rebuild_link_tags()
+    db.Session.commit()
+    click.echo(
+        "Rebuilt the counters of {} tags, {} tag pairs and {} link tags.".format(
+            updated, pairs, links
+        )
+    )
+
+
+@app.cli.command("rename-tag")
+@click.argument("old_name")
+@click.argument("new_name")
+@click.option("--user", "username", help="Only rename the tag of the bookmarks of this user.")
+def rename_tag(old_name, new_name, username):
+    """Rename a tag, merging it into NEW_NAME if that tag already exists"""
+
+    user_id = None
+    if username is not None:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            click.echo("User {} not found.".format(username), err=True)
+            sys.exit(1)
+        user_id = user.id
+
+    try:
+        ids = retag_bookmarks(old_name, new_name, user_id)
+    except ValueError as ex:
+        click.echo(str(ex), err=True)
+        sys.exit(1)
+    db.Session.commit()
+    click.echo("Renamed the tag of {} bookmarks.".format(len(ids)))
+
+
+@app.cli.command("sweep-tag-orphans")
+@click.option("--batch-size", default=1000, show_default=True, help="Tags checked per batch.")
+def sweep_orphans(batch_size):
+    """Delete the tags not used by any bookmark"""
+
+    deleted = sweep_tag_orphans(batch_size)
+    click.echo("Deleted {} orphan tags.".format(deleted))
+
+
+@app.cli.command("tag-postings")
+def tag_postings():
+    """Rebuild the snapshot of the tag posting lists"""
+
+    if not postings.manager.enabled:
+        click.echo("TAG_POSTINGS_PATH is not configured.", err=True)
+        sys.exit(1)
+
+    engine = postings.manager.save()
+    click.echo(
+        "Saved the posting lists of {} tags and {} bookmarks to {}.".format(
+            len(engine.tags), len(engine), postings.manager.path
+        )
+    )
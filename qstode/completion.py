@@ -0,0 +1,150 @@
+"""
+    qstode.completion
+    ~~~~~~~~~~~~~~~~~
+
+    In-process prefix index for tag autocompletion.
+
+    Tag names are kept in a sorted list, so the names starting with a
+    prefix are a contiguous range found with `bisect`, ranked by their
+    public usage count. The index is loaded from the database, updated
+    with the tags created and deleted by this process and reloaded every
+    `max_age` seconds to catch up with the counters and with the writes of
+    other processes.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import heapq
+import threading
+from bisect import bisect_left
+from sqlalchemy import event, select
+from . import db
+from .model.bookmark import Tag
+
+
+# Rankings of prefixes matching more names than this are memoized until the index changes
+MEMOIZE_MIN_MATCHES = 64
+
+
+class TagCompleter:
+    """Ranked prefix index over tag names"""
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.names = []
+        self.ids = []
+        self.counts = []
+        self.loaded_at = None
+        self._memo = {}
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        self.max_age = app.config.get("TAG_AUTOCOMPLETE_REFRESH", 300)
+        self.clear()
+
+    def load(self):
+        """Loads all the tag names and their public usage counts"""
+
+        query = select([Tag.name, Tag.id, Tag.public_count]).order_by(Tag.name)
+        rows = db.Session.execute(query).fetchall()
+        with self._lock:
+            self.names = [row.name for row in rows]
+            self.ids = [row.id for row in rows]
+            self.counts = [row.public_count for row in rows]
+            self.loaded_at = time.monotonic()
+            self._memo.clear()
+
+    def clear(self):
+        """Forces the index to be reloaded on the next completion"""
+
+        with self._lock:
+            self.loaded_at = None
+
+    def add(self, tag_id, name, count=None):
+        """Adds or updates the tag `name`; without a `count` the count of a
+        name already in the index is kept"""
+
+        with self._lock:
+            if self.loaded_at is None:
+                return
+            i = bisect_left(self.names, name)
+            if i < len(self.names) and self.names[i] == name:
+                self.ids[i] = tag_id
+                if count is not None:
+                    self.counts[i] = count
+            else:
+                self.names.insert(i, name)
+                self.ids.insert(i, tag_id)
+                self.counts.insert(i, count or 0)
+            self._memo.clear()
+
+    def remove(self, name):
+        with self._lock:
+            if self.loaded_at is None:
+                return
+            i = bisect_left(self.names, name)
+            if i < len(self.names) and self.names[i] == name:
+                del self.names[i], self.ids[i], self.counts[i]
+                self._memo.clear()
+
+    def complete(self, term, limit=15):
+        """Returns a list of tuples (id, name) for the `limit` most used tags
+        starting with `term`"""
+
+        term = term.lower()
+        with self._lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age:
+                self.load()
+
+            rv = self._memo.get((term, limit))
+            if rv is not None:
+                return rv
+
+            lo = bisect_left(self.names, term)
+            hi = bisect_left(self.names, term + "\U0010ffff", lo)
+            counts, names = self.counts, self.names
+            best = heapq.nsmallest(limit, range(lo, hi), key=lambda i: (-counts[i], names[i]))
+            rv = [(self.ids[i], names[i]) for i in best]
+
+            if hi - lo > MEMOIZE_MIN_MATCHES:
+                self._memo[(term, limit)] = rv
+            return rv
+
+
+completer = TagCompleter()
+
+
+@event.listens_for(db.Session, "after_flush")
+def collect_completion_changes(session, ctx):
+    changes = session.info.setdefault("completion_changes", [])
+    for obj in session.new:
+        if isinstance(obj, Tag):
+            changes.append((obj.id, obj.name, obj.public_count or 0))
+    for obj in session.deleted:
+        if isinstance(obj, Tag):
+            changes.append((None, obj.name, 0))
+
+
+@event.listens_for(db.Session, "after_commit")
+def apply_completion_changes(session):
+    for tag_id, name, count in session.info.pop("completion_changes", ()):
+        if tag_id is None:
+            completer.remove(name)
+        else:
+            completer.add(tag_id, name, count)
+    # tags inserted by `Tag.get_or_create_many()` without a flush
+    for tag_id, name in session.info.get("created_tags", ()):
+        completer.add(tag_id, name)
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_completion_changes(session, previous_transaction):
+    session.info.pop("completion_changes", None)
+
+
+# the created tags are also read by the tag postings on commit
+@event.listens_for(db.Session, "after_transaction_end")
+def forget_created_tags(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("created_tags", None)
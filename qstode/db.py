@@ -9,8 +9,12 @@
     :copyright: (c) 2013 by Daniel Kertesz
     :license: BSD, see LICENSE for more details.
 """
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+import iso8601
 from flask import abort
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, and_, or_, func
 from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import make_url
@@ -44,27 +48,279 @@ class BaseQuery(orm.Query):
             abort(404)
         return rv
 
-    def paginate(self, page, per_page=20, error_out=True):
+    def paginate(
+        self,
+        page,
+        per_page=20,
+        error_out=True,
+        count=True,
+        keys=None,
+        count_cache=None,
+        count_limit=None,
+    ):
         """Returns `per_page` items from page `page`.  By default it will
         abort with 404 if no items were found and the page was larger than
         1.  This behavor can be disabled by setting `error_out` to `False`.
 
+        When `count` is `False` the total number of items is not computed:
+        one more row than needed is fetched to tell if a next page exists.
+
+        The optional `keys` (see :meth:`seek`) are used to generate cursors
+        pointing to the adjacent pages.
+
+        The total can be looked up and stored in a :class:`~utils.CountCache`
+        passed as `count_cache`. When `count_limit` is set the rows are
+        counted only up to `count_limit` (or up to the current page, if
+        larger) and bigger totals are reported as not exact.
+
         Returns an :class:`Pagination` object.
         """
         if error_out and page < 1:
             abort(404)
-        items = self.limit(per_page).offset((page - 1) * per_page).all()
+
+        if not count:
+            items = self.limit(per_page + 1).offset((page - 1) * per_page).all()
+            if not items and page != 1 and error_out:
+                abort(404)
+            has_next = len(items) > per_page
+            return utils.Pagination(
+                self,
+                page,
+                per_page,
+                None,
+                items[:per_page],
+                has_next=has_next,
+                keys=keys,
+                total_exact=False,
+            )
+
+        # a not exact total must at least tell if there's a page after this one
+        min_total = page * per_page + 1
+        total, exact = None, True
+        cache_key = None
+        if count_cache is not None:
+            cache_key = count_cache.key(self.count_fingerprint())
+            cached = count_cache.get(cache_key)
+            if cached is not None:
+                cached_total, cached_exact = cached
+                if cached_exact or (count_limit is not None and cached_total >= min_total):
+                    total, exact = cached
+
+        if total is None and count_limit is None and self._can_count_over():
+            # fetch the items and the total in a single statement; the window
+            # function is evaluated after GROUP BY/HAVING and before LIMIT.
+            query = self.add_columns(func.count().over().label("_pagination_total"))
+            rows = query.limit(per_page).offset((page - 1) * per_page).all()
+            if len(self.column_descriptions) == 1:
+                items = [row[0] for row in rows]
+            else:
+                # rows of a column query, with the extra total at the end
+                items = rows
+            if rows:
+                total = rows[0][-1]
+        else:
+            items = self.limit(per_page).offset((page - 1) * per_page).all()
+
         if not items and page != 1 and error_out:
             abort(404)
 
-        # No need to count if we're on the first page and there are fewer
-        # items than we expected.
-        if page == 1 and len(items) < per_page:
-            total = len(items)
+        if total is None:
+            # No need to count if we're on the first page and there are fewer
+            # items than we expected.
+            if page == 1 and len(items) < per_page:
+                total = len(items)
+            elif count_limit is not None:
+                total, exact = self._count_upto(max(count_limit, min_total))
+            else:
+                total = self.order_by(None).count()
+        if cache_key is not None:
+            count_cache.set(cache_key, (total, exact))
+
+        return utils.Pagination(self, page, per_page, total, items, keys=keys, total_exact=exact)
+
+    def count_fingerprint(self):
+        """Returns a key identifying the set of rows counted by this query:
+        the ordering and the eager loads are ignored."""
+        query = self.enable_eagerloads(False).order_by(None)
+        bind = self.session.get_bind()
+        compiled = query.statement.compile(dialect=bind.dialect)
+        params = sorted(compiled.params.items())
+        data = "%s\n%s\n%r" % (bind.url, compiled, params)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def _count_upto(self, limit):
+        """Counts the rows of this query, stopping after `limit` rows.
+
+        :returns: a tuple (total, exact)
+        """
+        subq = self.order_by(None).limit(limit + 1).subquery()
+        total = self.session.query(func.count()).select_from(subq).scalar()
+        if total > limit:
+            return limit, False
+        return total, True
+
+    def _can_count_over(self):
+        """Tells if the total count can be fetched along with the items
+        with a `COUNT(*) OVER ()` window function"""
+        if any(column["entity"] is None for column in self.column_descriptions):
+            return False
+        return supports_window_functions(self.session.get_bind())
+
+    def seek(self, cursor, per_page=20, keys=None, error_out=True):
+        """Returns `per_page` items following (or preceding) the position
+        encoded in `cursor`, using keyset pagination instead of `OFFSET`.
+
+        `keys` is a sequence of columns that uniquely identify a row (e.g.
+        `(Bookmark.created_on, Bookmark.id)`); the results are always
+        ordered by `keys`, descending. A `None` cursor returns the first
+        page. The total number of items is never computed.
+
+        An invalid cursor aborts with 400, unless `error_out` is `False`.
+
+        Returns an :class:`Pagination` object.
+        """
+        assert keys, "keyset pagination requires at least one key column"
+
+        direction, page, values = utils.CURSOR_NEXT, 1, None
+        if cursor:
+            try:
+                direction, page, values = utils.decode_cursor(cursor)
+                values = _cursor_values(keys, values)
+            except ValueError:
+                if error_out:
+                    abort(400)
+                direction, page, values = utils.CURSOR_NEXT, 1, None
+
+        forward = direction == utils.CURSOR_NEXT
+        query = self.order_by(None)
+        if values is not None:
+            query = query.filter(_seek_clause(keys, values, forward))
+        if forward:
+            query = query.order_by(*[key.desc() for key in keys])
         else:
-            total = self.order_by(None).count()
+            query = query.order_by(*[key.asc() for key in keys])
 
-        return utils.Pagination(self, page, per_page, total, items)
+        items = query.limit(per_page + 1).all()
+        if not items and page != 1 and error_out:
+            abort(404)
+
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if forward:
+            has_next = has_more
+        else:
+            # we got here walking backwards from the next page
+            items.reverse()
+            has_next = True
+
+        return utils.Pagination(
+            self,
+            page,
+            per_page,
+            None,
+            items,
+            has_next=has_next,
+            keys=keys,
+            keyset=True,
+            total_exact=False,
+        )
+
+
+def supports_window_functions(bind):
+    """Returns True if the database behind `bind` supports window functions:
+    SQLite >= 3.25, MySQL >= 8.0, MariaDB >= 10.2 and PostgreSQL."""
+
+    dialect = bind.dialect
+    if dialect.name == "postgresql":
+        return True
+    elif dialect.name == "sqlite":
+        return dialect.dbapi.sqlite_version_info >= (3, 25, 0)
+    elif dialect.name == "mysql":
+        # the server version is only known after the first connection
+        version = dialect.server_version_info
+        if version is None:
+            return False
+        if getattr(dialect, "_is_mariadb", False):
+            return version >= (10, 2)
+        return version >= (8, 0)
+    return False
+
+
+def insert_ignore(table, bind=None):
+    """Returns an INSERT statement for `table` that silently skips the rows
+    violating a primary key or unique constraint.
+
+    On MySQL ``INSERT IGNORE`` also turns the other errors into warnings,
+    truncating too long strings and storing defaults in place of invalid
+    values: the callers must validate the rows beforehand.
+    """
+
+    bind = bind or Session.get_bind()
+    dialect = bind.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+
+        return insert(table).on_conflict_do_nothing()
+    elif dialect == "mysql":
+        return table.insert().prefix_with("IGNORE")
+    elif dialect == "sqlite":
+        return table.insert().prefix_with("OR IGNORE")
+    return table.insert()
+
+
+@contextmanager
+def read_snapshot(session=None):
+    """Runs the block in a new transaction reading a consistent snapshot of
+    the database, rolled back at the end: REPEATABLE READ on PostgreSQL and
+    MySQL, an explicit deferred transaction on SQLite."""
+
+    session = session or Session()
+    session.close()
+    dialect = session.get_bind().dialect.name
+    if dialect in ("postgresql", "mysql"):
+        session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    elif dialect == "sqlite":
+        # pysqlite doesn't begin a transaction before a SELECT
+        session.execute("BEGIN")
+    try:
+        yield session
+    finally:
+        session.rollback()
+
+
+def _cursor_values(keys, values):
+    """Converts the raw values decoded from a cursor to the python type of
+    their columns"""
+
+    if len(values) != len(keys):
+        raise ValueError("Invalid cursor")
+
+    rv = []
+    for key, value in zip(keys, values):
+        if value is None:
+            raise ValueError("Invalid cursor")
+        python_type = key.type.python_type
+        if python_type is datetime:
+            try:
+                value = iso8601.parse_date(value).replace(tzinfo=None)
+            except (iso8601.ParseError, TypeError):
+                raise ValueError("Invalid cursor")
+        elif not isinstance(value, python_type):
+            raise ValueError("Invalid cursor")
+        rv.append(value)
+    return rv
+
+
+def _seek_clause(keys, values, forward=True):
+    """Builds the row comparison `keys < values` (or `keys > values`) as a
+    chain of OR clauses, since row values are not supported by every
+    database"""
+
+    clauses = []
+    for i, key in enumerate(keys):
+        cmp = key < values[i] if forward else key > values[i]
+        clauses.append(and_(*([keys[j] == values[j] for j in range(i)] + [cmp])))
+    return or_(*clauses)
 
 
 class Base:
@@ -86,6 +342,9 @@ Session = orm.scoped_session(
 Base = declarative_base(cls=Base)
 Base.query = Session.query_property()
 
+# Cache for the pagination totals, invalidated when bookmarks are written.
+count_cache = utils.CountCache()
+
 
 def init_alembic(config_file="alembic.ini"):
     """Initialize alembic (i.e. set the migration version to "current")
@@ -100,7 +359,7 @@ def init_alembic(config_file="alembic.ini"):
 
 def init_db(uri, app=None, create=False):
     # we must import all SQLAlchemy models here
-    from .model import bookmark  # noqa
+    from .model import bookmark
     from .model import user  # noqa
 
     options = {"convert_unicode": True}
@@ -121,6 +380,14 @@ def init_db(uri, app=None, create=False):
 
     engine = create_engine(info, **options)
     Session.configure(bind=engine)
+
+    count_cache.clear()
+    count_cache.generation = None
+    if app is not None:
+        count_cache.ttl = app.config.get("PAGINATION_COUNT_CACHE_TTL", 0)
+        if app.config.get("PAGINATION_COUNT_CACHE_SHARED"):
+            count_cache.generation = bookmark.count_generation
+
     if create is True:
         create_all(engine)
 
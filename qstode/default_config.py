@@ -18,6 +18,19 @@ TAGLIST_ITEMS = 30
 # Temporary switch for related tags
 ENABLE_RELATED_TAGS = True
 
+# Full text search on bookmarks with Whoosh: needs the "search" extra requirements and the
+# WHOOSH_INDEX_PATH option; the indexing queue is stored in Redis when REDIS_HOST is set, in the
+# INDEX_QUEUE_PATH SQLite database otherwise (by default next to the index directory).
+ENABLE_SEARCH = False
+
+# Search engine used by ENABLE_SEARCH: "whoosh", or "fts5" to keep the index in a SQLite FTS5 table
+# of the application database (requires a SQLite database).
+SEARCH_BACKEND = "whoosh"
+
+# Number of parsed queries and of result pages cached by each process; cached results are
+# discarded when the search index changes.
+SEARCH_CACHE_SIZE = 512
+
 # Enable new users registration
 ENABLE_USER_REGISTRATION = True
 
@@ -27,5 +40,47 @@ ENABLE_RECAPTCHA = False
 # Autocomplete API: number of tag returned
 TAG_AUTOCOMPLETE_MAX = 15
 
+# Autocomplete API: seconds between reloads of the in-memory index of tag names, to pick up the
+# usage counters and the tags created by other processes
+TAG_AUTOCOMPLETE_REFRESH = 300
+
+# Autocomplete API: seconds browsers and proxies may cache the completions of a prefix
+TAG_AUTOCOMPLETE_CACHE_MAX_AGE = 60
+
+# Post form: number of tags suggested for a URL already bookmarked by other users
+SUGGESTED_TAGS_MAX = 10
+
+# JSON API: maximum number of bookmarks in a batch request or in a multi-get
+API_BATCH_MAX_ITEMS = 1000
+
+# Delta sync API: seconds a change waits before being returned, for the transaction writing it to
+# commit, and days the tombstones of the deleted bookmarks are kept
+SYNC_SETTLE_SECONDS = 5
+SYNC_TOMBSTONE_DAYS = 90
+
 # Restrict registration to the following domains: (empty list disable this feature)
 FRIEND_DOMAINS = []
+
+# Pagination of bookmark lists: "count" shows the total number of pages, "has_next" skips
+# counting the results and "keyset" navigates pages with cursors instead of offsets.
+PAGINATION_MODE = "count"
+
+# Seconds a pagination total is cached for; the cache of a process is invalidated when it changes
+# bookmarks (0 disables the cache).
+PAGINATION_COUNT_CACHE_TTL = 60
+
+# Invalidate the cached pagination totals of all the processes when bookmarks change, through a
+# counter stored in the database: every write updates it and every cached total reads it.
+PAGINATION_COUNT_CACHE_SHARED = False
+
+# Count the results of bookmark lists only up to this number of rows and show an approximate total
+# beyond it (None always counts every row).
+PAGINATION_APPROXIMATE_COUNT = None
+
+# Leave orphan tags in the database at every write and delete them in batches with the
+# "sweep-tag-orphans" command, e.g. from a cron job.
+DEFER_TAG_ORPHANS_CLEANUP = False
+
+# Snapshot file of the in-memory tag posting lists used by tag searches, built with the
+# "tag-postings" command; the file is shared by all the worker processes (None disables them).
+TAG_POSTINGS_PATH = None
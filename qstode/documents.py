@@ -0,0 +1,88 @@
+"""
+    qstode.documents
+    ~~~~~~~~~~~~~~~~
+
+    Search engine documents built from bookmarks, shared by the search
+    backends.
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+from collections import namedtuple
+from urllib.parse import urlsplit
+from sqlalchemy import select
+from qstode import db, utils
+from qstode.model.bookmark import Bookmark, Tag, Link, bookmark_tags
+
+
+# A page of search results: the bookmark ids, in rank order, the total number of hits and a list of
+# (tag name, hits) tuples for the most common tags among all the hits
+SearchPage = namedtuple("SearchPage", "ids total tags")
+
+
+def create_document(bookmark):
+    """Creates a Document (a dict) for the search engine"""
+
+    return make_document(bookmark, [tag.name for tag in bookmark.tags])
+
+
+def make_document(bookmark, tags):
+    """Creates a Document (a dict) from a bookmark, or a row with the same
+    attributes (including `href`), and the names of its tags"""
+
+    return {
+        "id": str(bookmark.id),
+        "title": bookmark.title or "",
+        "notes": bookmark.notes or "",
+        "tags": ", ".join(tags),
+        "private": bool(bookmark.private),
+        "user_id": bookmark.user_id,
+        "created_on": bookmark.created_on,
+        "domain": urlsplit(bookmark.href or "").hostname or "",
+    }
+
+
+def iter_documents(after_id=0, chunk_size=500, criterion=None):
+    """Yields the search engine documents of the bookmarks matching
+    `criterion` with an id greater than `after_id`, in lists of up to
+    `chunk_size` documents ordered by id.
+
+    Rows are read with two plain queries per chunk, one for the bookmarks
+    and one for their tags, without loading ORM objects.
+    """
+
+    table = Bookmark.__table__
+    columns = [
+        table.c.id,
+        table.c.title,
+        table.c.notes,
+        table.c.private,
+        table.c.user_id,
+        table.c.created_on,
+        Link.href,
+    ]
+    while True:
+        query = (
+            select(columns)
+            .select_from(table.outerjoin(Link.__table__))
+            .where(table.c.id > after_id)
+        )
+        if criterion is not None:
+            query = query.where(criterion)
+        rows = db.Session.execute(query.order_by(table.c.id).limit(chunk_size)).fetchall()
+        if not rows:
+            return
+
+        tags = {row.id: [] for row in rows}
+        for chunk in utils.chunks(list(tags), 500):
+            query = (
+                select([bookmark_tags.c.bookmark_id, Tag.name])
+                .select_from(bookmark_tags.join(Tag.__table__))
+                .where(bookmark_tags.c.bookmark_id.in_(chunk))
+                .order_by(Tag.name)
+            )
+            for bookmark_id, name in db.Session.execute(query):
+                tags[bookmark_id].append(name)
+
+        yield [make_document(row, tags[row.id]) for row in rows]
+        after_id = rows[-1].id
@@ -0,0 +1,105 @@
+"""
+    qstode.export
+    ~~~~~~~~~~~~~
+
+    Streamed exports of bookmarks in the Netscape bookmark file format, as
+    JSON Lines or as CSV, optionally compressed with gzip.
+
+    The exporters consume an iterable of `BookmarkRecord` (e.g. from
+    `qstode.model.records.iter_records()`) and produce the file a chunk at
+    a time, so that memory use doesn't depend on the number of bookmarks.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import io
+import csv
+import json
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+
+
+# Size of the chunks sent to the client, before compression
+BUFFER_SIZE = 64 * 1024
+
+CSV_FIELDS = ("url", "title", "notes", "tags", "private", "created_on", "modified_on")
+
+
+def export_html(records):
+    """Renders the Netscape bookmark file template, lazily"""
+
+    template = current_app.jinja_env.get_template("_export.html")
+    return template.generate(bookmarks=records, today=datetime.now())
+
+
+def export_jsonl(records):
+    for record in records:
+        yield json.dumps(record.to_dict(), ensure_ascii=False) + "\n"
+
+
+def export_csv(records):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CSV_FIELDS)
+    for record in records:
+        writer.writerow(
+            [
+                record.href,
+                record.title,
+                record.notes or "",
+                ",".join(tag.name for tag in record.tags),
+                int(record.private),
+                record.created_on.isoformat(),
+                record.modified_on.isoformat(),
+            ]
+        )
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+
+ExportFormat = namedtuple("ExportFormat", "extension mimetype exporter")
+
+FORMATS = {
+    "html": ExportFormat("html", "text/html; charset=utf-8", export_html),
+    "jsonl": ExportFormat("jsonl", "application/x-ndjson", export_jsonl),
+    "csv": ExportFormat("csv", "text/csv; charset=utf-8", export_csv),
+}
+
+
+def buffered(chunks, size=BUFFER_SIZE):
+    """Joins the small strings of `chunks` into UTF-8 encoded chunks of at
+    least `size` bytes"""
+
+    buf, length = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield "".join(buf).encode("utf-8")
+            buf, length = [], 0
+    if buf:
+        yield "".join(buf).encode("utf-8")
+
+
+def gzipped(chunks, level=6):
+    """Compresses the bytes of `chunks` into a gzip stream"""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(name, records, compress=False):
+    """Returns an iterator of the bytes of the export of `records` in the
+    format `name`, one of `FORMATS`"""
+
+    chunks = buffered(FORMATS[name].exporter(records))
+    if compress:
+        chunks = gzipped(chunks)
+    return chunks
@@ -12,6 +12,7 @@ from qstode.forms.user import (  # noqa
 )
 from qstode.forms.bookmark import (  # noqa
     SimpleSearchForm,
+    TextSearchForm,
     TypeaheadTextInput,
     BookmarkForm,
     TagSelectionForm,
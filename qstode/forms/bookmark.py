@@ -10,11 +10,12 @@
 import re
 from flask_wtf import FlaskForm
 from wtforms import StringField, Field, BooleanField, TextAreaField, HiddenField, SelectField
-from wtforms.fields.html5 import URLField
-from wtforms.validators import DataRequired, Length, URL, Optional
+from wtforms.fields.html5 import URLField, DateField
+from wtforms.validators import DataRequired, Length, URL, Optional, Regexp
 from wtforms.widgets import TextInput
 from flask_babel import lazy_gettext as _
-from ..model.bookmark import tag_name_re, TAG_MIN, TAG_MAX, NOTES_MAX, create_bookmark
+from ..model.bookmark import tag_name_re, TAG_MIN, TAG_MAX, NOTES_MAX, URL_MAX
+from ..model.bookmark import create_bookmark
 from .misc import RedirectForm
 from .validators import ItemsLength, ListLength, ListRegexp
 
@@ -84,6 +85,17 @@ class SimpleSearchForm(FlaskForm):
     page = HiddenField()
 
 
+class TextSearchForm(FlaskForm):
+    """Full text search form; submitted with GET requests"""
+
+    class Meta:
+        csrf = False
+
+    q = StringField(_("Query"), [DataRequired(), Length(max=200)])
+    start = DateField(_("Created since"), [Optional()])
+    end = DateField(_("Created until"), [Optional()])
+
+
 class TypeaheadTextInput(TextInput):
     """A TextInput with javascript 'typeahead' support"""
 
@@ -96,7 +108,7 @@ class BookmarkForm(RedirectForm):
     """Form used to post new bookmarks"""
 
     title = StringField(_("Title"), [DataRequired()])
-    url = URLField(_("URL"), [DataRequired(), URL()])
+    url = URLField(_("URL"), [DataRequired(), URL(), Length(max=URL_MAX)])
     private = BooleanField(_("Private"), default=False)
     tags = TagListField(
         _("Tag"),
@@ -139,4 +151,7 @@ class TagSelectionForm(FlaskForm):
 
 class RenameTagForm(FlaskForm):
     old_name = StringField(_("Tag name"), [DataRequired(), Length(TAG_MIN, TAG_MAX)])
-    new_name = StringField(_("New tag name"), [DataRequired(), Length(TAG_MIN, TAG_MAX)])
+    new_name = StringField(
+        _("New tag name"), [DataRequired(), Length(TAG_MIN, TAG_MAX), Regexp(tag_name_re)]
+    )
+    all_users = BooleanField(_("Rename the tag for every user"), default=False)
@@ -0,0 +1,270 @@
+"""
+    qstode.fts
+    ~~~~~~~~~~
+
+    SQLite FTS5 search engine support.
+
+    The index is a FTS5 virtual table in the application database, with
+    the bookmark ids as rowids. It's updated by the session flush that
+    writes the bookmarks, so it commits and rolls back with them, and the
+    search results are filtered by joining the bookmarks table.
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+import time
+from flask import current_app, has_app_context
+from sqlalchemy import event, select, func, and_, or_, false, text, table, column
+from qstode import db, utils
+from qstode.model.bookmark import Bookmark, Tag, bookmark_tags
+from qstode.documents import SearchPage, iter_documents
+
+
+FTS_TABLE = "bookmarks_fts"
+
+CREATE_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, notes, tags, domain UNINDEXED, "
+    'tokenize = "unicode61 remove_diacritics 2")' % FTS_TABLE
+)
+
+fts_table = table(FTS_TABLE, column("rowid"), column("domain"), column("rank"))
+
+# a query term: an optional field name followed by a quoted phrase or a word
+_term_re = re.compile(r"""(?:(\w+):)?(?:'([^']*)'|"([^"]*)"|(\S+))""")
+
+_operators = ("AND", "OR", "NOT")
+
+
+def _phrase(text):
+    return '"%s"' % text.replace('"', '""')
+
+
+def parse_query(query, fields):
+    """Translates a user query, in the same syntax accepted by the Whoosh
+    backend, to a FTS5 query expression.
+
+    Words and quoted phrases are searched in `fields`; `title:`, `notes:`
+    and `tags:` prefixes restrict a term to one field, and `AND`, `OR` and
+    `NOT` are kept as operators. A `domain:` term is not part of the
+    expression and is returned separately.
+
+    :returns: a tuple (expression, domain), where both can be `None`
+    """
+
+    terms = []
+    domain = None
+    for match in _term_re.finditer(query):
+        field = match.group(1)
+        value = next(group for group in match.group(2, 3, 4) if group is not None)
+
+        if field is None and value in _operators:
+            # operators are only valid between two terms
+            if terms and terms[-1] not in _operators:
+                terms.append(value)
+        elif field == "domain":
+            domain = value.lower()
+        elif field in ("title", "notes", "tags"):
+            terms.append("%s : %s" % (field, _phrase(value)))
+        else:
+            if field is not None:
+                value = match.group(0)
+            terms.append("{%s} : %s" % (" ".join(fields), _phrase(value)))
+
+    while terms and terms[-1] in _operators:
+        terms.pop()
+    return " ".join(terms) or None, domain
+
+
+class FTSSearcher(object):
+    """Search engine based on a SQLite FTS5 virtual table, offering the
+    same operations of `WhooshSearcher`"""
+
+    # default search fields for user queries
+    search_fields = ("notes", "title", "tags")
+
+    # number of tags returned with the search results
+    facet_limit = 20
+
+    def __init__(self, app=None):
+        self.app = app
+
+    def init_app(self, app):
+        """Initialize module and create the index table if needed"""
+
+        self.app = app
+        if db.Session.get_bind().dialect.name != "sqlite":
+            raise Exception("The fts5 search backend requires a SQLite database")
+        self.setup_index()
+        app.extensions["searcher"] = self
+
+    def setup_index(self):
+        """Create the index table"""
+
+        with db.Session.get_bind().begin() as conn:
+            conn.execute(text(CREATE_TABLE))
+
+    def index_bookmarks(self, ids, chunk_size=500):
+        """Indexes again the bookmarks `ids`, removing from the index the
+        ones that don't exist anymore; runs in the current transaction.
+
+        :returns: the number of indexed bookmarks
+        """
+
+        total = 0
+        for chunk in utils.chunks(sorted(ids), chunk_size):
+            db.Session.execute(fts_table.delete().where(fts_table.c.rowid.in_(chunk)))
+            documents = iter_documents(chunk_size=chunk_size, criterion=Bookmark.id.in_(chunk))
+            total += self._insert(documents)
+        return total
+
+    def _insert(self, chunks):
+        total = 0
+        for documents in chunks:
+            db.Session.execute(
+                text(
+                    "INSERT INTO %s (rowid, title, notes, tags, domain) "
+                    "VALUES (:id, :title, :notes, :tags, :domain)" % FTS_TABLE
+                ),
+                documents,
+            )
+            total += len(documents)
+        return total
+
+    def rebuild(self, chunk_size=500, progress=None):
+        """Recreates the index table with all the bookmarks and commits.
+
+        :returns: the number of indexed bookmarks
+        """
+
+        db.Session.execute(text("DROP TABLE IF EXISTS %s" % FTS_TABLE))
+        db.Session.execute(text(CREATE_TABLE))
+        total = 0
+        started = time.monotonic()
+        for documents in iter_documents(chunk_size=chunk_size):
+            total += self._insert([documents])
+            if progress is not None:
+                progress(total, time.monotonic() - started)
+        db.Session.commit()
+        return total
+
+    def add_bookmark(self, bookmark, writer=None):
+        """Index a bookmark, updating it if it's already indexed; `writer`
+        is accepted for compatibility with `WhooshSearcher` and ignored"""
+
+        self.index_bookmarks([bookmark.id])
+
+    def update_bookmark(self, bookmark, writer=None):
+        """Reindex a Bookmark"""
+
+        self.add_bookmark(bookmark)
+
+    def delete_bookmark(self, bookmark_id, writer=None):
+        """Delete a Bookmark from the index"""
+
+        db.Session.execute(fts_table.delete().where(fts_table.c.rowid == bookmark_id))
+
+    def search(
+        self,
+        query,
+        page=1,
+        page_len=10,
+        fields=None,
+        viewer_id=None,
+        user_id=None,
+        start=None,
+        end=None,
+    ):
+        """Returns a page of results of a search engine query, ordered by
+        relevance; the arguments are the same of `WhooshSearcher.search`.
+
+        :returns: a `SearchPage` with the bookmark ids (int), the total
+            number of hits and the most common tags among the hits
+        :raises ValueError: when `page` is out of range
+        """
+        if page < 1:
+            raise ValueError("page must be >= 1")
+        if fields is None:
+            fields = tuple(self.search_fields)
+        expression, domain = parse_query(query, fields)
+        if expression is None and domain is None:
+            return SearchPage([], 0, [])
+
+        bookmarks = Bookmark.__table__
+        visible = bookmarks.c.private == false()
+        if viewer_id is not None:
+            visible = or_(visible, bookmarks.c.user_id == viewer_id)
+        where = [visible]
+        if expression is not None:
+            where.append(text("%s MATCH :expression" % FTS_TABLE).bindparams(expression=expression))
+        if domain is not None:
+            where.append(fts_table.c.domain == domain)
+        if user_id is not None:
+            where.append(bookmarks.c.user_id == user_id)
+        if start is not None:
+            where.append(bookmarks.c.created_on >= start)
+        if end is not None:
+            where.append(bookmarks.c.created_on <= end)
+
+        hits = (
+            select([fts_table.c.rowid])
+            .select_from(fts_table.join(bookmarks, bookmarks.c.id == fts_table.c.rowid))
+            .where(and_(*where))
+        )
+        total = db.Session.execute(select([func.count()]).select_from(hits.alias())).scalar()
+        if page > 1 and (page - 1) * page_len >= total:
+            raise ValueError("page %d is out of range" % page)
+
+        if expression is not None:
+            order_by = [fts_table.c.rank, bookmarks.c.id.desc()]
+        else:
+            order_by = [bookmarks.c.created_on.desc(), bookmarks.c.id.desc()]
+        query = hits.order_by(*order_by).limit(page_len).offset((page - 1) * page_len)
+        ids = [row.rowid for row in db.Session.execute(query)]
+
+        count = func.count().label("count")
+        query = (
+            select([Tag.name, count])
+            .select_from(bookmark_tags.join(Tag.__table__))
+            .where(bookmark_tags.c.bookmark_id.in_(hits))
+            .group_by(Tag.name)
+            .order_by(count.desc(), Tag.name)
+            .limit(self.facet_limit)
+        )
+        tags = [(row.name, row.count) for row in db.Session.execute(query)]
+
+        return SearchPage(ids, total, tags)
+
+
+# The index is written in the same transaction of the bookmarks
+@event.listens_for(db.Session, "after_flush")
+def sync_fts_index(session, ctx):
+    if not has_app_context():
+        return
+    searcher = current_app.extensions.get("searcher")
+    if not isinstance(searcher, FTSSearcher):
+        return
+
+    ids = set()
+    for obj in session.new:
+        if isinstance(obj, Bookmark):
+            ids.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Bookmark) and session.is_modified(obj):
+            ids.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Bookmark):
+            ids.add(obj.id)
+    if ids:
+        searcher.index_bookmarks(ids)
+
+
+# Bookmarks retagged by `retag_bookmarks()` with plain SQL never go through a flush
+@event.listens_for(db.Session, "before_commit")
+def sync_retagged_bookmarks(session):
+    ids = session.info.get("retagged_bookmarks")
+    if not ids or not has_app_context():
+        return
+    searcher = current_app.extensions.get("searcher")
+    if isinstance(searcher, FTSSearcher):
+        searcher.index_bookmarks(ids)
@@ -13,12 +13,16 @@ import click
 import jinja2
 from flask.logging import default_handler
 from .app import app, login_manager
-from . import db, utils
+from . import db, utils, postings, completion
 from .model import user as user_model
 
 # some circular imports needed to have nice things
 from .cli.backup import backup, import_file  # noqa
 from .cli.scuttle_importer import import_scuttle  # noqa
+from .cli.tags import tag_counters, rename_tag, sweep_orphans, tag_postings  # noqa
+from .cli.links import link_hashes  # noqa
+from .cli.sync import prune  # noqa
+from .cli.search import index_worker, reindex, index_export, index_import  # noqa
 
 from .views import api  # noqa
 from .views import admin  # noqa
@@ -55,7 +59,18 @@ def create_app(cfg=None):
 
     try:
         db.init_db(app.config["SQLALCHEMY_DATABASE_URI"], app)
+        postings.manager.init_app(app)
+        completion.completer.init_app(app)
         login_manager.init_app(app)
+        if app.config["ENABLE_SEARCH"]:
+            if app.config["SEARCH_BACKEND"] == "fts5":
+                from .fts import FTSSearcher
+
+                FTSSearcher().init_app(app)
+            else:
+                from .searcher import WhooshSearcher
+
+                WhooshSearcher().init_app(app)
     except Exception as ex:
         click.echo("Initialization error: {}".format(ex), err=True)
         sys.exit(1)
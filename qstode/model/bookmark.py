@@ -9,25 +9,493 @@
 """
 import re
 import math
+import hashlib
+import itertools
+from collections import namedtuple
 from datetime import datetime, timedelta
 from typing import List
+from urllib.parse import urlsplit, urlunsplit
 import sqlalchemy.types
-from sqlalchemy import desc, func, and_, not_, or_, cast, distinct
+from sqlalchemy import desc, func, and_, not_, or_, case, cast, distinct, select
 from sqlalchemy import Table, Column, ForeignKey, Integer, String, DateTime
-from sqlalchemy import Boolean, event
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Boolean, Index, bindparam, event, exists, literal
+from sqlalchemy.orm import relationship, backref, attributes, column_property, validates
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.sql.expression import false, true
+from flask import current_app, has_app_context
 from flask_login import current_user
-from qstode import db
+from qstode import db, utils
 from qstode.model.user import User, watched_users
 
 
-# Automatically delete orphan tags on database flush.
+# Collect the tags that could become orphans during a flush: new tags and tags removed from a
+# bookmark or belonging to a deleted bookmark.
+@event.listens_for(db.Session, "before_flush")
+def track_detached_tags(session, ctx, instances):
+    detached = session.info.setdefault("detached_tags", set())
+
+    for obj in session.new:
+        if isinstance(obj, Tag):
+            detached.add(obj)
+
+    for obj in session.dirty:
+        if isinstance(obj, Bookmark):
+            history = attributes.get_history(obj, "tags", attributes.PASSIVE_NO_INITIALIZE)
+            detached.update(history.deleted or ())
+
+    for obj in session.deleted:
+        if isinstance(obj, Bookmark):
+            tags = attributes.get_history(obj, "tags")
+            detached.update(itertools.chain(tags.unchanged, tags.deleted))
+
+
+# Automatically delete orphan tags on database flush, checking only the tags detached during the
+# flush; with DEFER_TAG_ORPHANS_CLEANUP orphans are left to `sweep_tag_orphans()`.
 # http://stackoverflow.com/questions/9234082/setting-delete-orphan-on-sqlalchemy-relationship-causes-assertionerror-this-att
 @event.listens_for(db.Session, "after_flush")
 def delete_tag_orphans(session, ctx):
-    session.query(Tag).filter(~Tag.bookmarks.any()).delete(synchronize_session=False)
+    detached = session.info.pop("detached_tags", None)
+    if not detached:
+        return
+    if has_app_context() and current_app.config.get("DEFER_TAG_ORPHANS_CLEANUP"):
+        return
+
+    ids = [tag.id for tag in detached if tag.id is not None]
+    if ids:
+        session.query(Tag).filter(Tag.id.in_(ids)).filter(~Tag.bookmarks.any()).delete(
+            synchronize_session=False
+        )
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_detached_tags(session, previous_transaction):
+    session.info.pop("detached_tags", None)
+
+
+def _bookmark_changes(session):
+    """Yields a tuple (old link, old tags, was public, new link, new tags,
+    is public) for each Bookmark added, modified or deleted in `session`."""
+
+    for obj in session.new:
+        if isinstance(obj, Bookmark):
+            yield None, (), False, obj.link, obj.tags, not obj.private
+
+    for obj in session.dirty:
+        if isinstance(obj, Bookmark) and session.is_modified(obj):
+            link = attributes.get_history(obj, "link")
+            tags = attributes.get_history(obj, "tags")
+            private = attributes.get_history(obj, "private")
+            was_private = private.deleted[0] if private.deleted else obj.private
+            yield (
+                link.deleted[0] if link.deleted else obj.link,
+                list(itertools.chain(tags.unchanged, tags.deleted)),
+                not was_private,
+                obj.link,
+                list(itertools.chain(tags.unchanged, tags.added)),
+                not obj.private,
+            )
+
+    for obj in session.deleted:
+        if isinstance(obj, Bookmark):
+            link = attributes.get_history(obj, "link")
+            tags = attributes.get_history(obj, "tags")
+            private = attributes.get_history(obj, "private")
+            was_private = private.deleted[0] if private.deleted else obj.private
+            yield (
+                next(itertools.chain(link.deleted, link.unchanged), None),
+                list(itertools.chain(tags.unchanged, tags.deleted)),
+                not was_private,
+                None,
+                (),
+                False,
+            )
+
+
+def _bookmark_tag_changes(session):
+    """Yields a tuple (old tags, was public, new tags, is public) for each
+    Bookmark added, modified or deleted in `session`."""
+
+    for _, old_tags, was_public, _, new_tags, is_public in _bookmark_changes(session):
+        yield old_tags, was_public, new_tags, is_public
+
+
+def _count_tags(deltas, tags, public, sign):
+    for tag in tags:
+        delta = deltas.setdefault(tag, [0, 0])
+        delta[1] += sign
+        if public:
+            delta[0] += sign
+
+
+# Keep the usage counters of tags up to date; the persistent tags are updated after the flush
+# with a single statement adding the deltas, so that concurrent transactions don't overwrite each
+# other's changes.
+@event.listens_for(db.Session, "before_flush")
+def update_tag_counters(session, ctx, instances):
+    deltas = {}
+
+    for old_tags, was_public, new_tags, is_public in _bookmark_tag_changes(session):
+        _count_tags(deltas, old_tags, was_public, -1)
+        _count_tags(deltas, new_tags, is_public, 1)
+
+    pending = session.info.setdefault("tag_counters", {})
+    for tag, (public, total) in deltas.items():
+        if tag in session.deleted or (public == 0 and total == 0):
+            continue
+        if tag.id is None:
+            tag.public_count = (tag.public_count or 0) + public
+            tag.total_count = (tag.total_count or 0) + total
+        else:
+            delta = pending.setdefault(tag, [0, 0])
+            delta[0] += public
+            delta[1] += total
+
+
+# The loaded counters are expired once the flush is complete, to be read again from the database.
+@event.listens_for(db.Session, "after_flush_postexec")
+def apply_tag_counters(session, ctx):
+    deltas = session.info.pop("tag_counters", None)
+    if not deltas:
+        return
+
+    _add_tag_counters(session, {tag.id: delta for tag, delta in deltas.items()})
+    for tag in deltas:
+        if tag in session:
+            session.expire(tag, ["public_count", "total_count"])
+
+
+def _add_tag_counters(session, deltas):
+    """Adds the deltas `deltas`, a dict {tag id: [public, total]}, to the
+    usage counters of the tags"""
+
+    # rows are updated in key order, the same in every transaction, to avoid deadlocks
+    rows = sorted(
+        (
+            {"counted_id": tag_id, "public_delta": public, "total_delta": total}
+            for tag_id, (public, total) in deltas.items()
+            if public != 0 or total != 0
+        ),
+        key=lambda row: row["counted_id"],
+    )
+    if not rows:
+        return
+
+    session.execute(
+        Tag.__table__.update()
+        .where(Tag.id == bindparam("counted_id"))
+        .values(
+            public_count=Tag.public_count + bindparam("public_delta"),
+            total_count=Tag.total_count + bindparam("total_delta"),
+        ),
+        rows,
+    )
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_tag_counters(session, previous_transaction):
+    session.info.pop("tag_counters", None)
+
+
+def _count_tag_pairs(deltas, tags, sign):
+    for tag_a, tag_b in itertools.permutations(tags, 2):
+        deltas[(tag_a, tag_b)] = deltas.get((tag_a, tag_b), 0) + sign
+
+
+# Keep the `tag_pairs` co-occurrence table up to date: the changes are collected before the
+# flush, when new tags don't have an id yet, and applied with SQL expressions after it.
+@event.listens_for(db.Session, "before_flush")
+def track_tag_pairs(session, ctx, instances):
+    deltas = session.info.setdefault("tag_pairs", {})
+
+    for old_tags, was_public, new_tags, is_public in _bookmark_tag_changes(session):
+        if was_public:
+            _count_tag_pairs(deltas, old_tags, -1)
+        if is_public:
+            _count_tag_pairs(deltas, new_tags, 1)
+
+
+@event.listens_for(db.Session, "after_flush")
+def update_tag_pairs(session, ctx):
+    deltas = session.info.pop("tag_pairs", None)
+    if not deltas:
+        return
+
+    _add_tag_pairs(
+        session,
+        {
+            (tag_a.id, tag_b.id): delta
+            for (tag_a, tag_b), delta in deltas.items()
+            if tag_a.id is not None and tag_b.id is not None
+        },
+    )
+
+
+def _add_tag_pairs(session, deltas):
+    """Adds the deltas `deltas`, a dict {(tag id, tag id): delta}, to the
+    `tag_pairs` table, deleting the pairs dropping to zero"""
+
+    # in key order, like the tag counters
+    rows = sorted(
+        (
+            {"pair_a": tag_a, "pair_b": tag_b, "delta": delta}
+            for (tag_a, tag_b), delta in deltas.items()
+            if delta != 0
+        ),
+        key=lambda row: (row["pair_a"], row["pair_b"]),
+    )
+    if not rows:
+        return
+
+    created = [
+        {"tag_a": row["pair_a"], "tag_b": row["pair_b"], "public_count": 0}
+        for row in rows
+        if row["delta"] > 0
+    ]
+    if created:
+        session.execute(db.insert_ignore(tag_pairs, session.get_bind()), created)
+
+    session.execute(
+        tag_pairs.update()
+        .where(tag_pairs.c.tag_a == bindparam("pair_a"))
+        .where(tag_pairs.c.tag_b == bindparam("pair_b"))
+        .values(public_count=tag_pairs.c.public_count + bindparam("delta")),
+        rows,
+    )
+
+    touched = sorted(set(row["pair_a"] for row in rows))
+    for chunk in utils.chunks(touched, 500):
+        session.execute(
+            tag_pairs.delete()
+            .where(tag_pairs.c.tag_a.in_(chunk))
+            .where(tag_pairs.c.public_count <= 0)
+        )
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_tag_pairs(session, previous_transaction):
+    session.info.pop("tag_pairs", None)
+
+
+def _count_link_tags(deltas, link, tags, sign):
+    if link is None:
+        return
+    for tag in tags:
+        deltas[(link, tag)] = deltas.get((link, tag), 0) + sign
+
+
+# Keep the `link_tags` table up to date, the same way as `tag_pairs`.
+@event.listens_for(db.Session, "before_flush")
+def track_link_tags(session, ctx, instances):
+    deltas = session.info.setdefault("link_tags", {})
+
+    for old_link, old_tags, was_public, new_link, new_tags, is_public in _bookmark_changes(session):
+        if was_public:
+            _count_link_tags(deltas, old_link, old_tags, -1)
+        if is_public:
+            _count_link_tags(deltas, new_link, new_tags, 1)
+
+
+@event.listens_for(db.Session, "after_flush")
+def update_link_tags(session, ctx):
+    deltas = session.info.pop("link_tags", None)
+    if not deltas:
+        return
+
+    _add_link_tags(
+        session,
+        {
+            (link.id, tag.id): delta
+            for (link, tag), delta in deltas.items()
+            if link.id is not None and tag.id is not None
+        },
+    )
+
+
+def _add_link_tags(session, deltas):
+    """Adds the deltas `deltas`, a dict {(link id, tag id): delta}, to the
+    `link_tags` table, deleting the rows dropping to zero"""
+
+    # in key order, like the tag counters
+    rows = sorted(
+        (
+            {"row_link": link_id, "row_tag": tag_id, "delta": delta}
+            for (link_id, tag_id), delta in deltas.items()
+            if delta != 0
+        ),
+        key=lambda row: (row["row_link"], row["row_tag"]),
+    )
+    if not rows:
+        return
+
+    created = [
+        {"link_id": row["row_link"], "tag_id": row["row_tag"], "public_count": 0}
+        for row in rows
+        if row["delta"] > 0
+    ]
+    if created:
+        session.execute(db.insert_ignore(link_tags, session.get_bind()), created)
+
+    session.execute(
+        link_tags.update()
+        .where(link_tags.c.link_id == bindparam("row_link"))
+        .where(link_tags.c.tag_id == bindparam("row_tag"))
+        .values(public_count=link_tags.c.public_count + bindparam("delta")),
+        rows,
+    )
+
+    touched = sorted(set(row["row_link"] for row in rows))
+    for chunk in utils.chunks(touched, 500):
+        session.execute(
+            link_tags.delete()
+            .where(link_tags.c.link_id.in_(chunk))
+            .where(link_tags.c.public_count <= 0)
+        )
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_link_tags(session, previous_transaction):
+    session.info.pop("link_tags", None)
+
+
+# Changing only the tags of a bookmark doesn't update its row: touch `modified_on` anyway, so
+# that the change is seen by the delta sync API and by the incremental reindexing. The bookmarks
+# stamped automatically are stamped again on commit, see `stamp_changes()`.
+@event.listens_for(db.Session, "before_flush")
+def touch_retagged_bookmarks(session, ctx, instances):
+    stamped = session.info.setdefault("stamped_bookmarks", [])
+    for obj in session.new:
+        if isinstance(obj, Bookmark) and not attributes.get_history(obj, "modified_on").added:
+            stamped.append(obj)
+
+    for obj in session.dirty:
+        if not isinstance(obj, Bookmark) or attributes.get_history(obj, "modified_on").added:
+            continue
+        tags = attributes.get_history(obj, "tags", attributes.PASSIVE_NO_INITIALIZE)
+        if tags.has_changes():
+            obj.modified_on = datetime.utcnow()
+            stamped.append(obj)
+        elif session.is_modified(obj, include_collections=False):
+            stamped.append(obj)
+
+
+# Deleted bookmarks leave a tombstone behind, for the clients of the delta sync API
+@event.listens_for(db.Session, "after_flush")
+def record_tombstones(session, ctx):
+    deleted_on = datetime.utcnow()
+    rows = [
+        {"bookmark_id": obj.id, "user_id": obj.user_id, "deleted_on": deleted_on}
+        for obj in session.deleted
+        if isinstance(obj, Bookmark) and obj.user_id is not None
+    ]
+    if rows:
+        session.execute(Tombstone.__table__.insert(), rows)
+        session.info.setdefault("tombstones", []).extend(
+            (deleted_on, row["bookmark_id"]) for row in rows
+        )
+
+
+# The delta sync API reads the changes in the order of `modified_on` and of the tombstones
+# `deleted_on`, which are stamped at flush time: a transaction taking longer than
+# SYNC_SETTLE_SECONDS between its flushes and its commit would be missed by the clients that
+# polled in the meantime. The stamps are taken again right before the commit, leaving only the
+# time the COMMIT itself takes (and the clock skew among the application servers).
+@event.listens_for(db.Session, "before_commit")
+def stamp_changes(session):
+    if session.transaction.nested:
+        return
+    session.flush()
+
+    ids = set(session.info.get("retagged_bookmarks", ()))
+    for obj in session.info.pop("stamped_bookmarks", ()):
+        identity = attributes.instance_state(obj).identity
+        if identity is not None:
+            ids.add(identity[0])
+    tombstones = session.info.pop("tombstones", [])
+    if not ids and not tombstones:
+        return
+
+    now = datetime.utcnow()
+    bookmarks = Bookmark.__table__
+    for chunk in utils.chunks(sorted(ids), 500):
+        session.execute(
+            bookmarks.update().where(bookmarks.c.id.in_(chunk)).values(modified_on=now)
+        )
+    if tombstones:
+        # the ids of the deleted bookmarks could have been used before
+        table = Tombstone.__table__
+        since = min(deleted_on for deleted_on, _ in tombstones)
+        deleted = sorted(set(bookmark_id for _, bookmark_id in tombstones))
+        for chunk in utils.chunks(deleted, 500):
+            session.execute(
+                table.update()
+                .where(table.c.bookmark_id.in_(chunk))
+                .where(table.c.deleted_on >= since)
+                .values(deleted_on=now)
+            )
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_stamped_changes(session, previous_transaction):
+    session.info.pop("stamped_bookmarks", None)
+    session.info.pop("tombstones", None)
+
+
+# Pagination totals are cached: flag the sessions writing bookmarks (or users,
+# which own the list of followed users), bump the shared generation of the cached
+# totals before they commit, when it's enabled, and clear the cache of this process
+# once they do.
+@event.listens_for(db.Session, "after_flush")
+def track_counted_changes(session, ctx):
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, (Bookmark, User)):
+            session.info["invalidate_counts"] = True
+            break
+
+
+def count_generation():
+    """Returns the shared generation of the cached pagination totals"""
+
+    query = select([count_generations.c.generation]).where(count_generations.c.id == 1)
+    return db.Session.execute(query).scalar() or 0
+
+
+# Registered after `stamp_changes()`, which flushes the session.
+@event.listens_for(db.Session, "before_commit")
+def bump_count_generation(session):
+    if session.transaction.nested or not session.info.get("invalidate_counts"):
+        return
+    # the other processes rely on the TTL of their cached totals
+    if db.count_cache.generation is None:
+        return
+
+    # the row stays locked until the commit: it's updated at the very end of the transaction
+    table = count_generations
+    update = table.update().where(table.c.id == 1).values(generation=table.c.generation + 1)
+    if not session.execute(update).rowcount:
+        # the first bump creates the row, unless a concurrent transaction just did
+        insert = db.insert_ignore(table, session.get_bind())
+        if not session.execute(insert, {"id": 1, "generation": 1}).rowcount:
+            session.execute(update)
+
+
+@event.listens_for(db.Session, "after_commit")
+def invalidate_count_cache(session):
+    if session.info.pop("invalidate_counts", False):
+        db.count_cache.clear()
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_counted_changes(session, previous_transaction):
+    session.info.pop("invalidate_counts", None)
+
+
+# The bookmarks retagged with plain SQL by `retag_bookmarks()` are refreshed by the search
+# backends and the tag postings on commit, and forgotten when the transaction ends.
+@event.listens_for(db.Session, "after_transaction_end")
+def forget_retagged_bookmarks(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("retagged_bookmarks", None)
+        session.info.pop("retags", None)
 
 
 # Many-to-many mapping between Bookmarks and Tags
@@ -39,6 +507,44 @@ bookmark_tags = Table(
     ),
     Column("tag_id", Integer, ForeignKey("tags.id", ondelete="cascade"), primary_key=True),
 )
+Index("ix_bookmark_tags_tag_id", bookmark_tags.c.tag_id, bookmark_tags.c.bookmark_id)
+
+# Tag co-occurrences: the number of public bookmarks tagged with both `tag_a` and `tag_b`, stored
+# in both directions and maintained by `update_tag_pairs()`.
+tag_pairs = Table(
+    "tag_pairs",
+    db.Base.metadata,
+    Column("tag_a", Integer, ForeignKey("tags.id", ondelete="cascade"), primary_key=True),
+    Column("tag_b", Integer, ForeignKey("tags.id", ondelete="cascade"), primary_key=True),
+    Column("public_count", Integer, nullable=False, default=0),
+)
+Index("ix_tag_pairs_tag_a_public_count", tag_pairs.c.tag_a, tag_pairs.c.public_count)
+
+# The number of public bookmarks of each link tagged with each tag, maintained by
+# `update_link_tags()` and used to suggest tags for a URL.
+link_tags = Table(
+    "link_tags",
+    db.Base.metadata,
+    Column("link_id", Integer, ForeignKey("links.id", ondelete="cascade"), primary_key=True),
+    Column("tag_id", Integer, ForeignKey("tags.id", ondelete="cascade"), primary_key=True),
+    Column("public_count", Integer, nullable=False, default=0),
+)
+Index("ix_link_tags_link_id_public_count", link_tags.c.link_id, link_tags.c.public_count)
+
+# A single row with the generation of the cached pagination totals, bumped by every transaction
+# writing bookmarks or users so that all the processes stop using their cached totals.
+count_generations = Table(
+    "count_generations",
+    db.Base.metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("generation", Integer, nullable=False, default=0),
+)
+
+RelatedTag = namedtuple("RelatedTag", "id name tot")
+
+# What is known about a URL when posting it: the id of the bookmark of the current user linking
+# it, or None, and a list of (tag name, count) tuples for the tags most used by public bookmarks
+LinkHints = namedtuple("LinkHints", "bookmark_id tags")
 
 
 # Tag names must be validated by this regex
@@ -51,6 +557,9 @@ TAG_MAX = 35
 # Validation for length of the notes field
 NOTES_MAX = 2500
 
+# Validation for length of the URLs
+URL_MAX = 2000
+
 
 class Tag(db.Base):
     """This seemingly harmless class describes the `Tag` model that is the
@@ -79,13 +588,18 @@ class Tag(db.Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(TAG_MAX), nullable=False, index=True, unique=True)
 
+    # Denormalized usage counters, maintained by `update_tag_counters()`: the number of public
+    # bookmarks and the number of bookmarks tagged with this tag.
+    public_count = Column(Integer, nullable=False, default=0, server_default="0", index=True)
+    total_count = Column(Integer, nullable=False, default=0, server_default="0")
+
     def __init__(self, name):
         """Create a new Tag, enforcing a lowercase name"""
         self.name = name.lower()
 
     @classmethod
     def get_or_create(cls, name):
-        return super().get_or_create(name=name)
+        return cls.get_or_create_many([name])[0]
 
     @classmethod
     def search(cls, term):
@@ -96,36 +610,127 @@ class Tag(db.Base):
     def get_related(cls, tags: List[str], max_results=10, user=None):
         """
         Returns a list of tuples (Tag.id, Tag.name, count) for each Tag related
-        to `tags`, which is a list of tag names.
+        to `tags`, which is a list of tag names, ordered by count, popularity
+        and name.
+
+        The related tags of a single tag are read from the `tag_pairs` table;
+        for many tags the bookmarks having all of them are found starting
+        from the rarest one.
+        """
+        assert isinstance(tags, list), "The 'tags' parameter must be a list"
+
+        found = list(Tag.get_many([tag.lower() for tag in tags]))
+        if not found:
+            return []
+
+        if len(found) == 1:
+            counts = cls._related_pair_counts(found[0].id, max_results, user)
+        else:
+            found.sort(key=lambda tag: tag.total_count)
+            counts = cls._related_counts([tag.id for tag in found], user)
+
+        return cls._rank_related(counts, max_results)
+
+    @classmethod
+    def _related_pair_counts(cls, tag_id, max_results, user=None):
+        """Returns a dict mapping the ids of the tags related to `tag_id` to
+        the number of bookmarks visible to `user` they share with it, for
+        at least the top `max_results` tags."""
+
+        # the private bookmarks of `user` are not in `tag_pairs`
+        private = {}
+        if user is not None:
+            private = cls._related_counts([tag_id], user, private_only=True)
+
+        query = (
+            select([tag_pairs.c.tag_b, tag_pairs.c.public_count])
+            .where(tag_pairs.c.tag_a == tag_id)
+            .where(tag_pairs.c.public_count > 0)
+            .order_by(tag_pairs.c.public_count.desc())
+        )
+        # the tags sharing the same count with the last one are all needed to rank them
+        limit = max_results + len(private)
+        rows = db.Session.execute(query.limit(limit)).fetchall()
+        if len(rows) == limit:
+            rows = db.Session.execute(
+                query.where(tag_pairs.c.public_count >= rows[-1].public_count)
+            ).fetchall()
+
+        counts = dict(rows)
+        for chunk in utils.chunks(sorted(set(private) - set(counts)), 500):
+            query = select([tag_pairs.c.tag_b, tag_pairs.c.public_count]).where(
+                and_(tag_pairs.c.tag_a == tag_id, tag_pairs.c.tag_b.in_(chunk))
+            )
+            counts.update(db.Session.execute(query).fetchall())
+        for related_id, count in private.items():
+            counts[related_id] = counts.get(related_id, 0) + count
+
+        return counts
+
+    @classmethod
+    def _related_counts(cls, tags_ids, user=None, private_only=False):
+        """Returns a dict mapping the ids of the tags related to `tags_ids` to
+        the number of bookmarks visible to `user` tagged with all of them.
+
+        The bookmarks of the first tag, which should be the rarest one, are
+        intersected with the other tags through primary key lookups.
+        """
+
+        if private_only:
+            visible = and_(Bookmark.private == true(), Bookmark.user_id == user.id)
+        else:
+            visible = _visible_bookmarks(user)
+
+        first = bookmark_tags.alias("first")
+        joined = first.join(Bookmark.__table__, Bookmark.id == first.c.bookmark_id)
+        for i, tag_id in enumerate(tags_ids[1:]):
+            other = bookmark_tags.alias("other%d" % i)
+            joined = joined.join(
+                other, and_(other.c.bookmark_id == first.c.bookmark_id, other.c.tag_id == tag_id)
+            )
+        joined = joined.join(bookmark_tags, bookmark_tags.c.bookmark_id == first.c.bookmark_id)
+
+        query = (
+            select([bookmark_tags.c.tag_id, func.count()])
+            .select_from(joined)
+            .where(first.c.tag_id == tags_ids[0])
+            .where(visible)
+            .where(not_(bookmark_tags.c.tag_id.in_(tags_ids)))
+            .group_by(bookmark_tags.c.tag_id)
+        )
+        return dict(db.Session.execute(query).fetchall())
+
+    @classmethod
+    def _rank_related(cls, counts, max_results):
+        """Returns the top `max_results` related tags from a dict mapping tag
+        ids to their counts."""
+
+        tags = []
+        for chunk in utils.chunks(sorted(counts), 500):
+            query = db.Session.query(cls.id, cls.name, cls.public_count).filter(cls.id.in_(chunk))
+            tags.extend(query)
+
+        tags.sort(key=lambda tag: (-counts[tag.id], -tag.public_count, tag.name))
+        return [RelatedTag(tag.id, tag.name, counts[tag.id]) for tag in tags[:max_results]]
+
+    @classmethod
+    def _get_related_sql(cls, tags_ids, max_results=10, user=None):
+        """Computes the related tags with a single SQL query; the results
+        are the same of `get_related()`.
 
         The generated SQL query used to hang MySQL 5.5.46-0+deb7u1.
 
         SQL query as explained here:
         http://stackoverflow.com/questions/4483357/join-instead-of-subquery-for-related-tags
         """
-        assert isinstance(tags, list), "The 'tags' parameter must be a list"
-
-        # enforce lowercase
-        tags = [tag.lower() for tag in tags]
-        # get the IDs for 'tags'
-        tags_ids = [tag.id for tag in Tag.get_many(tags)]
 
         # build the subquery first: the subquery fetch all the bookmark ids of Bookmarks having
         # (all?)  `tags` among their tags.
-        subq = db.Session.query(bookmark_tags.c.bookmark_id).join(
-            Bookmark, Bookmark.id == bookmark_tags.c.bookmark_id
+        subq = (
+            db.Session.query(bookmark_tags.c.bookmark_id)
+            .join(Bookmark, Bookmark.id == bookmark_tags.c.bookmark_id)
+            .filter(_visible_bookmarks(user))
         )
-        if user is None:
-            # Exclude private Bookmarks
-            subq = subq.filter(Bookmark.private == false())
-        else:
-            # Exclude private Bookmarks but include user's bookmarks
-            subq = subq.filter(
-                or_(
-                    Bookmark.private == false(),
-                    and_(Bookmark.private == true(), Bookmark.user_id == user.id),
-                )
-            )
 
         subq = (
             # Only include Bookmarks which tags matches our `tags`
@@ -144,26 +749,63 @@ class Tag(db.Base):
             .join(subq, subq.c.bookmark_id == bookmark_tags.c.bookmark_id)
             .filter(not_(cls.id.in_(tags_ids)))
             .group_by(cls.id)
-            .order_by(desc("tot"))
+            .order_by(desc("tot"), cls.public_count.desc(), cls.name)
             .limit(max_results)
         )
 
-        return q.all()
+        return [RelatedTag(*row) for row in q]
 
     @classmethod
     def get_or_create_many(cls, names):
         """
-        Returns a list of Tag objects matching `names` and create Tags
-        that can't be found.
-        """
-        results = []
-        names = set([n.lower() for n in names])
+        Returns a list of Tag objects matching `names`, lowercased and
+        without duplicates, creating the Tags that can't be found.
+
+        The existing tags are fetched with one query and the missing ones
+        are inserted with one statement ignoring the names inserted in the
+        meantime by concurrent transactions, then read back with a locking
+        read, which also sees the rows committed after our first read.
 
+        Raises `ValueError` for names longer than `TAG_MAX`, which would be
+        silently truncated by MySQL.
+        """
+        names = list(dict.fromkeys(name.lower() for name in names))
         for name in names:
-            tag = cls.get_or_create(name)
-            results.append(tag)
+            if len(name) > TAG_MAX:
+                raise ValueError("Tag name longer than {} characters".format(TAG_MAX))
+
+        tags = {}
+
+        def fetch(keys, lock=False):
+            for chunk in utils.chunks(keys, 500):
+                query = cls.query.filter(cls.name.in_(chunk))
+                if lock:
+                    query = query.with_for_update()
+                tags.update((tag.name, tag) for tag in query)
+
+        fetch(names)
+        missing = [name for name in names if name not in tags]
+        if missing:
+            session = db.Session()
+            bind = session.get_bind()
+            rows = [{"name": name, "public_count": 0, "total_count": 0} for name in missing]
+            if bind.dialect.name == "postgresql":
+                # only the inserted rows are returned
+                stmt = db.insert_ignore(cls.__table__, bind).values(rows).returning(cls.name)
+                inserted = {row.name for row in session.execute(stmt)}
+            else:
+                result = session.execute(db.insert_ignore(cls.__table__, bind), rows)
+                # when a concurrent transaction inserted only some of the names we can't tell
+                # which ones: the autocompletion index keeps the counts of the names it knows
+                inserted = set(missing) if result.rowcount else set()
+            fetch(missing, lock=True)
+            # the new tags weren't flushed by the session: keep track of them for the tag
+            # autocompletion index and the postings, updated when the session commits
+            session.info.setdefault("created_tags", []).extend(
+                (tags[name].id, name) for name in missing if name in inserted
+            )
 
-        return results
+        return [tags[name] for name in names]
 
     @classmethod
     def get_many(cls, names, match_case=False):
@@ -238,12 +880,9 @@ class Tag(db.Base):
         """
 
         q = (
-            db.Session.query(cls, func.count(bookmark_tags.c.bookmark_id).label("tot"))
-            .join(bookmark_tags)
-            .join(Bookmark)
-            .filter(Bookmark.private == false())
-            .group_by(cls)
-            .order_by(desc("tot"))
+            db.Session.query(cls, cls.public_count)
+            .filter(cls.public_count > 0)
+            .order_by(cls.public_count.desc())
             .limit(max_results)
         )
 
@@ -253,18 +892,112 @@ class Tag(db.Base):
         return "<Tag(%r)>" % self.name
 
 
+_default_ports = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """Normalizes the parts of a URL that don't change the resource it
+    points to: surrounding spaces, the case of scheme and host name, a
+    default port and an empty path."""
+
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    if not parts.netloc:
+        return url
+
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if ":" in netloc:
+        netloc = "[%s]" % netloc
+    if parts.username is not None:
+        userinfo = parts.netloc.rpartition("@")[0]
+        netloc = "%s@%s" % (userinfo, netloc)
+    if port is not None and port != _default_ports.get(scheme):
+        netloc = "%s:%d" % (netloc, port)
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+def url_hash(url):
+    """Returns the hash of the normalized `url` used to look up links"""
+
+    return hashlib.sha1(normalize_url(url).encode("utf-8")).hexdigest()
+
+
 class Link(db.Base):
     __tablename__ = "links"
 
     id = Column(Integer, primary_key=True)
-    href = Column(String(2000), nullable=False)
+    href = Column(String(URL_MAX), nullable=False)
+    # the lookup key of links; NULL only for links created before the column was added, until
+    # `backfill_link_hashes()` fills it in
+    href_hash = Column(String(40), index=True, unique=True)
 
     def __init__(self, href):
         self.href = href
 
+    @validates("href")
+    def _set_href_hash(self, key, href):
+        self.href_hash = url_hash(href)
+        return href
+
     @classmethod
     def get_or_create(cls, href):
-        return super().get_or_create(href=href)
+        """Returns the link to `href`, or to the same normalized URL,
+        creating it if needed.
+
+        The link is inserted right away ignoring conflicts and then read
+        back, so that concurrent transactions posting the same URL end up
+        with the same row.
+        """
+
+        return cls.get_or_create_many([href])[0]
+
+    @classmethod
+    def get_or_create_many(cls, hrefs):
+        """Returns a list with the link to each URL of `hrefs`, like
+        `get_or_create()`, with a query for the existing links and one
+        statement inserting the missing ones.
+
+        The inserted links are read back with a locking read: under
+        REPEATABLE READ a plain query would not see the links committed by
+        concurrent transactions after our first read, whose insert was
+        ignored.
+
+        Raises `ValueError` for URLs longer than `URL_MAX`, which would be
+        silently truncated by MySQL.
+        """
+
+        for href in hrefs:
+            if len(href) > URL_MAX:
+                raise ValueError("URL longer than {} characters".format(URL_MAX))
+
+        hashes = [url_hash(href) for href in hrefs]
+        links = {}
+
+        def fetch(keys, lock=False):
+            for chunk in utils.chunks(keys, 500):
+                query = cls.query.filter(cls.href_hash.in_(chunk))
+                if lock:
+                    query = query.with_for_update()
+                links.update((link.href_hash, link) for link in query)
+
+        fetch(list(set(hashes)))
+        missing = {}
+        for href, href_hash in zip(hrefs, hashes):
+            if href_hash not in links:
+                missing.setdefault(href_hash, href)
+        if missing:
+            db.Session.execute(
+                db.insert_ignore(cls.__table__),
+                [{"href": href, "href_hash": href_hash} for href_hash, href in missing.items()],
+            )
+            fetch(list(missing), lock=True)
+
+        return [links[href_hash] for href_hash in hashes]
 
     def __repr__(self):
         return "<Link(href={})>".format(self.href)
@@ -285,10 +1018,12 @@ class Bookmark(db.Base):
     id = Column(Integer, primary_key=True)
     title = Column(String(300), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), index=True)
-    link = relationship("Link", lazy="joined", backref=backref("bookmarks"))
+    # the previous link is needed to keep the per-link tag counts up to date
+    link = relationship("Link", lazy="joined", backref=backref("bookmarks"), active_history=True)
     link_id = Column(Integer, ForeignKey("links.id"))
     href = association_proxy("link", "href")
-    private = Column(Boolean, default=False)
+    # the previous value is needed to keep the tag usage counters up to date
+    private = column_property(Column(Boolean, default=False), active_history=True)
 
     created_on = Column(DateTime, default=datetime.utcnow)
     modified_on = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -299,7 +1034,9 @@ class Bookmark(db.Base):
         secondary=bookmark_tags,
         backref=backref("bookmarks", lazy="dynamic"),
         order_by="Tag.name",
-        lazy="subquery",
+        # a second query keyed by the primary keys of the loaded bookmarks; "subquery" loading
+        # would run the whole original query again (e.g. the GROUP BY of `by_tags`)
+        lazy="selectin",
     )
     notes = Column(String(NOTES_MAX))
 
@@ -312,6 +1049,12 @@ class Bookmark(db.Base):
             self.modified_on = modified_on
         self.notes = notes or ""
 
+    @classmethod
+    def sort_keys(cls):
+        """Returns the columns defining the (descending) order of bookmark
+        listings; used as keys for keyset pagination."""
+        return (cls.created_on, cls.id)
+
     @classmethod
     def get_public(cls):
         """Return a query for the list of latest public Bookmarks, including
@@ -326,7 +1069,7 @@ class Bookmark(db.Base):
 
     @classmethod
     def get_latest(cls):
-        query = cls.get_public().order_by(cls.created_on.desc())
+        query = cls.get_public().order_by(cls.created_on.desc(), cls.id.desc())
         return query
 
     @classmethod
@@ -334,7 +1077,7 @@ class Bookmark(db.Base):
         where = cls.user_id == userid
         if not include_private:
             where = where & (cls.private == false())
-        return cls.query.filter(where).order_by(cls.created_on.desc())
+        return cls.query.filter(where).order_by(cls.created_on.desc(), cls.id.desc())
 
     @classmethod
     def by_followed(cls):
@@ -346,7 +1089,7 @@ class Bookmark(db.Base):
             .outerjoin(watched_users, User.id == watched_users.c.other_user_id)
             .filter(watched_users.c.user_id == current_user.id)
             .filter(cls.private == false())
-            .order_by(cls.created_on.desc())
+            .order_by(cls.created_on.desc(), cls.id.desc())
         )
 
     @classmethod
@@ -359,7 +1102,7 @@ class Bookmark(db.Base):
             .filter(Tag.name.in_(tags))
             .group_by(cls.id)
             .having(func.count(cls.id) == len(tags))
-            .order_by(cls.created_on.desc())
+            .order_by(cls.created_on.desc(), cls.id.desc())
         )
 
     @classmethod
@@ -393,7 +1136,7 @@ class Bookmark(db.Base):
                 .filter(Tag.name.in_(tags))
                 .group_by(cls.id)
                 .having(func.count(cls.id) == len(tags))
-                .order_by(cls.created_on.desc())
+                .order_by(cls.created_on.desc(), cls.id.desc())
             )
 
             if user_id is not None:
@@ -422,7 +1165,7 @@ class Bookmark(db.Base):
             .outerjoin(exclude_query, cls.id == exclude_query.c.bookmark_id)
             .join(include_query, cls.id == include_query.c.bookmark_id)
             .filter(exclude_query.c.bookmark_id == None)  # noqa
-            .order_by(cls.created_on.desc())
+            .order_by(cls.created_on.desc(), cls.id.desc())
         )
 
         if user_id is not None:
@@ -430,21 +1173,29 @@ class Bookmark(db.Base):
 
         return query
 
-    # TODO: wat?
     @classmethod
-    def by_ids(cls, ids):
-        """Returns a list of Bookmarks matching the IDs in `ids`;
-        in MySQL the returned list is ordered the same as `ids`.
+    def by_ids(cls, ids, user=None):
+        """Returns a query for the Bookmarks matching the IDs in `ids`,
+        ordered the same as `ids` (e.g. by search engine rank), including
+        only the bookmarks visible by `user`.
+
+        Visibility is checked again even when `ids` come from the search
+        engine, whose index is updated asynchronously.
         """
-        # Keep the order from Whoosh with a MySQL specific hack:
-        # order_by FIELD() function.
-        # http://dev.mysql.com/doc/refman/5.0/en/string-functions.html#function_field
-        engine = db.Session.get_bind()
-        if engine.driver.startswith("mysql"):
-            query = cls.get_public().filter(cls.id.in_(ids)).order_by(func.field(cls.id, *ids))
-        else:
-            query = cls.get_public().filter(cls.id.in_(ids)).order_by(cls.created_on.desc())
-        return query
+        if not ids:
+            return cls.query.filter(false())
+
+        # a CASE expression mapping each id to its position works on every database
+        rank = case({bookmark_id: i for i, bookmark_id in enumerate(ids)}, value=cls.id)
+        query = cls.query.filter(cls.id.in_(ids)).filter(cls.visible_to(user))
+        return query.order_by(rank)
+
+    @classmethod
+    def visible_to(cls, user=None):
+        """Returns the filter for the bookmarks visible by `user`, or by the
+        anonymous users when `user` is None"""
+
+        return _visible_bookmarks(user)
 
     @classmethod
     def submit_by_day(cls, days=30):
@@ -487,24 +1238,472 @@ class Bookmark(db.Base):
         )
 
 
+Index("ix_bookmarks_link_id_user_id", Bookmark.link_id, Bookmark.user_id)
+# the changes of the bookmarks of a user, in the order read by the delta sync API
+Index("ix_bookmarks_user_id_modified_on", Bookmark.user_id, Bookmark.modified_on, Bookmark.id)
+
+
+class Tombstone(db.Base):
+    """The record of a deleted bookmark, kept for the clients of the delta
+    sync API until `prune_tombstones()` removes it."""
+
+    __tablename__ = "bookmark_tombstones"
+
+    id = Column(Integer, primary_key=True)
+    bookmark_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    deleted_on = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<Tombstone(bookmark_id={})>".format(self.bookmark_id)
+
+
+Index(
+    "ix_bookmark_tombstones_user_id_deleted_on",
+    Tombstone.user_id,
+    Tombstone.deleted_on,
+    Tombstone.bookmark_id,
+)
+
+
+def _visible_bookmarks(user=None):
+    """Returns the filter for the bookmarks visible to `user`: the public
+    ones and, for a logged in user, its own private bookmarks."""
+
+    if user is None:
+        return Bookmark.private == false()
+    return or_(
+        Bookmark.private == false(), and_(Bookmark.private == true(), Bookmark.user_id == user.id)
+    )
+
+
 # TODO: rename me
 def get_stats():
     tot_bookmarks = (
         db.Session.query(func.count(Bookmark.id)).filter(Bookmark.private == false()).scalar()
     )
 
-    tot_tags = (
-        db.Session.query(Tag)
-        .join(bookmark_tags)
-        .join(Bookmark)
-        .filter(Bookmark.private == false())
-        .group_by(Tag.id)
-        .count()
-    )
+    tot_tags = db.Session.query(func.count(Tag.id)).filter(Tag.public_count > 0).scalar()
 
     return (tot_bookmarks, tot_tags)
 
 
+def sweep_tag_orphans(batch_size=1000):
+    """Deletes the tags not used by any bookmark, walking the tags table in
+    batches of `batch_size` ids and committing after each batch.
+
+    :returns: the number of deleted tags
+    """
+
+    last_id, deleted = 0, 0
+    while True:
+        query = db.Session.query(Tag.id).filter(Tag.id > last_id).order_by(Tag.id)
+        ids = [row.id for row in query.limit(batch_size)]
+        if not ids:
+            break
+        last_id = ids[-1]
+
+        deleted += (
+            db.Session.query(Tag)
+            .filter(Tag.id.in_(ids))
+            .filter(~Tag.bookmarks.any())
+            .delete(synchronize_session=False)
+        )
+        db.Session.commit()
+
+    return deleted
+
+
+def prune_tombstones(max_age):
+    """Deletes the tombstones of the bookmarks deleted more than `max_age`
+    (a timedelta) ago.
+
+    For each user a horizon tombstone, with bookmark id 0, keeps the time of
+    the newest tombstone deleted: the sync tokens older than that could miss
+    a deleted bookmark (see `qstode.model.sync.pruned_until()`).
+
+    :returns: the number of deleted tombstones
+    """
+
+    table = Tombstone.__table__
+    old = table.c.deleted_on < datetime.utcnow() - max_age
+    horizons = db.Session.execute(
+        select([table.c.user_id, func.max(table.c.deleted_on).label("deleted_on")])
+        .where(old)
+        .group_by(table.c.user_id)
+    ).fetchall()
+
+    result = db.Session.execute(table.delete().where(and_(old, table.c.bookmark_id != 0)))
+    db.Session.execute(table.delete().where(and_(old, table.c.bookmark_id == 0)))
+    if horizons:
+        db.Session.execute(
+            table.insert(),
+            [
+                {"bookmark_id": 0, "user_id": user_id, "deleted_on": deleted_on}
+                for user_id, deleted_on in horizons
+            ],
+        )
+    return result.rowcount
+
+
+def backfill_link_hashes(batch_size=1000):
+    """Fills in the lookup hash of the links created before it existed,
+    committing every `batch_size` links; can run while the application is
+    serving requests.
+
+    Links to the same normalized URL are merged into the first one, moving
+    their bookmarks to it.
+
+    :returns: a tuple (number of links updated, number of links merged)
+    """
+
+    links = Link.__table__
+    bookmarks = Bookmark.__table__
+    updated = merged = 0
+    last_id = 0
+    while True:
+        query = (
+            select([links.c.id, links.c.href])
+            .where(links.c.href_hash == None)  # noqa
+            .where(links.c.id > last_id)
+            .order_by(links.c.id)
+            .limit(batch_size)
+        )
+        rows = db.Session.execute(query).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        hashes = {row.id: url_hash(row.href) for row in rows}
+        query = select([links.c.href_hash, links.c.id]).where(
+            links.c.href_hash.in_(set(hashes.values()))
+        )
+        canonical = dict(db.Session.execute(query).fetchall())
+        for link_id, href_hash in hashes.items():
+            if href_hash not in canonical:
+                canonical[href_hash] = link_id
+                db.Session.execute(
+                    links.update().where(links.c.id == link_id).values(href_hash=href_hash)
+                )
+                updated += 1
+                continue
+
+            db.Session.execute(
+                bookmarks.update()
+                .where(bookmarks.c.link_id == link_id)
+                .values(link_id=canonical[href_hash], modified_on=bookmarks.c.modified_on)
+            )
+            db.Session.execute(links.delete().where(links.c.id == link_id))
+            merged += 1
+        db.Session.commit()
+
+    return updated, merged
+
+
+def _real_tag_counts():
+    """Returns the correlated subqueries computing the real values of the
+    tag usage counters"""
+
+    public = (
+        select([func.count()])
+        .select_from(bookmark_tags.join(Bookmark.__table__))
+        .where(bookmark_tags.c.tag_id == Tag.id)
+        .where(Bookmark.private == false())
+        .as_scalar()
+    )
+    total = select([func.count()]).where(bookmark_tags.c.tag_id == Tag.id).as_scalar()
+    return public, total
+
+
+def tag_counters_drift():
+    """Returns a list of tuples (tag name, public count, real public count,
+    total count, real total count) for each Tag whose usage counters are
+    wrong."""
+
+    public, total = _real_tag_counts()
+    query = (
+        db.Session.query(Tag.name, Tag.public_count, public, Tag.total_count, total)
+        .filter(or_(Tag.public_count != public, Tag.total_count != total))
+        .order_by(Tag.name)
+    )
+    return query.all()
+
+
+def rebuild_tag_counters():
+    """Recomputes the usage counters of every Tag from scratch.
+
+    :returns: the number of updated tags
+    """
+
+    public, total = _real_tag_counts()
+    stmt = Tag.__table__.update().values(public_count=public, total_count=total)
+    result = db.Session.execute(stmt)
+    return result.rowcount
+
+
+def _real_tag_pairs():
+    """Returns a query computing the real content of the `tag_pairs` table"""
+
+    pair = bookmark_tags.alias("pair")
+    return (
+        select([bookmark_tags.c.tag_id, pair.c.tag_id, func.count()])
+        .select_from(
+            bookmark_tags.join(Bookmark.__table__).join(
+                pair,
+                and_(
+                    pair.c.bookmark_id == bookmark_tags.c.bookmark_id,
+                    pair.c.tag_id != bookmark_tags.c.tag_id,
+                ),
+            )
+        )
+        .where(Bookmark.private == false())
+        .group_by(bookmark_tags.c.tag_id, pair.c.tag_id)
+    )
+
+
+def tag_pairs_drift():
+    """Returns the number of wrong, missing or stale rows in the `tag_pairs`
+    table."""
+
+    real = {(tag_a, tag_b): count for tag_a, tag_b, count in db.Session.execute(_real_tag_pairs())}
+    drift = 0
+    for tag_a, tag_b, count in db.Session.execute(select([tag_pairs])):
+        if real.pop((tag_a, tag_b), 0) != count:
+            drift += 1
+    return drift + len(real)
+
+
+def rebuild_tag_pairs():
+    """Recomputes the `tag_pairs` table from scratch.
+
+    :returns: the number of tag pairs
+    """
+
+    db.Session.execute(tag_pairs.delete())
+    stmt = tag_pairs.insert().from_select(["tag_a", "tag_b", "public_count"], _real_tag_pairs())
+    db.Session.execute(stmt)
+    return db.Session.execute(select([func.count()]).select_from(tag_pairs)).scalar()
+
+
+def _real_link_tags():
+    """Returns a query computing the real content of the `link_tags` table"""
+
+    return (
+        select([Bookmark.link_id, bookmark_tags.c.tag_id, func.count()])
+        .select_from(bookmark_tags.join(Bookmark.__table__))
+        .where(Bookmark.private == false())
+        .where(Bookmark.link_id != None)  # noqa
+        .group_by(Bookmark.link_id, bookmark_tags.c.tag_id)
+    )
+
+
+def link_tags_drift():
+    """Returns the number of wrong, missing or stale rows in the `link_tags`
+    table."""
+
+    rows = db.Session.execute(_real_link_tags())
+    real = {(link_id, tag_id): count for link_id, tag_id, count in rows}
+    drift = 0
+    for link_id, tag_id, count in db.Session.execute(select([link_tags])):
+        if real.pop((link_id, tag_id), 0) != count:
+            drift += 1
+    return drift + len(real)
+
+
+def rebuild_link_tags():
+    """Recomputes the `link_tags` table from scratch.
+
+    :returns: the number of rows
+    """
+
+    db.Session.execute(link_tags.delete())
+    stmt = link_tags.insert().from_select(["link_id", "tag_id", "public_count"], _real_link_tags())
+    db.Session.execute(stmt)
+    return db.Session.execute(select([func.count()]).select_from(link_tags)).scalar()
+
+
+def retag_bookmarks(old_name, new_name, user_id=None):
+    """Renames the tag `old_name` to `new_name` on the bookmarks of `user_id`,
+    or on every bookmark when `user_id` is None, merging it into `new_name`
+    if that tag already exists.
+
+    The tags are moved with a few statements on `bookmark_tags`, whatever the
+    number of bookmarks: the bookmarks already tagged with `new_name` just
+    lose `old_name`. The tag counters, the tag pairs and the per-link counts
+    are updated in the same transaction with the deltas of the moved
+    bookmarks; the changes are not committed.
+
+    Raises `ValueError` when `new_name` is not a valid tag name.
+
+    :returns: the list of the ids of the renamed bookmarks
+    """
+
+    old_name, new_name = old_name.lower(), new_name.lower()
+    if old_name == new_name:
+        raise ValueError("Cannot rename a tag to itself")
+    if not TAG_MIN <= len(new_name) <= TAG_MAX or not tag_name_re.match(new_name):
+        raise ValueError("Invalid tag name: {}".format(new_name))
+
+    session = db.Session()
+    old_tag = Tag.query.filter_by(name=old_name).first()
+    if old_tag is None:
+        return []
+
+    moved = bookmark_tags.c.tag_id == old_tag.id
+    if user_id is not None:
+        owned = select([Bookmark.id]).where(Bookmark.user_id == user_id)
+        moved = and_(moved, bookmark_tags.c.bookmark_id.in_(owned))
+
+    # the moved bookmarks with all their tags, to compute the changes of the counters
+    other = bookmark_tags.alias("other")
+    query = (
+        select(
+            [
+                Bookmark.created_on,
+                Bookmark.id,
+                Bookmark.private,
+                Bookmark.link_id,
+                other.c.tag_id,
+            ]
+        )
+        .select_from(
+            bookmark_tags.join(Bookmark.__table__).join(
+                other, other.c.bookmark_id == bookmark_tags.c.bookmark_id
+            )
+        )
+        .where(bookmark_tags.c.tag_id == old_tag.id)
+    )
+    if user_id is not None:
+        query = query.where(Bookmark.user_id == user_id)
+
+    created, tagged_with = {}, {}
+    for created_on, bookmark_id, private, link_id, tag_id in session.execute(query):
+        created[bookmark_id] = created_on
+        tagged_with.setdefault((bookmark_id, not private, link_id), set()).add(tag_id)
+    if not created:
+        return []
+    rows = [(created_on, bookmark_id) for bookmark_id, created_on in created.items()]
+    ids = list(created)
+
+    new_tag = Tag.get_or_create(new_name)
+    touched = Bookmark.__table__.update().where(
+        Bookmark.id.in_(
+            select([bookmark_tags.c.bookmark_id]).where(bookmark_tags.c.tag_id == old_tag.id)
+        )
+    )
+    if user_id is not None:
+        # not through `moved`: MySQL can't update a table selected in a subquery
+        touched = touched.where(Bookmark.user_id == user_id)
+    session.execute(touched.values(modified_on=datetime.utcnow()))
+    tagged = bookmark_tags.alias("tagged")
+    session.execute(
+        bookmark_tags.insert().from_select(
+            ["bookmark_id", "tag_id"],
+            select([bookmark_tags.c.bookmark_id, literal(new_tag.id)])
+            .where(moved)
+            .where(
+                ~exists().where(
+                    and_(
+                        tagged.c.bookmark_id == bookmark_tags.c.bookmark_id,
+                        tagged.c.tag_id == new_tag.id,
+                    )
+                )
+            ),
+        )
+    )
+    session.execute(bookmark_tags.delete().where(moved))
+
+    counters, pairs, links = {}, {}, {}
+    for (_, public, link_id), old_tags in tagged_with.items():
+        new_tags = (old_tags - {old_tag.id}) | {new_tag.id}
+        _count_tags(counters, old_tags, public, -1)
+        _count_tags(counters, new_tags, public, 1)
+        if public:
+            _count_tag_pairs(pairs, old_tags, -1)
+            _count_tag_pairs(pairs, new_tags, 1)
+            _count_link_tags(links, link_id, old_tags, -1)
+            _count_link_tags(links, link_id, new_tags, 1)
+    _add_tag_counters(session, counters)
+    _add_tag_pairs(session, pairs)
+    _add_link_tags(session, links)
+
+    orphaned = False
+    if not (has_app_context() and current_app.config.get("DEFER_TAG_ORPHANS_CLEANUP")):
+        orphaned = (
+            session.query(Tag)
+            .filter(Tag.id == old_tag.id)
+            .filter(~Tag.bookmarks.any())
+            .delete(synchronize_session=False)
+        )
+
+    # the loaded objects don't know about the changes made with plain SQL
+    retagged = set(ids)
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Bookmark) and obj.id in retagged:
+            session.expire(obj, ["tags", "modified_on"])
+    for tag in (old_tag, new_tag):
+        session.expire(tag, ["public_count", "total_count"])
+
+    # the tag autocompletion index learns the new counters and the deleted tag on commit
+    query = select([Tag.id, Tag.name, Tag.public_count]).where(Tag.id.in_([old_tag.id, new_tag.id]))
+    completion = session.info.setdefault("completion_changes", [])
+    completion.extend(tuple(row) for row in session.execute(query))
+    if orphaned:
+        completion.append((None, old_name, 0))
+
+    session.info["invalidate_counts"] = True
+    session.info.setdefault("retagged_bookmarks", set()).update(retagged)
+    session.info.setdefault("retags", []).append(
+        ((old_tag.id, old_name), (new_tag.id, new_name), rows, bool(orphaned))
+    )
+    return ids
+
+
+def link_hints(url, user_id, max_tags=10):
+    """Looks up `url` by its hash, returning a `LinkHints` with the
+    bookmark of `user_id` linking it, if any, and the `max_tags` tags most
+    used by the public bookmarks of the URL of the other users."""
+
+    links = Link.__table__
+    bookmarks = Bookmark.__table__
+    query = (
+        select([links.c.id, bookmarks.c.id.label("bookmark_id")])
+        .select_from(
+            links.outerjoin(
+                bookmarks, and_(bookmarks.c.link_id == links.c.id, bookmarks.c.user_id == user_id)
+            )
+        )
+        .where(links.c.href_hash == url_hash(url))
+        .limit(1)
+    )
+    row = db.Session.execute(query).first()
+    if row is None:
+        return LinkHints(None, [])
+
+    # the public bookmarks of `user_id` with each tag are left out of the counts
+    own = (
+        select([func.count()])
+        .select_from(bookmark_tags.join(bookmarks))
+        .where(bookmarks.c.link_id == row.id)
+        .where(bookmarks.c.user_id == user_id)
+        .where(bookmarks.c.private == false())
+        .where(bookmark_tags.c.tag_id == link_tags.c.tag_id)
+        .as_scalar()
+    )
+    count = link_tags.c.public_count - own
+
+    query = (
+        select([Tag.name, count.label("count")])
+        .select_from(link_tags.join(Tag.__table__))
+        .where(link_tags.c.link_id == row.id)
+        .where(count > 0)
+        .order_by(desc("count"), Tag.name)
+        .limit(max_tags)
+    )
+    tags = [(name, count) for name, count in db.Session.execute(query)]
+    return LinkHints(row.bookmark_id, tags)
+
+
 def create_bookmark(url, title, notes, tags, private=False):
     """Helper for creating new Bookmark objects.
 
@@ -0,0 +1,180 @@
+"""
+    qstode.model.records
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Read-only bookmark records for list pages and the JSON API.
+
+    Records are loaded with plain SQL queries, bypassing the ORM identity
+    map, and carry the attributes read by the `render_bookmark` template
+    macro and by the API serializers.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+from urllib.parse import urlsplit
+from sqlalchemy import select
+from qstode import db, utils
+from qstode.model.bookmark import Bookmark, Tag, Link, bookmark_tags
+from qstode.model.user import User
+
+
+class Record(object):
+    """Base class of immutable records with the attributes in `__slots__`"""
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is read-only" % type(self).__name__)
+
+    def __repr__(self):
+        values = ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__[:2])
+        return "<%s(%s)>" % (type(self).__name__, values)
+
+
+class TagRecord(Record):
+    __slots__ = ("id", "name")
+
+
+class UserRecord(Record):
+    __slots__ = ("id", "username", "display_name")
+
+
+class BookmarkRecord(Record):
+    __slots__ = (
+        "id",
+        "title",
+        "href",
+        "domain",
+        "notes",
+        "private",
+        "created_on",
+        "modified_on",
+        "user",
+        "tags",
+    )
+
+    def to_dict(self):
+        """Same as `Bookmark.to_dict()`"""
+        return {
+            "id": self.id,
+            "url": self.href,
+            "title": self.title,
+            "notes": self.notes,
+            "tags": [tag.name for tag in self.tags],
+            "private": self.private,
+            "created_on": self.created_on.isoformat(),
+            "modified_on": self.modified_on.isoformat(),
+        }
+
+
+def load_records(ids, criterion=None):
+    """Loads the bookmarks `ids` matching the optional `criterion` as a
+    list of `BookmarkRecord`, in the same order of `ids`.
+
+    Two queries are run, one for the bookmarks with their link and user
+    and one for their tags; tag and user records are shared among the
+    bookmarks.
+    """
+
+    if not ids:
+        return []
+
+    table = Bookmark.__table__
+    users = User.__table__
+    query = select(
+        [
+            table.c.id,
+            table.c.title,
+            Link.href,
+            table.c.notes,
+            table.c.private,
+            table.c.created_on,
+            table.c.modified_on,
+            users.c.id.label("user_id"),
+            users.c.username,
+            users.c.display_name,
+        ]
+    ).select_from(table.outerjoin(Link.__table__).outerjoin(users))
+
+    rows = {}
+    for chunk in utils.chunks(list(ids), 500):
+        chunk_query = query.where(table.c.id.in_(chunk))
+        if criterion is not None:
+            chunk_query = chunk_query.where(criterion)
+        for row in db.Session.execute(chunk_query):
+            rows[row.id] = row
+
+    tags = {bookmark_id: [] for bookmark_id in rows}
+    tag_records = {}
+    for chunk in utils.chunks(list(tags), 500):
+        tags_query = (
+            select([bookmark_tags.c.bookmark_id, Tag.id, Tag.name])
+            .select_from(bookmark_tags.join(Tag.__table__))
+            .where(bookmark_tags.c.bookmark_id.in_(chunk))
+            .order_by(Tag.name)
+        )
+        for bookmark_id, tag_id, name in db.Session.execute(tags_query):
+            tag = tag_records.get(tag_id)
+            if tag is None:
+                tag = tag_records[tag_id] = TagRecord(tag_id, name)
+            tags[bookmark_id].append(tag)
+
+    user_records = {}
+    records = []
+    for bookmark_id in ids:
+        row = rows.get(bookmark_id)
+        if row is None:
+            continue
+        user = user_records.get(row.user_id)
+        if user is None:
+            user = user_records[row.user_id] = UserRecord(
+                row.user_id, row.username, row.display_name
+            )
+        href = row.href or ""
+        records.append(
+            BookmarkRecord(
+                row.id,
+                row.title,
+                href,
+                urlsplit(href).hostname or "",
+                row.notes,
+                row.private,
+                row.created_on,
+                row.modified_on,
+                user,
+                tuple(tags[row.id]),
+            )
+        )
+    return records
+
+
+def iter_records(criterion=None, chunk_size=500):
+    """Yields the `BookmarkRecord` of each bookmark matching `criterion`, in
+    id order.
+
+    The bookmarks are read `chunk_size` at a time with keyset queries on
+    the id, so that memory use doesn't grow with the number of bookmarks.
+    """
+
+    table = Bookmark.__table__
+    last_id = None
+    while True:
+        query = select([table.c.id]).order_by(table.c.id).limit(chunk_size)
+        if criterion is not None:
+            query = query.where(criterion)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        ids = [row.id for row in db.Session.execute(query)]
+
+        for record in load_records(ids):
+            yield record
+        if len(ids) < chunk_size:
+            return
+        last_id = ids[-1]
@@ -0,0 +1,154 @@
+"""
+    qstode.model.sync
+    ~~~~~~~~~~~~~~~~~
+
+    The feed of the changes to the bookmarks of a user, read by the delta
+    sync API: bookmarks created or modified and tombstones of the deleted
+    ones, ordered by the time of the change and by bookmark id.
+
+    A sync token encodes the position of the last change seen by a client.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import heapq
+from collections import namedtuple
+import iso8601
+from sqlalchemy import select, func, union_all, and_, or_
+from qstode import db, utils
+from qstode.model.bookmark import Bookmark, Tombstone
+from qstode.model.records import load_records
+
+
+# A change of the feed; `bookmark` is a `BookmarkRecord`, or None for deleted bookmarks
+Change = namedtuple("Change", "changed_on bookmark_id bookmark")
+
+
+def encode_token(changed_on, bookmark_id):
+    """Encodes the position of a change into an opaque sync token"""
+    return utils.encode_cursor(utils.CURSOR_NEXT, 1, [changed_on, bookmark_id])
+
+
+def decode_token(token):
+    """Returns the tuple (changed_on, bookmark id) encoded in `token`.
+
+    Raises `ValueError` if `token` is not a valid sync token.
+    """
+
+    _, _, values = utils.decode_cursor(token)
+    if len(values) != 2 or not isinstance(values[1], int) or isinstance(values[1], bool):
+        raise ValueError("Invalid token")
+    try:
+        changed_on = iso8601.parse_date(values[0]).replace(tzinfo=None)
+    except (iso8601.ParseError, TypeError):
+        raise ValueError("Invalid token")
+    return changed_on, values[1]
+
+
+def _changed(table, timestamp, key, user_id, since, until):
+    """Filters the rows of `table` belonging to `user_id` and changed after
+    the position `since` and before `until`"""
+
+    criterion = and_(table.c.user_id == user_id, timestamp < until)
+    if since is not None:
+        changed_on, bookmark_id = since
+        criterion = and_(
+            criterion,
+            or_(timestamp > changed_on, and_(timestamp == changed_on, key > bookmark_id)),
+        )
+    return criterion
+
+
+def latest_change(user_id, until):
+    """Returns the time of the last change to the bookmarks of `user_id`
+    before `until`, with a single statement answered by the indexes."""
+
+    bookmarks = Bookmark.__table__
+    tombstones = Tombstone.__table__
+    latest = union_all(
+        select([func.max(bookmarks.c.modified_on).label("changed_on")]).where(
+            and_(bookmarks.c.user_id == user_id, bookmarks.c.modified_on < until)
+        ),
+        select([func.max(tombstones.c.deleted_on).label("changed_on")]).where(
+            and_(
+                tombstones.c.user_id == user_id,
+                tombstones.c.deleted_on < until,
+                tombstones.c.bookmark_id > 0,
+            )
+        ),
+    ).alias("latest")
+    return db.Session.execute(select([func.max(latest.c.changed_on)])).scalar()
+
+
+def pruned_until(user_id):
+    """Returns the time of the newest tombstone of `user_id` deleted by
+    `prune_tombstones()`, or None; a client positioned at or before that
+    time could have missed a deleted bookmark and must sync again."""
+
+    table = Tombstone.__table__
+    query = select([func.max(table.c.deleted_on)]).where(
+        and_(table.c.user_id == user_id, table.c.bookmark_id == 0)
+    )
+    return db.Session.execute(query).scalar()
+
+
+def _modified(user_id, since, until, chunk_size):
+    table = Bookmark.__table__
+    while True:
+        criterion = _changed(table, table.c.modified_on, table.c.id, user_id, since, until)
+        query = (
+            select([table.c.modified_on, table.c.id])
+            .where(criterion)
+            .order_by(table.c.modified_on, table.c.id)
+            .limit(chunk_size)
+        )
+        rows = db.Session.execute(query).fetchall()
+        if not rows:
+            return
+
+        # the bookmarks deleted in the meantime are skipped: their tombstone comes later
+        records = {record.id: record for record in load_records([row.id for row in rows])}
+        for modified_on, bookmark_id in rows:
+            if bookmark_id in records:
+                yield Change(modified_on, bookmark_id, records[bookmark_id])
+
+        if len(rows) < chunk_size:
+            return
+        since = tuple(rows[-1])
+
+
+def _deleted(user_id, since, until, chunk_size):
+    table = Tombstone.__table__
+    while True:
+        criterion = _changed(table, table.c.deleted_on, table.c.bookmark_id, user_id, since, until)
+        query = (
+            select([table.c.deleted_on, table.c.bookmark_id])
+            .where(and_(criterion, table.c.bookmark_id > 0))
+            .order_by(table.c.deleted_on, table.c.bookmark_id)
+            .limit(chunk_size)
+        )
+        rows = db.Session.execute(query).fetchall()
+        for deleted_on, bookmark_id in rows:
+            yield Change(deleted_on, bookmark_id, None)
+
+        if len(rows) < chunk_size:
+            return
+        since = tuple(rows[-1])
+
+
+def iter_changes(user_id, since, until, chunk_size=500):
+    """Yields a `Change` for each bookmark of `user_id` created, modified or
+    deleted after the position `since` (a tuple (changed_on, bookmark id),
+    or None for every bookmark) and before the time `until`.
+
+    The bookmarks and the tombstones are read `chunk_size` at a time with
+    keyset queries and merged in the order of the changes; the tombstones
+    are skipped when `since` is None.
+    """
+
+    modified = _modified(user_id, since, until, chunk_size)
+    if since is None:
+        return modified
+
+    deleted = _deleted(user_id, since, until, chunk_size)
+    return heapq.merge(modified, deleted, key=lambda change: change[:2])
@@ -0,0 +1,627 @@
+"""
+    qstode.postings
+    ~~~~~~~~~~~~~~~
+
+    In-memory posting lists for tag intersection queries.
+
+    Bookmarks are numbered by their position in creation order and every
+    tag keeps the sorted list of the positions of its bookmarks, so that
+    the intersection of the lists is already sorted like the bookmark
+    lists. The engine is built from the database and saved to a snapshot
+    file, which is memory mapped and shared by prefork workers.
+
+    Every commit appends its changes to a journal next to the snapshot and
+    bumps a shared generation counter; each process applies its own writes
+    to its copy and replays the journal to catch up with the writes of the
+    other processes. Changes that can't be replayed (e.g. bulk updates made
+    with plain SQL) make queries fall back to SQL while a new snapshot is
+    built in a background thread, which also compacts the journal.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import json
+import mmap
+import fcntl
+import struct
+import logging
+import itertools
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from sqlalchemy import event, select
+from sqlalchemy.orm import attributes
+from . import db
+from .model.bookmark import Bookmark, Tag, bookmark_tags
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"QSTPOST1"
+EPOCH = datetime(1970, 1, 1)
+
+
+def _timestamp(dt):
+    """Converts a naive UTC datetime to microseconds since the epoch"""
+
+    if dt is None:
+        return 0
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def _intersect(small, large):
+    """Intersects two sorted sequences, searching the items of the
+    shortest one in the longest one"""
+
+    result = []
+    lo, size = 0, len(large)
+    for item in small:
+        lo = bisect_left(large, item, lo)
+        if lo == size:
+            break
+        if large[lo] == item:
+            result.append(item)
+    return result
+
+
+class TagPostings:
+    """Posting lists of the bookmarks of every tag.
+
+    The per-bookmark arrays (`ids`, `owners`, `created` and `public`) and
+    the posting lists are `array` objects, or read only `memoryview`
+    objects when loaded from a snapshot; a posting list is copied to an
+    `array` the first time it's modified.
+    """
+
+    def __init__(self, generation=0):
+        self.generation = generation
+        self.tags = {}
+        self.postings = {}
+        self.ids = array("q")
+        self.owners = array("q")
+        self.created = array("q")
+        self.public = bytearray()
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, generation=0):
+        """Builds the posting lists from the database"""
+
+        engine = cls(generation)
+        positions = {}
+
+        query = select(
+            [Bookmark.id, Bookmark.created_on, Bookmark.user_id, Bookmark.private]
+        ).order_by(Bookmark.created_on, Bookmark.id)
+        for row in db.Session.execute(query):
+            positions[row.id] = len(engine.ids)
+            engine.ids.append(row.id)
+            engine.owners.append(row.user_id or 0)
+            engine.created.append(_timestamp(row.created_on))
+            engine.public.append(0 if row.private else 1)
+
+        for tag_id, name in db.Session.execute(select([Tag.id, Tag.name])):
+            engine.tags[name] = tag_id
+
+        lists = {}
+        query = select([bookmark_tags.c.tag_id, bookmark_tags.c.bookmark_id])
+        for tag_id, bookmark_id in db.Session.execute(query):
+            lists.setdefault(tag_id, []).append(positions[bookmark_id])
+        for tag_id in engine.tags.values():
+            engine.postings[tag_id] = array("q", sorted(lists.get(tag_id, ())))
+
+        return engine
+
+    def save(self, path):
+        """Saves a snapshot to `path`, atomically replacing the old one"""
+
+        count = len(self.ids)
+        offset = 3 * count
+        tags = {}
+        for name, tag_id in self.tags.items():
+            length = len(self.postings[tag_id])
+            tags[name] = [tag_id, offset, length]
+            offset += length
+
+        header = json.dumps({"generation": self.generation, "count": count, "tags": tags})
+        header = header.encode("utf-8")
+        header += b" " * (-len(header) % 8)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(MAGIC)
+            fp.write(struct.pack("<Q", len(header)))
+            fp.write(header)
+            for seq in (self.ids, self.owners, self.created):
+                fp.write(seq)
+            for name in tags:
+                fp.write(self.postings[self.tags[name]])
+            fp.write(self.public)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a snapshot from `path` mapping it in memory"""
+
+        with open(path, "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[: len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a tag postings snapshot".format(path))
+
+        start = len(MAGIC) + 8
+        (header_size,) = struct.unpack("<Q", mm[len(MAGIC) : start])
+        header = json.loads(mm[start : start + header_size].decode("utf-8"))
+        count = header["count"]
+
+        base = start + header_size
+        size = 3 * count + sum(length for _, _, length in header["tags"].values())
+        data = memoryview(mm)[base : base + size * 8].cast("q")
+
+        engine = cls(header["generation"])
+        engine.ids = data[:count]
+        engine.owners = data[count : 2 * count]
+        engine.created = data[2 * count : 3 * count]
+        engine.public = bytearray(mm[base + size * 8 : base + size * 8 + count])
+        for name, (tag_id, offset, length) in header["tags"].items():
+            engine.tags[name] = tag_id
+            engine.postings[tag_id] = data[offset : offset + length]
+        engine._mmap = mm
+        return engine
+
+    def search(self, tags, exclude=(), user_id=None, viewer_id=None):
+        """Returns the ids of the bookmarks tagged with all the `tags` and
+        none of the `exclude` tag names, newest first, like
+        `Bookmark.by_tags()`.
+
+        :param user_id: include only bookmarks owned by `user_id`
+        :param viewer_id: the id of the current user, whose private
+            bookmarks are included
+        """
+
+        try:
+            include = sorted((self.postings[self.tags[name]] for name in set(tags)), key=len)
+        except KeyError:
+            return []
+        if not include:
+            return []
+
+        # intersect rarest first
+        result = include[0]
+        for postings in include[1:]:
+            if not len(result):
+                break
+            result = _intersect(result, postings)
+
+        excluded = set()
+        for name in exclude:
+            tag_id = self.tags.get(name)
+            if tag_id is not None:
+                excluded.update(self.postings[tag_id])
+
+        ids, owners, public = self.ids, self.owners, self.public
+        return [
+            ids[pos]
+            for pos in reversed(result)
+            if pos not in excluded
+            and (public[pos] or (viewer_id is not None and owners[pos] == viewer_id))
+            and (user_id is None or owners[pos] == user_id)
+        ]
+
+    def _position(self, created, bookmark_id):
+        pos = bisect_left(self.created, created)
+        while pos < len(self.created) and self.created[pos] == created:
+            if self.ids[pos] == bookmark_id:
+                return pos
+            pos += 1
+        return None
+
+    def _writable(self, name):
+        seq = getattr(self, name)
+        if isinstance(seq, memoryview):
+            seq = array("q", seq)
+            setattr(self, name, seq)
+        return seq
+
+    def _posting(self, tag_id):
+        postings = self.postings.get(tag_id)
+        if postings is None or isinstance(postings, memoryview):
+            postings = self.postings[tag_id] = array("q", postings or ())
+        return postings
+
+    def apply(self, changes):
+        """Applies the changes collected by `collect_postings_changes()`.
+
+        :returns: False when the changes can't be applied incrementally, in
+            which case the engine is left in an inconsistent state
+        """
+
+        for change in changes:
+            if change[0] == "tag":
+                _, tag_id, name = change
+                self.tags[name] = tag_id
+                self._posting(tag_id)
+            elif change[0] == "untag":
+                self.tags.pop(change[1], None)
+            elif change[0] == "retag":
+                if not self._apply_retag(*change[1:]):
+                    return False
+            elif not self._apply_bookmark(*change[1:]):
+                return False
+        return True
+
+    def _apply_retag(self, old_tag_id, new_tag_id, new_name, bookmarks):
+        self.tags[new_name] = new_tag_id
+        old, new = self._posting(old_tag_id), self._posting(new_tag_id)
+        for created, bookmark_id in bookmarks:
+            pos = self._position(created, bookmark_id)
+            if pos is None:
+                return False
+            i = bisect_left(old, pos)
+            if i < len(old) and old[i] == pos:
+                del old[i]
+            i = bisect_left(new, pos)
+            if i == len(new) or new[i] != pos:
+                new.insert(i, pos)
+        return True
+
+    def _apply_bookmark(
+        self, bookmark_id, old_created, created, user_id, private, old_tags, new_tags, state
+    ):
+        if state == "new":
+            # a change replayed from the journal can already be in the snapshot
+            if self._position(created, bookmark_id) is not None:
+                return True
+            # new bookmarks are appended to the end of the id space; bookmarks with an older
+            # creation date would need to renumber the positions.
+            if len(self.ids) and (created, bookmark_id) < (self.created[-1], self.ids[-1]):
+                return False
+            pos = len(self.ids)
+            self._writable("ids").append(bookmark_id)
+            self._writable("owners").append(user_id or 0)
+            self._writable("created").append(created)
+            self.public.append(0 if private else 1)
+            for tag_id in new_tags:
+                self._posting(tag_id).append(pos)
+            return True
+
+        pos = self._position(old_created, bookmark_id)
+        if pos is None or created != old_created:
+            return False
+
+        if state == "deleted":
+            self.public[pos] = 0
+            self._writable("owners")[pos] = 0
+            new_tags = ()
+        else:
+            self.public[pos] = 0 if private else 1
+            self._writable("owners")[pos] = user_id or 0
+
+        for tag_id in set(old_tags) - set(new_tags):
+            postings = self._posting(tag_id)
+            i = bisect_left(postings, pos)
+            if i < len(postings) and postings[i] == pos:
+                del postings[i]
+        for tag_id in set(new_tags) - set(old_tags):
+            postings = self._posting(tag_id)
+            i = bisect_left(postings, pos)
+            if i == len(postings) or postings[i] != pos:
+                postings.insert(i, pos)
+        return True
+
+
+class PostingsManager:
+    """Owns the `TagPostings` of the current process: loads the snapshot
+    when it changes, keeps track of the generation shared by all the
+    processes writing to the database and replays their changes from the
+    journal."""
+
+    # the journal is compacted by a new snapshot once it grows past this size
+    max_journal_size = 16 * 1024 * 1024
+
+    def __init__(self):
+        self.path = None
+        self.engine = None
+        self._mtime = None
+        self._stale = False
+        self._journal = (None, 0)
+        self._rebuild_thread = None
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        self.path = app.config.get("TAG_POSTINGS_PATH")
+        self.engine = None
+        self._mtime = None
+        self._stale = False
+        self._journal = (None, 0)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _open_generation(self):
+        return os.open(self.path + ".gen", os.O_RDWR | os.O_CREAT, 0o644)
+
+    def read_generation(self):
+        """Returns the number of writes committed by all the processes"""
+
+        fd = self._open_generation()
+        try:
+            data = os.pread(fd, 8, 0)
+        finally:
+            os.close(fd)
+        return struct.unpack("<q", data)[0] if len(data) == 8 else 0
+
+    def _bump_generation(self, changes=None):
+        """Appends `changes` to the journal as the next generation; None
+        marks changes that can't be replayed"""
+
+        fd = self._open_generation()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, 8, 0)
+            generation = struct.unpack("<q", data)[0] if len(data) == 8 else 0
+            entry = json.dumps({"generation": generation + 1, "changes": changes})
+            with open(self.path + ".log", "a", encoding="utf-8") as journal:
+                journal.write(entry + "\n")
+            os.pwrite(fd, struct.pack("<q", generation + 1), 0)
+        finally:
+            os.close(fd)
+
+        engine = self.engine
+        if changes is not None and engine is not None and engine.generation == generation:
+            if engine.apply(changes):
+                engine.generation = generation + 1
+            else:
+                self._discard()
+
+    def commit(self, changes):
+        """Records the changes committed by this process, applying them to
+        its engine when it's up to date"""
+
+        with self._lock:
+            self._bump_generation(changes)
+
+    def invalidate(self):
+        """Marks the snapshots as stale, e.g. after bulk updates that don't
+        go through the ORM; a new snapshot is built in the background"""
+
+        if self.enabled:
+            with self._lock:
+                self._bump_generation()
+
+    def _discard(self):
+        # the engine is left inconsistent by changes it couldn't apply: wait for a new snapshot
+        self.engine = None
+        self._stale = True
+        self._schedule_rebuild()
+
+    def _replay(self, generation):
+        """Applies the changes of the other processes read from the journal,
+        up to at least `generation`; returns False if they can't be applied"""
+
+        engine = self.engine
+        try:
+            journal = open(self.path + ".log", "rb")
+        except FileNotFoundError:
+            return False
+        with journal:
+            # the journal is replaced when it's compacted
+            inode = os.fstat(journal.fileno()).st_ino
+            offset = self._journal[1] if self._journal[0] == inode else 0
+            journal.seek(offset)
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    # still being written
+                    break
+                offset += len(line)
+                self._journal = (inode, offset)
+                entry = json.loads(line.decode("utf-8"))
+                if entry["generation"] <= engine.generation:
+                    continue
+                if (
+                    entry["generation"] != engine.generation + 1
+                    or entry["changes"] is None
+                    or not engine.apply(entry["changes"])
+                ):
+                    return False
+                engine.generation = entry["generation"]
+        return engine.generation >= generation
+
+    def current(self):
+        """Returns the engine if it's up to date with the database, None
+        otherwise"""
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self.engine is None and self._mtime is None:
+                logger.warning("No tag postings snapshot, run 'flask tag-postings'")
+                self._mtime = 0
+            return None
+
+        # snapshots are replaced atomically, so a new one has a new inode
+        mtime = (stat.st_ino, stat.st_mtime_ns)
+        if mtime != self._mtime:
+            self.engine = TagPostings.load(self.path)
+            self._mtime = mtime
+            self._stale = False
+            self._journal = (None, 0)
+        elif self._stale:
+            return None
+
+        generation = self.read_generation()
+        if self.engine.generation < generation:
+            if not self._replay(generation):
+                self._discard()
+                return None
+            if self._journal[1] > self.max_journal_size:
+                self._schedule_rebuild()
+        return self.engine
+
+    def search(self, tags, exclude=(), user_id=None, viewer_id=None):
+        """Searches the posting lists like `TagPostings.search()`.
+
+        :returns: a list of bookmark ids, or None when the engine is
+            disabled or stale and SQL must be used instead
+        """
+
+        if not self.enabled:
+            return None
+        with self._lock:
+            engine = self.current()
+            if engine is None:
+                return None
+            return engine.search(tags, exclude, user_id, viewer_id)
+
+    def save(self):
+        """Builds the posting lists from the database and saves a new
+        snapshot; the generation is read first, so that the writes committed
+        during the build are replayed from the journal. The journal is then
+        compacted, dropping the changes included in the snapshot."""
+
+        generation = self.read_generation()
+        engine = TagPostings.build(generation)
+        engine.save(self.path)
+
+        fd = self._open_generation()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                with open(self.path + ".log", "rb") as journal:
+                    entries = [
+                        line
+                        for line in journal
+                        if line.endswith(b"\n")
+                        and json.loads(line.decode("utf-8"))["generation"] > generation
+                    ]
+            except FileNotFoundError:
+                entries = []
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(tmp_fd, "wb") as journal:
+                journal.writelines(entries)
+            os.replace(tmp_path, self.path + ".log")
+        finally:
+            os.close(fd)
+        return engine
+
+    def _schedule_rebuild(self):
+        thread = self._rebuild_thread
+        if thread is not None and thread.is_alive():
+            return
+        self._rebuild_thread = threading.Thread(
+            target=self._rebuild, args=(self._mtime,), name="tag-postings", daemon=True
+        )
+        self._rebuild_thread.start()
+
+    def _rebuild(self, mtime):
+        """Saves a new snapshot, unless another process is already doing it
+        or did it since the snapshot `mtime` was loaded"""
+
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_ino, stat.st_mtime_ns) == mtime:
+                self.save()
+        except FileNotFoundError:
+            # the first snapshot is built with the "tag-postings" command
+            pass
+        except Exception:
+            logger.exception("Cannot rebuild the tag postings snapshot")
+        finally:
+            db.Session.remove()
+            os.close(fd)
+
+
+manager = PostingsManager()
+
+
+def _bookmark_change(obj, state):
+    tags = attributes.get_history(obj, "tags")
+    created = attributes.get_history(obj, "created_on")
+    old_created = created.deleted[0] if created.deleted else obj.created_on
+    return (
+        "bookmark",
+        obj.id,
+        _timestamp(old_created),
+        _timestamp(obj.created_on),
+        obj.user_id,
+        obj.private,
+        [tag.id for tag in itertools.chain(tags.unchanged or (), tags.deleted or ())],
+        [tag.id for tag in itertools.chain(tags.unchanged or (), tags.added or ())],
+        state,
+    )
+
+
+# The attribute history is still available after the flush, and the new objects have their ids.
+@event.listens_for(db.Session, "after_flush")
+def collect_postings_changes(session, ctx):
+    if not manager.enabled:
+        return
+
+    changes = session.info.setdefault("postings_changes", [])
+    for obj in session.new:
+        if isinstance(obj, Tag):
+            changes.append(("tag", obj.id, obj.name))
+    for obj in session.dirty:
+        if isinstance(obj, Tag) and attributes.get_history(obj, "name").deleted:
+            changes.append(("untag", attributes.get_history(obj, "name").deleted[0]))
+            changes.append(("tag", obj.id, obj.name))
+    for obj in session.deleted:
+        if isinstance(obj, Tag):
+            changes.append(("untag", obj.name))
+
+    # new bookmarks are appended to the id space in creation order
+    created = [_bookmark_change(obj, "new") for obj in session.new if isinstance(obj, Bookmark)]
+    changes.extend(sorted(created, key=lambda change: (change[3], change[1])))
+    for obj in session.dirty:
+        if isinstance(obj, Bookmark) and session.is_modified(obj):
+            changes.append(_bookmark_change(obj, "modified"))
+    for obj in session.deleted:
+        if isinstance(obj, Bookmark):
+            changes.append(_bookmark_change(obj, "deleted"))
+
+
+@event.listens_for(db.Session, "after_commit")
+def apply_postings_changes(session):
+    changes = session.info.pop("postings_changes", None) or []
+    if not manager.enabled:
+        return
+
+    # tags inserted by `Tag.get_or_create_many()` without a flush
+    created = [("tag", tag_id, name) for tag_id, name in session.info.get("created_tags", ())]
+    # bookmarks retagged by `retag_bookmarks()` with plain SQL
+    retags = []
+    for old_tag, new_tag, bookmarks, orphaned in session.info.get("retags", ()):
+        retags.append(
+            (
+                "retag",
+                old_tag[0],
+                new_tag[0],
+                new_tag[1],
+                [(_timestamp(created_on), bookmark_id) for created_on, bookmark_id in bookmarks],
+            )
+        )
+        if orphaned:
+            retags.append(("untag", old_tag[1]))
+
+    if retags and any(change[0] == "bookmark" for change in changes):
+        # the order of the retags and of the other changes is unknown
+        manager.invalidate()
+    elif created or changes or retags:
+        manager.commit(created + changes + retags)
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_postings_changes(session, previous_transaction):
+    session.info.pop("postings_changes", None)
@@ -7,16 +7,32 @@
     :copyright: (c) 2013 by Daniel Kertesz
     :license: BSD, see LICENSE for more details.
 """
+import io
 import os
 import json
-import redis
-from whoosh.fields import ID, TEXT, KEYWORD, Schema
+import fcntl
+import time
+import shutil
+import sqlite3
+import tarfile
+import logging
+import heapq
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict, Counter
+from flask import current_app, has_app_context
+from sqlalchemy import event, select, func, or_
+from whoosh.fields import ID, TEXT, KEYWORD, BOOLEAN, NUMERIC, DATETIME, Schema
+from whoosh.query import Term, And, Or, DateRange
 from whoosh.analysis import RegexTokenizer, LowercaseFilter, CharsetFilter
 from whoosh.support.charset import accent_map
-from whoosh.index import create_in, open_dir, exists_in
+from whoosh.index import create_in, open_dir, exists_in, LockError
+from whoosh.util.filelock import try_for
 from whoosh.writing import AsyncWriter
 from whoosh.qparser import MultifieldParser
-from whoosh.sorting import Facets
+from qstode import db, utils
+from qstode.model.bookmark import Bookmark
+from qstode.documents import SearchPage, create_document, iter_documents
 
 
 # Constants used in the Redis message queue
@@ -26,6 +42,16 @@ OP_INDEX, OP_UPDATE, OP_DELETE = list(range(3))
 QUEUE_INDEX = "index_in"
 QUEUE_WORK = "index_work"
 
+# Name of the manifest of an index snapshot; it's kept in the index directory of an imported
+# snapshot until the changes made after the snapshot are replayed
+SNAPSHOT_MANIFEST = "snapshot.json"
+
+# How far back from the export time a snapshot watermark is moved, to cover the transactions
+# running during the export
+SNAPSHOT_MARGIN = timedelta(minutes=5)
+
+logger = logging.getLogger(__name__)
+
 
 def generate_schema():
     """Generates the search engine schema"""
@@ -35,26 +61,37 @@ def generate_schema():
     schema = Schema(
         id=ID(stored=True, unique=True),
         title=TEXT(stored=False, analyzer=text_analyzer),
-        tags=KEYWORD(stored=False, lowercase=True, commas=True),
+        # the term vectors give the tags of the top hits
+        tags=KEYWORD(stored=False, lowercase=True, commas=True, vector=True),
         notes=TEXT(stored=False, analyzer=text_analyzer),
+        # used to filter the results inside the index
+        private=BOOLEAN(),
+        user_id=NUMERIC(int, bits=64),
+        created_on=DATETIME(),
+        domain=ID(),
     )
     return schema
 
 
-def create_document(bookmark):
-    """Creates a Document (a dict) for the search engine"""
+def mark_indexed(ids, indexed_on):
+    """Stamps the `indexed_on` column of the bookmarks `ids` and commits"""
 
-    return {
-        "id": str(bookmark.id),
-        "title": bookmark.title or "",
-        "notes": bookmark.notes or "",
-        "tags": ", ".join([tag.name for tag in bookmark.tags]),
-    }
+    # don't let the `onupdate` default of `modified_on` mark the bookmarks as modified
+    table = Bookmark.__table__
+    for chunk in utils.chunks(sorted(ids), 500):
+        db.Session.execute(
+            table.update()
+            .where(table.c.id.in_(chunk))
+            .values(indexed_on=indexed_on, modified_on=table.c.modified_on)
+        )
+    db.Session.commit()
 
 
 def redis_connect(config):
     """Connects to a Redis database as specified by the dictionary `config`"""
 
+    import redis
+
     return redis.Redis(
         host=config.get("REDIS_HOST", "localhost"),
         port=config.get("REDIS_PORT", 6379),
@@ -63,17 +100,207 @@ def redis_connect(config):
     )
 
 
+class RedisQueue(object):
+    """The indexing queue stored in Redis.
+
+    Items are moved atomically from the `QUEUE_INDEX` list to the
+    `QUEUE_WORK` list when they are reserved by a worker, and removed from
+    the latter once they are acknowledged; the items left in `QUEUE_WORK`
+    by a crashed worker are processed again by the next one.
+
+    The work list is shared, so a single worker may process the queue: it
+    holds a lock expiring after `lock_ttl` seconds, refreshed while it runs.
+    """
+
+    # seconds after which the lock of a worker that stopped refreshing it expires
+    lock_ttl = 300
+
+    def __init__(self, client, name=QUEUE_INDEX, work_name=QUEUE_WORK):
+        self.client = client
+        self.name = name
+        self.work_name = work_name
+        self._lock = None
+
+    def lock(self):
+        """Takes the lock of the worker processing the queue.
+
+        :returns: False if another worker holds it
+        """
+        self._lock = self.client.lock(self.work_name + ":lock", timeout=self.lock_ttl)
+        return self._lock.acquire(blocking=False)
+
+    def refresh_lock(self):
+        self._lock.reacquire()
+
+    def unlock(self):
+        self._lock.release()
+        self._lock = None
+
+    def push(self, payloads):
+        # items are popped from the tail: push them on the head to get a FIFO queue
+        if payloads:
+            self.client.lpush(self.name, *payloads)
+
+    def reserve(self, timeout):
+        """Reserves the next item, waiting up to `timeout` seconds.
+
+        :returns: a tuple (token, payload) or None
+        """
+        if timeout > 0:
+            payload = self.client.brpoplpush(self.name, self.work_name, max(1, int(timeout)))
+        else:
+            payload = self.client.rpoplpush(self.name, self.work_name)
+        if payload is None:
+            return None
+        return payload, payload.decode("utf-8")
+
+    def pending(self):
+        """Returns the items reserved but never acknowledged"""
+
+        items = self.client.lrange(self.work_name, 0, -1)
+        return [(payload, payload.decode("utf-8")) for payload in items]
+
+    def ack(self, tokens):
+        pipe = self.client.pipeline()
+        for token in tokens:
+            pipe.lrem(self.work_name, 1, token)
+        pipe.execute()
+
+    def __len__(self):
+        return self.client.llen(self.name)
+
+
+class LocalQueue(object):
+    """A stand-in for `RedisQueue` stored in a SQLite database, for
+    installations without Redis; it can be shared by the processes of a
+    single host. The lock of the worker is a file lock, released when the
+    worker exits."""
+
+    # how often `reserve()` checks for new items while waiting
+    poll_interval = 0.05
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock_fd = None
+
+    def lock(self):
+        fd = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fd.close()
+            return False
+        self._lock_fd = fd
+        return True
+
+    def refresh_lock(self):
+        pass
+
+    def unlock(self):
+        self._lock_fd.close()
+        self._lock_fd = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "payload TEXT NOT NULL, reserved INTEGER NOT NULL DEFAULT 0)"
+            )
+        return self._conn
+
+    def push(self, payloads):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO queue (payload) VALUES (?)", [(payload,) for payload in payloads]
+            )
+
+    def reserve(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT id, payload FROM queue WHERE reserved = 0 ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute("UPDATE queue SET reserved = 1 WHERE id = ?", (row[0],))
+            finally:
+                self.conn.execute("COMMIT")
+            if row is not None or time.monotonic() >= deadline:
+                return row
+            time.sleep(self.poll_interval)
+
+    def pending(self):
+        return self.conn.execute(
+            "SELECT id, payload FROM queue WHERE reserved = 1 ORDER BY id"
+        ).fetchall()
+
+    def ack(self, tokens):
+        with self.conn:
+            for chunk in utils.chunks(list(tokens), 500):
+                self.conn.execute(
+                    "DELETE FROM queue WHERE id IN (%s)" % ",".join("?" * len(chunk)), chunk
+                )
+
+    def __len__(self):
+        return self.conn.execute("SELECT count(*) FROM queue WHERE reserved = 0").fetchone()[0]
+
+
+class LRUCache(object):
+    """A thread safe mapping keeping the `size` most recently used items"""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
 class WhooshSearcher(object):
     """Interface to a Whoosh based Search Engine"""
 
     # default search fields for user queries
     search_fields = ("notes", "title", "tags")
 
+    # number of tags returned with the search results
+    facet_limit = 20
+
+    # number of top hits over which the tags of the search results are counted
+    facet_sample = 500
+
     def __init__(self, app=None, index_dir=None):
         self.app = app
         self.index_dir = index_dir
         self._ix = None
         self._redis = None
+        self._queue = None
+        # Whoosh searchers aren't thread safe: each thread keeps its own
+        self._local = threading.local()
+        self._queries = LRUCache(512)
+        self._results = LRUCache(512)
 
     @property
     def ix(self):
@@ -91,6 +318,21 @@ class WhooshSearcher(object):
             self._redis = redis_connect(self.app.config)
         return self._redis
 
+    @property
+    def queue(self):
+        """The indexing queue: a `RedisQueue` when Redis is configured, a
+        `LocalQueue` otherwise"""
+
+        if self._queue is None:
+            if "REDIS_HOST" in self.app.config:
+                self._queue = RedisQueue(self.redis)
+            else:
+                path = self.app.config.get("INDEX_QUEUE_PATH")
+                if path is None:
+                    path = os.path.normpath(self.index_dir) + "-queue.sqlite"
+                self._queue = LocalQueue(path)
+        return self._queue
+
     def init_app(self, app):
         """Initialize module and checks if the index exists"""
 
@@ -98,8 +340,11 @@ class WhooshSearcher(object):
         if "WHOOSH_INDEX_PATH" not in self.app.config:
             raise Exception("You must set the WHOOSH_INDEX_PATH option " "in the configuration")
         self.index_dir = self.app.config["WHOOSH_INDEX_PATH"]
+        self._queries = LRUCache(app.config.get("SEARCH_CACHE_SIZE", 512))
+        self._results = LRUCache(app.config.get("SEARCH_CACHE_SIZE", 512))
         if not exists_in(self.index_dir):
             self.setup_index()
+        app.extensions["searcher"] = self
 
     def setup_index(self):
         """Create the index directory"""
@@ -113,27 +358,61 @@ class WhooshSearcher(object):
         ix = open_dir(self.index_dir)
         return ix
 
+    def swap_index(self, path):
+        """Replaces the index with the one in the directory `path`.
+
+        The index directory becomes a symbolic link to `path`, renamed after
+        the swap time, and the link is replaced atomically; only the first
+        swap, replacing a plain directory with the link, leaves a short
+        window without an index.
+        """
+
+        link = os.path.normpath(self.index_dir)
+        target = "%s.%s" % (link, datetime.utcnow().strftime("%Y%m%d%H%M%S%f"))
+        os.rename(path, target)
+
+        if os.path.islink(link):
+            old = os.path.join(os.path.dirname(link), os.readlink(link))
+        elif os.path.exists(link):
+            old = link + ".old"
+            shutil.rmtree(old, ignore_errors=True)
+            os.rename(link, old)
+        else:
+            old = None
+
+        tmp_link = link + ".swap"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.basename(target), tmp_link)
+        os.replace(tmp_link, link)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+        self._ix = None
+
     def get_async_writer(self):
         """Return an AsyncWriter; NOTE that we NEED thread support (i.e when
         you're running in uwsgi"""
         return AsyncWriter(self.ix)
 
     def push_add_bookmark(self, bookmark):
-        """Pushes a 'add bookmark' operation to the Redis queue"""
+        """Pushes a 'add bookmark' operation to the indexing queue"""
 
-        r = self.redis
-        payload = json.dumps((OP_INDEX, bookmark.id))
-        r.rpush(QUEUE_INDEX, payload)
+        self.push_operations([(OP_INDEX, bookmark.id)])
 
     def push_update_bookmark(self, bookmark):
-        """Pushes a 'update bookmark' operation to the Redis queue"""
+        """Pushes a 'update bookmark' operation to the indexing queue"""
         self.push_add_bookmark(bookmark)
 
     def push_delete_bookmark(self, bookmark_id):
-        """Pushes a 'delete bookmark' operation to the Redis queue"""
-        r = self.redis
-        payload = json.dumps((OP_DELETE, bookmark_id))
-        r.rpush(QUEUE_INDEX, payload)
+        """Pushes a 'delete bookmark' operation to the indexing queue"""
+        self.push_operations([(OP_DELETE, bookmark_id)])
+
+    def push_operations(self, operations):
+        """Pushes a list of (operation, bookmark id) tuples to the indexing
+        queue with a single command"""
+
+        if operations:
+            self.queue.push([json.dumps(op) for op in operations])
 
     def add_bookmark(self, bookmark, writer=None):
         """Index a bookmark, updating it if it's already indexed;
@@ -167,26 +446,511 @@ class WhooshSearcher(object):
         else:
             writer.delete_by_term("id", _id)
 
-    def search(self, query, page=1, page_len=10, fields=None):
-        """Returns the results of a search engine query ordered by
-        Whoosh default ordering (?).
+    def get_searcher(self):
+        """Returns the Whoosh searcher of the current thread, and the index
+        generation it reads, reopening it only when the index changed.
 
-        :returns: a list of bookmark id (int)
+        The generation is a tuple (index directory, index generation), so
+        that an index replaced by `swap_index` is never confused with the
+        previous one.
+        """
+
+        local = self._local
+        generation = (os.path.realpath(self.index_dir), self.ix.latest_generation())
+        if getattr(local, "generation", None) != generation:
+            if getattr(local, "searcher", None) is not None:
+                local.searcher.close()
+            local.searcher = self.ix.searcher()
+            local.generation = generation
+        return local.searcher, local.generation
+
+    @staticmethod
+    def count_tags(searcher, docnums):
+        """Returns a `Counter` of the tags of the documents `docnums`, read
+        from the term vectors of the index; documents indexed without term
+        vectors have no tags."""
+
+        counts = Counter()
+        for docnum in docnums:
+            if searcher.has_vector(docnum, "tags"):
+                counts.update(name for name, _ in searcher.vector_as("frequency", docnum, "tags"))
+        return counts
+
+    def parse_query(self, query, fields):
+        """Returns the parsed Whoosh query for a normalized user query"""
+
+        key = (query, fields)
+        whoosh_query = self._queries.get(key)
+        if whoosh_query is None:
+            whoosh_query = MultifieldParser(fields, self.ix.schema).parse(query)
+            self._queries.put(key, whoosh_query)
+        return whoosh_query
+
+    @staticmethod
+    def filter_query(viewer_id=None, user_id=None, start=None, end=None):
+        """Returns a Whoosh query matching the public bookmarks and the
+        private bookmarks of `viewer_id`, optionally restricted to the
+        bookmarks of `user_id` and to those created between the datetimes
+        `start` and `end`"""
+
+        visible = Term("private", False)
+        if viewer_id is not None:
+            visible = Or([visible, And([Term("private", True), Term("user_id", viewer_id)])])
+        terms = [visible]
+        if user_id is not None:
+            terms.append(Term("user_id", user_id))
+        if start is not None or end is not None:
+            terms.append(DateRange("created_on", start, end))
+        return And(terms)
+
+    def search(
+        self,
+        query,
+        page=1,
+        page_len=10,
+        fields=None,
+        viewer_id=None,
+        user_id=None,
+        start=None,
+        end=None,
+    ):
+        """Returns a page of results of a search engine query, ordered by
+        relevance, including only the bookmarks visible by the user
+        `viewer_id` (`None` for anonymous users).
+
+        Results can be restricted to the bookmarks of `user_id` and to
+        those created between the datetimes `start` and `end`; the filters
+        are applied by the index, so every page and the total are exact.
+        Results are cached until the index changes.
+
+        :returns: a `SearchPage` with the bookmark ids (int), the total
+            number of hits and the most common tags among the top
+            `facet_sample` hits
+        :raises ValueError: when `page` is out of range
         """
         if fields is None:
             fields = tuple(self.search_fields)
+        query = " ".join(query.split())
+        filters = (viewer_id, user_id, start, end)
+
+        searcher, generation = self.get_searcher()
+        key = (query, fields, filters, page, page_len, generation)
+        results = self._results.get(key)
+        if results is not None:
+            return results
+
+        if page < 1:
+            raise ValueError("page must be >= 1")
+        hits = searcher.search(
+            self.parse_query(query, fields),
+            limit=max(page * page_len, self.facet_sample),
+            filter=self.filter_query(*filters),
+        )
+        total = len(hits)
+        if page > 1 and (page - 1) * page_len >= total:
+            raise ValueError("page %d is out of range" % page)
+        ids = [int(hit["id"]) for hit in hits[(page - 1) * page_len : page * page_len]]
+
+        docnums = [docnum for _, docnum in hits.top_n[: self.facet_sample]]
+        counts = self.count_tags(searcher, docnums)
+        tags = heapq.nsmallest(self.facet_limit, counts.items(), key=lambda i: (-i[1], i[0]))
+
+        results = SearchPage(ids, total, tags)
+        self._results.put(key, results)
+        return results
+
+
+class IndexWorker(object):
+    """Applies the operations of the indexing queue to the search engine
+    index: operations are collected in batches of up to `batch_size` items
+    or `interval` seconds, and each batch is written with a single index
+    commit.
+
+    Queue items are acknowledged only after the index commit, so a worker
+    interrupted in the middle of a batch leaves them in the queue for the
+    next one. A single worker may run at a time for each queue.
+    """
+
+    # seconds to wait for the index write lock
+    lock_timeout = 60
+
+    def __init__(self, searcher, batch_size=100, interval=1.0):
+        self.searcher = searcher
+        self.queue = searcher.queue
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def run(self, once=False):
+        """Processes the queue forever or, with `once`, until it's empty.
+
+        :returns: the number of indexed or deleted documents
+        :raises LockError: when another worker is processing the queue
+        """
 
-        results = None
-        with self.ix.searcher() as searcher:
-            parser = MultifieldParser(fields, self.ix.schema)
-            whoosh_query = parser.parse(query)
-            facets = Facets()
-            facets.add_field("tags", allow_overlap=True)
+        # the pending items would be processed again by a second worker
+        if not self.queue.lock():
+            raise LockError("Another index worker is processing the queue")
+        try:
+            return self._run(once)
+        finally:
+            self.queue.unlock()
+
+    def _run(self, once):
+        # an imported index snapshot must catch up with the database first
+        total = replay_snapshot(self.searcher, self.batch_size)
+        # items reserved by a worker that died before acknowledging them
+        batch = self.queue.pending()
+        while True:
+            self.queue.refresh_lock()
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = 0 if once else max(0, deadline - time.monotonic())
+                item = self.queue.reserve(timeout)
+                if item is None:
+                    break
+                batch.append(item)
+
+            if batch:
+                total += self.process([payload for _, payload in batch])
+                self.queue.ack([token for token, _ in batch])
+                batch = []
+            elif once:
+                return total
+
+    def process(self, payloads):
+        """Indexes a batch of queue payloads with a single writer and stamps
+        the `indexed_on` column of the indexed bookmarks.
+
+        :returns: the number of indexed or deleted documents
+        """
 
-            # this can raise a ValueError
-            search_results = searcher.search_page(
-                whoosh_query, page, pagelen=page_len, groupedby=facets
-            )
-            results = [int(result["id"]) for result in search_results]
+        # every operation rebuilds the document from the database, so only the last one matters
+        operations = {}
+        for payload in payloads:
+            op, bookmark_id = json.loads(payload)
+            operations[bookmark_id] = op
+
+        started = datetime.utcnow()
+        ids = sorted(bookmark_id for bookmark_id, op in operations.items() if op != OP_DELETE)
+        bookmarks = {}
+        for chunk in utils.chunks(ids, 500):
+            bookmarks.update((b.id, b) for b in Bookmark.query.filter(Bookmark.id.in_(chunk)))
+
+        writer = self.searcher.ix.writer(timeout=self.lock_timeout)
+        try:
+            for bookmark_id in operations:
+                bookmark = bookmarks.get(bookmark_id)
+                if bookmark is None:
+                    writer.delete_by_term("id", str(bookmark_id))
+                else:
+                    writer.update_document(**create_document(bookmark))
+        except Exception:
+            writer.cancel()
+            raise
+        writer.commit()
+        mark_indexed(bookmarks, started)
+
+        deleted = len(operations) - len(bookmarks)
+        logger.info("Indexed %d bookmarks, deleted %d", len(bookmarks), deleted)
+        return len(operations)
+
+
+def _write_documents(ix, chunks, commit_every, on_commit, progress=None, update=True, **kwargs):
+    """Writes lists of documents to the index `ix`, committing every
+    `commit_every` documents; after every index commit `on_commit` is called
+    with the ids of the committed documents and the time when the first of
+    them was read.
+
+    :returns: the number of written documents
+    """
+
+    total = 0
+    started = time.monotonic()
+    chunks = iter(chunks)
+    while True:
+        read_on = datetime.utcnow()
+        writer = None
+        ids = []
+        try:
+            for documents in chunks:
+                if writer is None:
+                    writer = ix.writer(**kwargs)
+                for document in documents:
+                    if update:
+                        writer.update_document(**document)
+                    else:
+                        writer.add_document(**document)
+                ids.extend(int(document["id"]) for document in documents)
+                if len(ids) >= commit_every:
+                    break
+        except BaseException:
+            if writer is not None:
+                writer.cancel()
+            raise
+        if writer is None:
+            return total
+
+        writer.commit()
+        on_commit(ids, read_on)
+        total += len(ids)
+        if progress is not None:
+            progress(total, time.monotonic() - started)
+
+
+def reindex_modified(searcher, chunk_size=500, commit_every=10000, progress=None):
+    """Indexes the bookmarks modified since they were last indexed, or never
+    indexed.
+
+    Every index commit stamps the `indexed_on` column of its bookmarks, so an
+    interrupted run is resumed by running it again. `progress`, if given, is
+    called after every commit with the number of documents indexed so far
+    and the elapsed seconds.
+
+    :returns: the number of indexed bookmarks
+    """
+
+    modified = or_(Bookmark.indexed_on.is_(None), Bookmark.modified_on > Bookmark.indexed_on)
+    return _write_documents(
+        searcher.ix,
+        iter_documents(chunk_size=chunk_size, criterion=modified),
+        commit_every,
+        mark_indexed,
+        progress,
+        timeout=IndexWorker.lock_timeout,
+    )
+
+
+def rebuild_index(searcher, chunk_size=500, commit_every=10000, procs=1, progress=None):
+    """Indexes all the bookmarks in a new index, built next to the current
+    one, which then replaces the current index with `WhooshSearcher.swap_index`.
+
+    With `procs` greater than one the documents are indexed by as many
+    processes, each writing its own segments. The id of the last committed
+    bookmark is saved in the new index directory, and an interrupted rebuild
+    is resumed from there, replacing the documents committed to the index
+    after the last saved id; the bookmarks changed after the rebuild started
+    are indexed again before the swap.
+
+    :returns: the number of indexed bookmarks
+    """
+
+    path = os.path.normpath(searcher.index_dir) + ".rebuild"
+    state_path = os.path.join(path, "rebuild.json")
+    resumed = os.path.exists(state_path)
+    if resumed:
+        with open(state_path) as fd:
+            state = json.load(fd)
+        ix = open_dir(path)
+        logger.info("Resuming the index rebuild after bookmark %d", state["last_id"])
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+        os.mkdir(path)
+        ix = create_in(path, generate_schema())
+        state = {"started": datetime.utcnow().isoformat(), "last_id": 0}
+    started = _parse_datetime(state["started"])
+
+    def on_commit(ids, read_on):
+        mark_indexed(ids, read_on)
+        state["last_id"] = max(ids)
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump(state, fd)
+        os.replace(tmp_path, state_path)
+
+    writer_args = {"procs": procs, "multisegment": True} if procs > 1 else {}
+    total = _write_documents(
+        ix,
+        iter_documents(state["last_id"], chunk_size),
+        commit_every,
+        on_commit,
+        progress,
+        # the rebuild may have been interrupted between an index commit and its checkpoint
+        update=resumed,
+        **writer_args
+    )
 
-        return results or []
+    # catch up with the bookmarks changed or deleted while the rebuild was running
+    table = Bookmark.__table__
+    _write_documents(
+        ix,
+        iter_documents(chunk_size=chunk_size, criterion=table.c.modified_on >= started),
+        commit_every,
+        mark_indexed,
+    )
+    delete_missing(ix)
+
+    os.remove(state_path)
+    searcher.swap_index(path)
+    return total
+
+
+def delete_missing(ix, **kwargs):
+    """Deletes from the index `ix` the bookmarks that don't exist anymore"""
+
+    with ix.searcher() as s:
+        indexed = set(int(term) for term in s.lexicon("id"))
+    for row in db.Session.execute(select([Bookmark.id])):
+        indexed.discard(row.id)
+    if indexed:
+        writer = ix.writer(**kwargs)
+        for bookmark_id in indexed:
+            writer.delete_by_term("id", str(bookmark_id))
+        writer.commit()
+
+
+def export_snapshot(searcher, path):
+    """Writes a snapshot of the index to the tar.gz file `path`.
+
+    The index is locked against writes while it's copied. The snapshot
+    manifest records a watermark: all the bookmarks modified before it
+    are in the snapshot, as proven by their `indexed_on` column.
+
+    :returns: the watermark (a datetime)
+    """
+
+    ix = searcher.ix
+    lock = ix.lock("WRITELOCK")
+    if not try_for(lock.acquire, timeout=IndexWorker.lock_timeout, delay=0.1):
+        raise LockError("Cannot lock the index")
+    try:
+        modified = or_(Bookmark.indexed_on.is_(None), Bookmark.modified_on > Bookmark.indexed_on)
+        watermark = db.Session.execute(
+            select([func.min(Bookmark.modified_on)]).where(modified)
+        ).scalar()
+        # transactions still running have modification times older than their commit
+        now = datetime.utcnow() - SNAPSHOT_MARGIN
+        if watermark is None or watermark > now:
+            watermark = now
+        manifest = {"watermark": watermark.isoformat(), "generation": ix.latest_generation()}
+
+        tmp_path = path + ".tmp"
+        with tarfile.open(tmp_path, "w:gz") as tar:
+            for name in sorted(ix.storage.list()):
+                # lock files and the manifest of a previous import
+                if name.endswith("LOCK") or name == SNAPSHOT_MANIFEST:
+                    continue
+                tar.add(os.path.join(searcher.index_dir, name), arcname=name)
+            data = json.dumps(manifest).encode("utf-8")
+            info = tarfile.TarInfo(SNAPSHOT_MANIFEST)
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(data))
+        os.replace(tmp_path, path)
+    finally:
+        lock.release()
+    return watermark
+
+
+def import_snapshot(searcher, path):
+    """Replaces the index with the snapshot in the tar.gz file `path`.
+
+    The snapshot manifest is kept in the index directory until the
+    bookmarks modified after the snapshot watermark are indexed again by
+    `replay_snapshot`; the `IndexWorker` replays an interrupted import
+    before processing the queue.
+
+    :returns: the watermark of the snapshot (a datetime)
+    """
+
+    target = os.path.normpath(searcher.index_dir) + ".import"
+    shutil.rmtree(target, ignore_errors=True)
+    os.mkdir(target)
+    with tarfile.open(path, "r:gz") as tar:
+        for member in tar.getmembers():
+            if not member.isfile() or os.path.basename(member.name) != member.name:
+                raise ValueError("Invalid index snapshot member: %s" % member.name)
+            tar.extract(member, target)
+
+    manifest_path = os.path.join(target, SNAPSHOT_MANIFEST)
+    if not os.path.exists(manifest_path) or not exists_in(target):
+        shutil.rmtree(target)
+        raise ValueError("%s is not an index snapshot" % path)
+    with open(manifest_path) as fd:
+        manifest = json.load(fd)
+
+    searcher.swap_index(target)
+    return _parse_datetime(manifest["watermark"])
+
+
+def replay_snapshot(searcher, chunk_size=500, commit_every=10000):
+    """Indexes the bookmarks modified after the watermark of an imported
+    snapshot and deletes the ones deleted after it, then forgets the
+    watermark.
+
+    :returns: the number of indexed bookmarks
+    """
+
+    manifest_path = os.path.join(searcher.index_dir, SNAPSHOT_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return 0
+    with open(manifest_path) as fd:
+        watermark = _parse_datetime(json.load(fd)["watermark"])
+
+    # `indexed_on` describes the index of the node that exported the snapshot: leave it alone
+    total = _write_documents(
+        searcher.ix,
+        iter_documents(chunk_size=chunk_size, criterion=Bookmark.modified_on >= watermark),
+        commit_every,
+        lambda ids, read_on: None,
+        timeout=IndexWorker.lock_timeout,
+    )
+    delete_missing(searcher.ix, timeout=IndexWorker.lock_timeout)
+    os.remove(manifest_path)
+    logger.info("Replayed %d bookmarks modified after %s", total, watermark)
+    return total
+
+
+def _parse_datetime(value):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Invalid datetime: %s" % value)
+
+
+# Bookmark changes are queued for indexing once the transaction is committed, so that requests
+# never wait for the search engine and rolled back changes are never indexed.
+@event.listens_for(db.Session, "after_flush")
+def collect_index_operations(session, ctx):
+    if not has_app_context():
+        return
+    # other search backends keep their index in sync by themselves
+    if not isinstance(current_app.extensions.get("searcher"), WhooshSearcher):
+        return
+
+    operations = session.info.setdefault("index_operations", {})
+    for obj in session.new:
+        if isinstance(obj, Bookmark):
+            operations[obj.id] = OP_INDEX
+    for obj in session.dirty:
+        if isinstance(obj, Bookmark) and session.is_modified(obj):
+            operations[obj.id] = OP_UPDATE
+    for obj in session.deleted:
+        if isinstance(obj, Bookmark):
+            operations[obj.id] = OP_DELETE
+
+
+@event.listens_for(db.Session, "after_commit")
+def queue_index_operations(session):
+    operations = session.info.pop("index_operations", None) or {}
+    if not has_app_context():
+        return
+
+    searcher = current_app.extensions.get("searcher")
+    if isinstance(searcher, WhooshSearcher):
+        # bookmarks retagged by `retag_bookmarks()` without a flush
+        for bookmark_id in session.info.get("retagged_bookmarks", ()):
+            operations.setdefault(bookmark_id, OP_UPDATE)
+    if searcher is None or not operations:
+        return
+    try:
+        searcher.push_operations([(op, bookmark_id) for bookmark_id, op in operations.items()])
+    except Exception:
+        # the bookmarks are already committed, indexing must not fail the request
+        logger.exception("Cannot queue %d bookmarks for indexing", len(operations))
+
+
+@event.listens_for(db.Session, "after_soft_rollback")
+def forget_index_operations(session, previous_transaction):
+    session.info.pop("index_operations", None)
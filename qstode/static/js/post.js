@@ -1,3 +1,51 @@
+/* Shows if the URL was already saved by the current user and the tags
+ * other users applied to it */
+function loadPostHints(el, url) {
+    el.empty();
+    if (!url) {
+        return;
+    }
+
+    $.getJSON(el.data("url"), {url: url}, function(data) {
+        el.empty();
+        if (data.bookmark) {
+            $("<div class=\"alert alert-info\"></div>")
+                .text(el.data("saved") + " ")
+                .append($("<a></a>").attr("href", data.bookmark.edit_url).text(el.data("edit")))
+                .appendTo(el);
+        }
+        if (data.tags.length) {
+            var p = $("<p></p>").text(el.data("suggested") + " ").appendTo(el);
+            $.each(data.tags, function(i, tag) {
+                $("<button type=\"button\" class=\"btn btn-xs btn-default\"></button>")
+                    .text(tag.name)
+                    .attr("title", tag.count)
+                    .click(function() {
+                        var field = $("#tags");
+                        var terms = $.grep(comma_split(field.val()), function(term) {
+                            return term !== "";
+                        });
+                        if ($.inArray(tag.name, terms) < 0) {
+                            terms.push(tag.name);
+                        }
+                        terms.push("");
+                        field.val(terms.join(", "));
+                    })
+                    .appendTo(p);
+                p.append(" ");
+            });
+        }
+    });
+}
+
 $(function() {
     setupAutocomplete($("#tags"));
+
+    var hints = $("#post-hints");
+    if (hints.length) {
+        loadPostHints(hints, $("#url").val());
+        $("#url").change(function() {
+            loadPostHints(hints, $(this).val());
+        });
+    }
 });
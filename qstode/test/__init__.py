@@ -1,6 +1,8 @@
 import os
 import tempfile
 import shutil
+from contextlib import contextmanager
+from sqlalchemy import event
 from flask_testing import TestCase
 from qstode import main
 from qstode import db
@@ -37,3 +39,20 @@ class FlaskTestCase(TestCase):
         for item in data:
             db.Session.add(item)
         db.Session.commit()
+
+
+@contextmanager
+def count_statements():
+    """Collects the SQL statements executed inside the `with` block"""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.Session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
@@ -7,10 +7,13 @@
     :copyright: (c) 2012 by Daniel Kertesz
     :license: BSD, see LICENSE for more details.
 """
+from datetime import datetime, timedelta
 from flask import url_for
-from . import FlaskTestCase
+from . import FlaskTestCase, count_statements
 from .model_factory import UserFactory, TagFactory, BookmarkFactory
 from .. import db
+from ..model.bookmark import Bookmark, Link, Tombstone, tag_counters_drift, prune_tombstones
+from ..model.sync import encode_token, decode_token, iter_changes
 
 
 class ApiTestBase(FlaskTestCase):
@@ -44,3 +47,258 @@ class TaglistViewTest(ApiTestBase):
         first = tags[0]
         self.assertEqual(first["tag"], "python")
         self.assertEqual(len(tags), 6)
+
+
+class BookmarkListViewTest(ApiTestBase):
+    def test_cursor(self):
+        self.addCleanup(self.app.config.__setitem__, "PER_PAGE", self.app.config["PER_PAGE"])
+        self.app.config["PER_PAGE"] = 1
+        rv = self.client.get(url_for("api_bookmark_list"))
+        self.assert200(rv)
+        meta = rv.json["meta"]
+        self.assertIsNone(meta["prev_cursor"])
+        first = rv.json["bookmarks"][0]
+
+        rv = self.client.get(url_for("api_bookmark_list", cursor=meta["next_cursor"]))
+        self.assert200(rv)
+        self.assertEqual(rv.json["meta"]["cur_page"], 2)
+        self.assertIsNone(rv.json["meta"]["next_cursor"])
+        self.assertNotEqual(rv.json["bookmarks"][0]["id"], first["id"])
+
+        rv = self.client.get(url_for("api_bookmark_list", cursor=rv.json["meta"]["prev_cursor"]))
+        self.assertEqual(rv.json["bookmarks"][0]["id"], first["id"])
+
+    def test_invalid_cursor(self):
+        rv = self.client.get(url_for("api_bookmark_list", cursor="nope"))
+        self.assert400(rv)
+
+
+class PostHintsTest(ApiTestBase):
+    def test_post_hints(self):
+        url = url_for("post_hints", url="http://example.com/")
+        self.assert401(self.client.get(url))
+
+        link = Link("http://example.com/")
+        bookmark = BookmarkFactory.create(
+            user=self.user1, link=link, tags=[TagFactory.create(name="python")]
+        )
+        BookmarkFactory.create(user=self.user2, link=link, tags=[TagFactory.create(name="web")])
+        db.Session.commit()
+
+        self.client.post(url_for("login"), data={"user": "user1", "password": "password"})
+        rv = self.client.get(url)
+        self.assert200(rv)
+        self.assertEqual(rv.json["bookmark"]["id"], bookmark.id)
+        # only the tags of the other users
+        self.assertEqual(rv.json["tags"], [{"name": "web", "count": 1}])
+
+        rv = self.client.get(url_for("post_hints", url="http://example.org/"))
+        self.assertEqual(rv.json, {"bookmark": None, "tags": []})
+        self.assert400(self.client.get(url_for("post_hints")))
+
+
+class BookmarkBatchTest(ApiTestBase):
+    def login(self):
+        self.client.post(url_for("login"), data={"user": "user1", "password": "password"})
+
+    def test_batch(self):
+        url = url_for("api_bookmark_batch")
+        self.assert401(self.client.post(url, json={"create": []}))
+        self.login()
+
+        other = BookmarkFactory.create(user=self.user2, tags=[TagFactory.create(name="web")])
+        db.Session.commit()
+        first, second = [b.id for b in self.user1.bookmarks]
+        other_id = other.id
+
+        data = {
+            "create": [
+                {"url": "http://example.com/", "title": "Example", "tags": ["Python", "new"]},
+                {"url": "http://example.com/", "title": "Secret", "tags": ["new"], "private": True},
+                {"url": "not an url", "title": "Broken", "tags": ["python"]},
+                {"url": "http://example.org/", "title": "No tags", "tags": []},
+                {"url": "http://example.org/" + "a" * 2000, "title": "Long", "tags": ["web"]},
+            ],
+            "update": [
+                {"id": first, "title": "Renamed", "tags": ["python", "guido"]},
+                {"id": other_id, "title": "Not mine"},
+                {"id": "x"},
+            ],
+            "delete": [second, other_id, 12345, [1]],
+        }
+        rv = self.client.post(url, json=data)
+        self.assert200(rv)
+        results = rv.json
+
+        self.assertEqual([r["status"] for r in results["create"]], [201, 201, 400, 400, 400])
+        self.assertEqual(results["create"][2]["message"], "Invalid url")
+        self.assertEqual(results["create"][4]["message"], "Url too long")
+        self.assertEqual([r["status"] for r in results["update"]], [200, 404, 400])
+        self.assertEqual([r["status"] for r in results["delete"]], [204, 404, 404, 400])
+
+        created = [Bookmark.query.get(r["id"]) for r in results["create"][:2]]
+        self.assertEqual([t.name for t in created[0].tags], ["new", "python"])
+        self.assertTrue(created[1].private)
+        self.assertIs(created[0].link, created[1].link)
+
+        renamed = Bookmark.query.get(first)
+        self.assertEqual(renamed.title, "Renamed")
+        self.assertEqual([t.name for t in renamed.tags], ["guido", "python"])
+        self.assertIsNone(Bookmark.query.get(second))
+        self.assertEqual(Bookmark.query.get(other_id).user.username, "user2")
+        self.assertEqual(tag_counters_drift(), [])
+
+    def test_batch_limits(self):
+        self.login()
+        url = url_for("api_bookmark_batch")
+        self.assert400(self.client.post(url, data="[]", content_type="application/json"))
+        self.assert400(self.client.post(url, json={"create": {}}))
+
+        self.addCleanup(self.app.config.__setitem__, "API_BATCH_MAX_ITEMS", 1000)
+        self.app.config["API_BATCH_MAX_ITEMS"] = 2
+        rv = self.client.post(url, json={"delete": [1, 2, 3]})
+        self.assertEqual(rv.status_code, 413)
+
+    def test_batch_statements(self):
+        self.login()
+
+        def create(count):
+            items = [
+                {
+                    "url": "http://example.com/%d/%d" % (count, i),
+                    "title": "Bookmark %d" % i,
+                    "tags": ["python", "tag%d" % i],
+                }
+                for i in range(count)
+            ]
+            with count_statements() as statements:
+                rv = self.client.post(url_for("api_bookmark_batch"), json={"create": items})
+            self.assert200(rv)
+            return len([s for s in statements if not s.startswith("INSERT INTO bookmarks ")])
+
+        # links and tags are resolved in bulk: only the bookmark rows are inserted one by one
+        self.assertEqual(create(5), create(50))
+
+    def test_multi_get(self):
+        private = BookmarkFactory.create(
+            user=self.user2, private=True, tags=[TagFactory.create(name="web")]
+        )
+        db.Session.commit()
+        private_id = private.id
+        first, second = [b.id for b in self.user1.bookmarks]
+
+        ids = "%d,%d,%d,999" % (second, private_id, first)
+        rv = self.client.get(url_for("api_bookmark_multi", ids=ids))
+        self.assert200(rv)
+        self.assertEqual([b["id"] for b in rv.json["bookmarks"]], [second, first])
+        self.assertEqual(rv.json["missing"], [private_id, 999])
+
+        self.client.post(url_for("login"), data={"user": "user2", "password": "password"})
+        rv = self.client.get(url_for("api_bookmark_multi", ids=ids))
+        self.assertEqual([b["id"] for b in rv.json["bookmarks"]], [second, private_id, first])
+        self.assert400(self.client.get(url_for("api_bookmark_multi", ids="1,x")))
+
+
+class BookmarkChangesTest(ApiTestBase):
+    def setUp(self):
+        super(BookmarkChangesTest, self).setUp()
+        self.addCleanup(self.app.config.__setitem__, "SYNC_SETTLE_SECONDS", 5)
+        self.app.config["SYNC_SETTLE_SECONDS"] = 0
+        self.first, self.second = [b.id for b in self.user1.bookmarks]
+
+    def changes(self, since=None, **kwargs):
+        rv = self.client.get(url_for("api_bookmark_changes", since=since), **kwargs)
+        self.assert200(rv)
+        return rv, rv.json["changes"], rv.json["next"]
+
+    def test_changes(self):
+        self.assert401(self.client.get(url_for("api_bookmark_changes")))
+        self.client.post(url_for("login"), data={"user": "user1", "password": "password"})
+
+        rv, changes, token = self.changes()
+        self.assertEqual([c["id"] for c in changes], [self.first, self.second])
+        self.assertEqual(changes[0]["bookmark"]["tags"], ["guido", "programming", "python"])
+
+        # nothing changed: the token moves forward anyway
+        rv, changes, next_token = self.changes(token)
+        self.assertEqual(changes, [])
+        self.assertGreater(decode_token(next_token), decode_token(token))
+        headers = {"If-None-Match": rv.headers["ETag"]}
+        rv = self.client.get(url_for("api_bookmark_changes", since=token), headers=headers)
+        self.assertEqual(rv.status_code, 304)
+
+        bookmark = Bookmark.query.get(self.first)
+        bookmark.tags = bookmark.tags[:1]
+        db.Session.commit()
+        db.Session.delete(Bookmark.query.get(self.second))
+        db.Session.commit()
+
+        rv, changes, token = self.changes(token, headers=headers)
+        self.assertEqual([c["id"] for c in changes], [self.first, self.second])
+        self.assertEqual(changes[0]["bookmark"]["tags"], ["guido"])
+        self.assertTrue(changes[1]["deleted"])
+        self.assertEqual(self.changes(token)[1], [])
+
+    def test_invalid_token(self):
+        self.client.post(url_for("login"), data={"user": "user1", "password": "password"})
+        self.assert400(self.client.get(url_for("api_bookmark_changes", since="garbage")))
+
+        # an old position is fine until tombstones after it are pruned
+        old = encode_token(datetime.utcnow() - timedelta(days=365), 1)
+        self.changes(old)
+        bookmark = Bookmark.query.get(self.second)
+        db.Session.delete(bookmark)
+        db.Session.commit()
+        prune_tombstones(timedelta(0))
+        db.Session.commit()
+        rv = self.client.get(url_for("api_bookmark_changes", since=old))
+        self.assertEqual(rv.status_code, 410)
+
+        # a full sync after the pruning starts after the horizon
+        token = self.changes()[2]
+        self.assertEqual(self.changes(token)[1], [])
+
+    def test_idle_user(self):
+        """A user whose last change is older than the tombstones keeps syncing"""
+
+        self.client.post(url_for("login"), data={"user": "user1", "password": "password"})
+        bookmark = Bookmark.query.get(self.first)
+        bookmark.modified_on = datetime.utcnow() - timedelta(days=100)
+        db.Session.commit()
+
+        token = self.changes()[2]
+        for _ in range(2):
+            rv, changes, token = self.changes(token)
+            self.assertEqual(changes, [])
+
+    def test_stamped_on_commit(self):
+        bookmark = Bookmark.query.get(self.first)
+        bookmark.title = "Changed"
+        db.Session.delete(Bookmark.query.get(self.second))
+        db.Session.flush()
+        flushed = datetime.utcnow()
+        db.Session.commit()
+
+        self.assertGreaterEqual(Bookmark.query.get(self.first).modified_on, flushed)
+        tombstone = Tombstone.query.filter_by(bookmark_id=self.second).one()
+        self.assertGreaterEqual(tombstone.deleted_on, flushed)
+
+    def test_iter_changes(self):
+        ids = [self.first, self.second]
+        for bookmark_id in ids:
+            db.Session.delete(Bookmark.query.get(bookmark_id))
+            db.Session.commit()
+        created = BookmarkFactory.create(user=self.user1, tags=[TagFactory.create(name="new")])
+        db.Session.commit()
+
+        since, until = (datetime(2000, 1, 1), 0), datetime.utcnow()
+        changes = list(iter_changes(self.user1.id, since, until, chunk_size=1))
+        self.assertEqual([c.bookmark_id for c in changes], ids + [created.id])
+        self.assertEqual([c.bookmark for c in changes[:2]], [None, None])
+        # a full sync has no tombstones
+        changes = list(iter_changes(self.user1.id, None, until))
+        self.assertEqual([c.bookmark_id for c in changes], [created.id])
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["prune-tombstones", "--days", "0"])
+        self.assertIn("Deleted 2 tombstones", result.output)
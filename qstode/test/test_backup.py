@@ -0,0 +1,139 @@
+"""
+    qstode.test.test_backup
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Backup and restore commands.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import gzip
+import json
+from unittest import mock
+from . import FlaskTestCase
+from .. import db, archive
+from .model_factory import UserFactory, TagFactory, BookmarkFactory
+from ..model.bookmark import Bookmark, Tag
+from ..model.user import User
+
+
+class BackupTest(FlaskTestCase):
+    def setUp(self):
+        super(BackupTest, self).setUp()
+        self.filename = os.path.join(self.tmp_dir, "backup.jsonl.gz")
+        user1 = UserFactory.create(username="user1", email="user1@example.com", admin=True)
+        user2 = UserFactory.create(username="user2", email="user2@example.com")
+        BookmarkFactory.create(
+            user=user1,
+            title="Python",
+            tags=[TagFactory.create(name=w) for w in ("python", "programming")],
+        )
+        db.Session.commit()
+        BookmarkFactory.create(
+            user=user1, private=True, tags=[TagFactory.create(name=w) for w in ("web", "python")]
+        )
+        db.Session.commit()
+        BookmarkFactory.create(user=user2, tags=[TagFactory.create(name="web")])
+        db.Session.commit()
+        self.runner = self.app.test_cli_runner()
+
+    def reset_db(self):
+        db.Session.remove()
+        db.drop_all()
+        db.create_all()
+
+    def bookmarks(self):
+        return sorted(
+            (b.user.username, b.title, b.private, sorted(t.name for t in b.tags))
+            for b in Bookmark.query
+        )
+
+    def test_backup_restore(self):
+        expected = self.bookmarks()
+        # one bookmark at a time, to cross the chunk boundaries
+        with mock.patch("qstode.cli.backup.CHUNK_SIZE", 1):
+            result = self.runner.invoke(args=["backup", self.filename])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        # a plain gzip file of JSON Lines
+        with open(self.filename, "rb") as fd:
+            lines = gzip.decompress(fd.read()).decode("utf-8").splitlines()
+        items = [json.loads(line) for line in lines]
+        self.assertEqual(items[0], {"format": "qstode-backup", "version": 2})
+        self.assertEqual(sum("bookmark" in item for item in items), 3)
+
+        with open(self.filename, "rb") as fd:
+            index = archive.read_index(fd)
+        entries = [(entry["username"], entry["bookmarks"]) for entry in index]
+        self.assertEqual(entries, [("user1", 2), ("user2", 1)])
+
+        self.reset_db()
+        with mock.patch("qstode.cli.backup.CHUNK_SIZE", 1):
+            result = self.runner.invoke(args=["import-file", self.filename])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Restored 2 users", result.output)
+
+        self.assertEqual(self.bookmarks(), expected)
+        self.assertTrue(User.query.filter_by(username="user1").one().admin)
+        python = Tag.query.filter_by(name="python").one()
+        self.assertEqual((python.public_count, python.total_count), (1, 2))
+
+    def test_restore_single_user(self):
+        self.runner.invoke(args=["backup", self.filename])
+        self.reset_db()
+
+        result = self.runner.invoke(args=["import-file", self.filename, "--user", "nobody"])
+        self.assertEqual(result.exit_code, 1)
+
+        result = self.runner.invoke(args=["import-file", self.filename, "--user", "user2"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([u.username for u in User.query], ["user2"])
+        self.assertEqual(self.bookmarks()[0][0], "user2")
+        self.assertEqual(Bookmark.query.count(), 1)
+
+    def test_invalid_archive(self):
+        self.runner.invoke(args=["backup", self.filename])
+        with open(self.filename, "rb+") as fd:
+            fd.truncate(os.path.getsize(self.filename) - 10)
+
+        result = self.runner.invoke(args=["import-file", self.filename])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Invalid backup archive", result.output)
+
+    def test_import_version1(self):
+        data = {
+            "backup": [
+                {
+                    "username": "old",
+                    "email": "old@example.com",
+                    "password": "secret",
+                    "created_at": "2012-01-01T10:00:00",
+                    "active": True,
+                    "roles": ["admin"],
+                    "bookmarks": [
+                        {
+                            "url": "http://www.example.com/",
+                            "title": "Example",
+                            "notes": "",
+                            "tags": ["Example", "web"],
+                            "private": False,
+                            "creation_date": "2012-01-02T10:00:00",
+                            "last_modified": "2012-01-03T10:00:00",
+                        }
+                    ],
+                }
+            ]
+        }
+        filename = os.path.join(self.tmp_dir, "backup.json")
+        with open(filename, "w", encoding="utf-8") as fd:
+            json.dump(data, fd)
+
+        result = self.runner.invoke(args=["import-file", filename])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        user = User.query.filter_by(username="old").one()
+        self.assertTrue(user.admin)
+        bookmark = Bookmark.query.filter_by(user_id=user.id).one()
+        self.assertEqual(sorted(t.name for t in bookmark.tags), ["example", "web"])
+        self.assertEqual(bookmark.modified_on.day, 3)
@@ -7,11 +7,18 @@
     :copyright: (c) 2012 by Daniel Kertesz
     :license: BSD, see LICENSE for more details.
 """
+import io
+import csv
+import gzip
+import json
 from flask import url_for
-from . import FlaskTestCase
+from . import FlaskTestCase, count_statements
 from .. import db
 from .model_factory import UserFactory, TagFactory, BookmarkFactory
 from ..model.user import User
+from ..model.bookmark import Tag, Bookmark, retag_bookmarks
+from ..completion import completer
+from ..model.records import iter_records
 
 
 class FrontendViewsTest(FlaskTestCase):
@@ -39,6 +46,49 @@ class FrontendViewsTest(FlaskTestCase):
         self.assert200(rv)
         self.assertTrue(self.b1.title in rv.data.decode("utf-8"))
 
+    def test_index_keyset_pagination(self):
+        for key, value in (("PER_PAGE", 1), ("PAGINATION_MODE", "keyset")):
+            self.addCleanup(self.app.config.__setitem__, key, self.app.config[key])
+            self.app.config[key] = value
+
+        BookmarkFactory.create(user=self.user2, tags=[TagFactory.create(name="python")])
+        db.Session.commit()
+
+        rv = self.client.get(url_for("index"))
+        self.assert200(rv)
+        bookmarks = self.get_context_variable("bookmarks")
+        self.assertTrue(bookmarks.keyset)
+        self.assertTrue(bookmarks.next_cursor in rv.data.decode("utf-8"))
+
+        rv = self.client.get(url_for("index", cursor=bookmarks.next_cursor))
+        self.assert200(rv)
+        self.assertTrue(self.b1.title in rv.data.decode("utf-8"))
+
+    def test_list_statements_constant(self):
+        self.addCleanup(self.app.config.__setitem__, "PER_PAGE", self.app.config["PER_PAGE"])
+        users = UserFactory.create_batch(4)
+        for i in range(20):
+            BookmarkFactory.create(
+                user=users[i % 4],
+                tags=[TagFactory.create(name=w) for w in ("python", "tag%d" % i)],
+            )
+        db.Session.commit()
+
+        urls = (
+            url_for("index"),
+            url_for("tagged", tags="python"),
+            url_for("api_bookmark_list"),
+        )
+        for url in urls:
+            counts = []
+            for per_page in (5, 20):
+                self.app.config["PER_PAGE"] = per_page
+                db.Session.expire_all()
+                with count_statements() as statements:
+                    self.assert200(self.client.get(url))
+                counts.append(len(statements))
+            self.assertEqual(counts[0], counts[1], url)
+
     def test_login_failure(self):
         form_data = {"user": "not_user", "password": "password", "next": url_for("index")}
         rv = self.client.post(url_for("login"), data=form_data)
@@ -55,6 +105,62 @@ class FrontendViewsTest(FlaskTestCase):
         self.assertTrue("Authentication required" in result.data.decode("utf-8"))
         self.assertTemplateUsed("unauthenticated.html")
 
+    def test_rename_tag(self):
+        b3 = BookmarkFactory.create(user=self.user2, tags=[TagFactory.create(name="python")])
+        db.Session.commit()
+        b3_id = b3.id
+
+        self.client.get(url_for("rename_tag"))
+        self.assertTemplateUsed("unauthenticated.html")
+
+        self.client.post(url_for("login"), data={"user": "user1", "password": "password"})
+        # only administrators can rename the tags of everyone
+        data = {"old_name": "Python", "new_name": "py", "all_users": "y"}
+        rv = self.client.post(url_for("rename_tag"), data=data)
+        self.assert_redirects(rv, url_for("rename_tag"))
+
+        self.assertEqual(Tag.query.filter_by(name="py").one().total_count, 2)
+        self.assertEqual(Tag.query.filter_by(name="python").one().bookmarks.all()[0].id, b3_id)
+
+        rv = self.client.post(url_for("rename_tag"), data={"old_name": "java", "new_name": "py"})
+        self.assert404(rv)
+
+    def test_export_bookmarks(self):
+        BookmarkFactory.create(user=self.user2, title="Not mine")
+        db.Session.commit()
+        self.client.post(url_for("login"), data={"user": "user1", "password": "password"})
+
+        rv = self.client.get(url_for("export_bookmarks"))
+        self.assert200(rv)
+        self.assertTrue(rv.is_streamed)
+        body = rv.get_data(as_text=True)
+        self.assertTrue(body.startswith("<!DOCTYPE NETSCAPE-Bookmark-file-1>"))
+        self.assertIn('TAGS="guido,programming,python"', body)
+        self.assertNotIn("Not mine", body)
+
+        rv = self.client.get(url_for("export_bookmarks", format="jsonl"))
+        self.assertEqual(rv.mimetype, "application/x-ndjson")
+        items = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+        self.assertEqual([item["id"] for item in items], sorted(item["id"] for item in items))
+        self.assertEqual(items[0]["tags"], ["guido", "programming", "python"])
+        self.assertEqual([item["private"] for item in items], [False, True])
+
+        rv = self.client.get(url_for("export_bookmarks", format="csv", gzip=1))
+        self.assertEqual(rv.mimetype, "application/gzip")
+        self.assertIn(".csv.gz", rv.headers["Content-Disposition"])
+        rows = list(csv.reader(io.StringIO(gzip.decompress(rv.data).decode("utf-8"))))
+        self.assertEqual(rows[0][:4], ["url", "title", "notes", "tags"])
+        self.assertEqual(rows[2][3], "flask,python,tags,web")
+        self.assertEqual(len(rows), 3)
+
+        self.assert404(self.client.get(url_for("export_bookmarks", format="xml")))
+
+    def test_iter_records_chunks(self):
+        ids = [b.id for b in Bookmark.query.order_by(Bookmark.id)]
+        self.assertEqual([record.id for record in iter_records(chunk_size=1)], ids)
+        records = iter_records(Bookmark.private == True, chunk_size=1)  # noqa: E712
+        self.assertEqual([record.id for record in records], ids[1:])
+
     def test_complete_tags_success(self):
         rv = self.client.get(url_for("complete_tags") + "?term=pyt")
         self.assert200(rv)
@@ -64,6 +170,41 @@ class FrontendViewsTest(FlaskTestCase):
         assert len(results) == 1
         assert results[0].get("value", "") == "python"
 
+    def test_complete_tags_ranked(self):
+        for _ in range(2):
+            BookmarkFactory.create(user=self.user2, tags=[TagFactory.create(name="pyramid")])
+            db.Session.commit()
+
+        rv = self.client.get(url_for("complete_tags", term="PY"))
+        self.assert200(rv)
+        self.assertEqual([r["value"] for r in rv.json["results"]], ["pyramid", "python"])
+
+        # tags created by this process are completed right away
+        BookmarkFactory.create(user=self.user2, tags=[TagFactory.create(name="pyflakes")])
+        db.Session.commit()
+        rv = self.client.get(url_for("complete_tags", term="py"))
+        self.assertEqual(
+            [r["value"] for r in rv.json["results"]], ["pyramid", "pyflakes", "python"]
+        )
+
+        # merging a tag updates the count of the target and removes the orphaned tag
+        retag_bookmarks("pyramid", "pyflakes")
+        db.Session.commit()
+        rv = self.client.get(url_for("complete_tags", term="py"))
+        self.assertEqual([r["value"] for r in rv.json["results"]], ["pyflakes", "python"])
+        self.assertEqual(completer.counts[completer.names.index("pyflakes")], 3)
+
+    def test_complete_tags_cache_headers(self):
+        rv = self.client.get(url_for("complete_tags", term="pyt"))
+        self.assertTrue(rv.cache_control.public)
+        max_age = self.app.config["TAG_AUTOCOMPLETE_CACHE_MAX_AGE"]
+        self.assertEqual(rv.cache_control.max_age, max_age)
+
+        rv = self.client.get(
+            url_for("complete_tags", term="pyt"), headers={"If-None-Match": rv.headers["ETag"]}
+        )
+        self.assertStatus(rv, 304)
+
     def test_complete_tags_empty(self):
         expected = {"results": []}
         rv = self.client.get(url_for("complete_tags") + "?term=foobarbaz")
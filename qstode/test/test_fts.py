@@ -0,0 +1,136 @@
+"""
+    qstode.test.test_fts
+    ~~~~~~~~~~~~~~~~~~~~
+
+    SQLite FTS5 search backend tests.
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import datetime
+from flask import url_for
+from . import FlaskTestCase
+from .. import db
+from ..fts import FTSSearcher, parse_query
+from ..model.bookmark import Bookmark, Link, retag_bookmarks
+from .model_factory import UserFactory, TagFactory, BookmarkFactory
+
+
+class FTSTest(FlaskTestCase):
+    def setUp(self):
+        super(FTSTest, self).setUp()
+        self.searcher = FTSSearcher()
+        self.searcher.init_app(self.app)
+        self.addCleanup(self.app.extensions.pop, "searcher", None)
+
+        self.user = UserFactory.create()
+        self.b1 = BookmarkFactory.create(
+            user=self.user,
+            title="Python decorators explained",
+            notes="how to write a decorator",
+            tags=[TagFactory.create(name="python")],
+        )
+        db.Session.commit()
+        self.b2 = BookmarkFactory.create(
+            user=self.user,
+            title="Writing a decorator in Python",
+            notes="python decorators, python closures and more python",
+            tags=[TagFactory.create(name="python")],
+        )
+        self.b3 = BookmarkFactory.create(
+            user=self.user, title="Flask tutorial", tags=[TagFactory.create(name="web")]
+        )
+        db.Session.commit()
+
+    def test_parse_query(self):
+        fields = ("title", "tags")
+        self.assertEqual(parse_query("python", fields), ('{title tags} : "python"', None))
+        self.assertEqual(
+            parse_query("OR python OR tags:'web dev' NOT", fields),
+            ('{title tags} : "python" OR tags : "web dev"', None),
+        )
+        self.assertEqual(
+            parse_query('domain:Example.com "say hi" it"s http://x', fields),
+            (
+                '{title tags} : "say hi" {title tags} : "it""s" {title tags} : "http://x"',
+                "example.com",
+            ),
+        )
+        self.assertEqual(parse_query("  ", fields), (None, None))
+
+    def test_sync_in_transaction(self):
+        self.assertEqual(sorted(self.searcher.search("python").ids), [self.b1.id, self.b2.id])
+
+        self.b3.title = "Flask and Python"
+        db.Session.flush()
+        self.assertEqual(self.searcher.search("python").total, 3)
+        db.Session.rollback()
+        self.assertEqual(self.searcher.search("python").total, 2)
+
+        db.Session.delete(Bookmark.query.get(self.b1.id))
+        db.Session.commit()
+        self.assertEqual(self.searcher.search("python").ids, [self.b2.id])
+
+    def test_search(self):
+        results = self.searcher.search("python", page_len=1)
+        self.assertEqual(results.total, 2)
+        # the bookmark mentioning python the most ranks first
+        self.assertEqual(results.ids, [self.b2.id])
+        self.assertEqual(results.tags, [("python", 2)])
+        self.assertEqual(self.searcher.search("python", page=2, page_len=1).ids, [self.b1.id])
+        with self.assertRaises(ValueError):
+            self.searcher.search("python", page=3, page_len=1)
+
+        self.assertEqual(self.searcher.search("tags:web").ids, [self.b3.id])
+        self.assertEqual(self.searcher.search("decorators NOT closures").ids, [self.b1.id])
+        self.assertEqual(self.searcher.search("python OR flask").total, 3)
+
+    def test_search_filters(self):
+        other = UserFactory.create()
+        secret = BookmarkFactory.create(
+            user=other,
+            private=True,
+            title="Secret python notes",
+            created_on=datetime(2012, 1, 1),
+            tags=[TagFactory.create(name="python")],
+        )
+        self.b3.link = Link("https://Flask.palletsprojects.com:443/tutorial/")
+        db.Session.commit()
+
+        self.assertEqual(self.searcher.search("python").total, 2)
+        results = self.searcher.search("python", viewer_id=other.id)
+        self.assertEqual(results.total, 3)
+        self.assertEqual(results.tags, [("python", 3)])
+        results = self.searcher.search("python", viewer_id=other.id, user_id=other.id)
+        self.assertEqual(results.ids, [secret.id])
+
+        results = self.searcher.search("python", viewer_id=other.id, end=datetime(2012, 12, 31))
+        self.assertEqual(results.ids, [secret.id])
+        results = self.searcher.search("python", viewer_id=other.id, start=datetime(2013, 1, 1))
+        self.assertEqual(results.total, 2)
+
+        results = self.searcher.search("domain:flask.palletsprojects.com")
+        self.assertEqual(results.ids, [self.b3.id])
+
+    def test_retag(self):
+        retag_bookmarks("python", "programming")
+        db.Session.commit()
+        self.assertEqual(self.searcher.search("tags:python").total, 0)
+        self.assertEqual(
+            sorted(self.searcher.search("tags:programming").ids), [self.b1.id, self.b2.id]
+        )
+
+    def test_rebuild(self):
+        db.Session.execute("DELETE FROM bookmarks_fts")
+        db.Session.commit()
+        self.assertEqual(self.searcher.search("python").total, 0)
+
+        self.assertEqual(self.searcher.rebuild(chunk_size=2), 3)
+        self.assertEqual(self.searcher.search("python OR flask").total, 3)
+
+    def test_text_search_view(self):
+        rv = self.client.get(url_for("text_search", q="python"))
+        self.assert200(rv)
+        bookmarks = self.get_context_variable("bookmarks")
+        self.assertEqual([b.id for b in bookmarks.items], [self.b2.id, self.b1.id])
+        self.assertEqual(bookmarks.total, 2)
@@ -7,12 +7,19 @@
     :copyright: (c) 2012 by Daniel Kertesz
     :license: BSD, see LICENSE for more details.
 """
+import time
+import random
 from datetime import datetime, timedelta
+import mock
 import werkzeug
-from . import FlaskTestCase
-from .. import db
+from . import FlaskTestCase, count_statements
+from .. import db, utils
 from ..model.user import User, ResetToken, TOKEN_VALIDITY
-from ..model.bookmark import Bookmark, Tag
+from ..model.bookmark import Bookmark, Tag, get_stats, tag_counters_drift, sweep_tag_orphans
+from ..model.bookmark import tag_pairs_drift, Link, normalize_url, url_hash, backfill_link_hashes
+from ..model.bookmark import link_tags_drift, link_hints, retag_bookmarks, URL_MAX, TAG_MAX
+from ..model.bookmark import count_generation, count_generations
+from ..model.records import load_records
 from .model_factory import UserFactory, TagFactory, BookmarkFactory
 
 
@@ -73,6 +80,196 @@ class DbTest(ModelTest):
         with self.assertRaises(werkzeug.exceptions.NotFound):
             p.prev(error_out=True)
 
+    def test_paginate_without_count(self):
+        Bookmark.query.delete()
+        db.Session.commit()
+
+        BookmarkFactory.create_batch(25)
+        db.Session.commit()
+        p = Bookmark.get_latest().paginate(2, per_page=10, count=False)
+        self.assertIsNone(p.total)
+        self.assertEqual(len(p.items), 10)
+        self.assertTrue(p.has_next)
+        self.assertEqual(p.pages, 3)
+
+        p = p.next()
+        self.assertEqual(len(p.items), 5)
+        self.assertFalse(p.has_next)
+        self.assertEqual(p.pages, 3)
+        self.assertEqual(list(p.iter_pages()), [1, 2, 3])
+
+    def test_seek(self):
+        Bookmark.query.delete()
+        db.Session.commit()
+
+        # same creation date for everyone: the id must break the ties
+        now = datetime.utcnow()
+        BookmarkFactory.create_batch(25, created_on=now)
+        db.Session.commit()
+        expected = [b.id for b in Bookmark.get_latest()]
+        keys = Bookmark.sort_keys()
+
+        p = Bookmark.get_latest().seek(None, per_page=10, keys=keys)
+        self.assertTrue(p.keyset)
+        self.assertIsNone(p.prev_cursor)
+        seen = [b.id for b in p.items]
+        while p.has_next:
+            p = p.next()
+            seen.extend(b.id for b in p.items)
+        self.assertEqual(seen, expected)
+        self.assertEqual(p.page, 3)
+        self.assertIsNone(p.next_cursor)
+
+        p = p.prev()
+        self.assertEqual(p.page, 2)
+        self.assertEqual([b.id for b in p.items], expected[10:20])
+        self.assertTrue(p.has_next)
+
+    def test_seek_invalid_cursor(self):
+        keys = Bookmark.sort_keys()
+        for cursor in ("garbage", utils.encode_cursor(utils.CURSOR_NEXT, 2, ["x", "y"])):
+            with self.assertRaises(werkzeug.exceptions.BadRequest):
+                Bookmark.get_latest().seek(cursor, keys=keys)
+
+        p = Bookmark.get_latest().seek("garbage", keys=keys, error_out=False)
+        self.assertEqual(p.page, 1)
+
+    def test_paginate_cursors(self):
+        Bookmark.query.delete()
+        db.Session.commit()
+
+        BookmarkFactory.create_batch(15)
+        db.Session.commit()
+        keys = Bookmark.sort_keys()
+        p = Bookmark.get_latest().paginate(1, per_page=10, keys=keys)
+        self.assertIsNone(p.prev_cursor)
+        p2 = Bookmark.get_latest().seek(p.next_cursor, per_page=10, keys=keys)
+        self.assertEqual(p2.page, 2)
+        self.assertEqual(
+            [b.id for b in p2.items], [b.id for b in Bookmark.get_latest().offset(10)]
+        )
+
+    def test_paginate_count_over(self):
+        Bookmark.query.delete()
+        db.Session.commit()
+
+        tag = TagFactory.create(name="grouped")
+        BookmarkFactory.create_batch(25, tags=[tag])
+        db.Session.commit()
+
+        with count_statements() as statements:
+            p = Bookmark.by_tags(["grouped"]).paginate(2, per_page=10)
+        self.assertEqual(p.total, 25)
+        self.assertEqual(len(p.items), 10)
+        self.assertTrue("OVER ()" in statements[0])
+        self.assertFalse(any("count(*) AS count_1" in s for s in statements))
+
+        with mock.patch("qstode.db.supports_window_functions", return_value=False):
+            with count_statements() as fallback_statements:
+                fp = Bookmark.by_tags(["grouped"]).paginate(2, per_page=10)
+        self.assertEqual(fp.total, 25)
+        self.assertEqual([b.id for b in fp.items], [b.id for b in p.items])
+        self.assertEqual(len(fallback_statements), len(statements) + 1)
+
+        # past the last page
+        p = Bookmark.by_tags(["grouped"]).paginate(4, per_page=10, error_out=False)
+        self.assertEqual(p.items, [])
+        self.assertEqual(p.total, 25)
+
+    def test_paginate_count_cache(self):
+        Bookmark.query.delete()
+        db.Session.commit()
+
+        BookmarkFactory.create_batch(25, user=self.user1)
+        db.Session.commit()
+        cache = utils.CountCache(ttl=60)
+
+        p = Bookmark.by_user(self.user1.id).paginate(2, per_page=10, count_cache=cache)
+        self.assertEqual(p.total, 25)
+        self.assertTrue(p.total_exact)
+        self.assertEqual(len(cache), 1)
+
+        # the ordering doesn't change the fingerprint
+        query = Bookmark.by_user(self.user1.id)
+        self.assertEqual(query.count_fingerprint(), query.order_by(None).count_fingerprint())
+        self.assertNotEqual(
+            query.count_fingerprint(), Bookmark.by_user(self.user2.id).count_fingerprint()
+        )
+
+        with count_statements() as statements:
+            p = Bookmark.by_user(self.user1.id).paginate(3, per_page=10, count_cache=cache)
+        self.assertEqual(p.total, 25)
+        self.assertFalse(any("count(" in s for s in statements))
+
+    def test_count_cache_invalidation(self):
+        db.count_cache.ttl = 60
+        db.count_cache.set("key", (1, True))
+        self.assertEqual(db.count_cache.get("key"), (1, True))
+
+        # writes that don't involve bookmarks or users keep the cache
+        TagFactory.create(name="unused")
+        db.Session.commit()
+        self.assertEqual(db.count_cache.get("key"), (1, True))
+
+        # without the shared generation
+        generation = count_generation()
+        BookmarkFactory.create(user=self.user2)
+        db.Session.commit()
+        self.assertIsNone(db.count_cache.get("key"))
+        self.assertEqual(count_generation(), generation)
+
+    def test_count_cache_generation(self):
+        db.count_cache.ttl = 60
+        db.count_cache.generation = count_generation
+        self.addCleanup(setattr, db.count_cache, "generation", None)
+        key = db.count_cache.key("fingerprint")
+        db.count_cache.set(key, (1, True))
+        self.assertEqual(db.count_cache.key("fingerprint"), key)
+
+        generation = count_generation()
+        BookmarkFactory.create(user=self.user2)
+        db.Session.commit()
+        self.assertEqual(count_generation(), generation + 1)
+
+        # a commit of another process changes the keys without clearing this cache
+        db.count_cache.set(db.count_cache.key("fingerprint"), (2, True))
+        table = count_generations
+        db.Session.execute(table.update().values(generation=table.c.generation + 1))
+        db.Session.commit()
+        self.assertIsNone(db.count_cache.get(db.count_cache.key("fingerprint")))
+
+    def test_count_cache_ttl(self):
+        cache = utils.CountCache(ttl=60)
+        cache.set("key", (1, True))
+        with mock.patch("time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get("key"))
+
+        cache = utils.CountCache(ttl=0)
+        cache.set("key", (1, True))
+        self.assertIsNone(cache.get("key"))
+
+    def test_paginate_approximate(self):
+        Bookmark.query.delete()
+        db.Session.commit()
+
+        BookmarkFactory.create_batch(30)
+        db.Session.commit()
+
+        p = Bookmark.get_latest().paginate(1, per_page=5, count_limit=12)
+        self.assertEqual(p.total, 12)
+        self.assertFalse(p.total_exact)
+        self.assertEqual(p.pages, 3)
+        self.assertTrue(p.has_next)
+
+        # beyond the limit the total still tells there's a next page
+        p = Bookmark.get_latest().paginate(4, per_page=5, count_limit=12)
+        self.assertFalse(p.total_exact)
+        self.assertTrue(p.has_next)
+
+        p = Bookmark.get_latest().paginate(2, per_page=5, count_limit=100)
+        self.assertEqual(p.total, 30)
+        self.assertTrue(p.total_exact)
+
 
 class UserTest(ModelTest):
     def test_user_check_password(self):
@@ -124,6 +321,46 @@ class TagTest(ModelTest):
         db.Session.commit()
         self.assertEqual(t2.id, tag.id)
 
+    def test_get_or_create_many(self):
+        search = Tag.query.filter_by(name="search").one()
+        with count_statements() as statements:
+            tags = Tag.get_or_create_many(["Search", "rust", "RUST", "go"])
+        # one lookup, one insert and one lookup of the inserted tags
+        self.assertEqual(len(statements), 3)
+        self.assertEqual([tag.name for tag in tags], ["search", "rust", "go"])
+        self.assertIs(tags[0], search)
+        self.assertEqual([name for _, name in db.Session.info["created_tags"]], ["rust", "go"])
+        db.Session.commit()
+
+        with count_statements() as statements:
+            self.assertEqual(Tag.get_or_create_many(["go", "rust"]), [tags[2], tags[1]])
+        self.assertEqual(len(statements), 1)
+
+        # "zig" is inserted by a concurrent transaction after the lookup
+        db.Session.execute(Tag.__table__.insert(), {"name": "zig"})
+        found = mock.Mock()
+        found.with_for_update.return_value = Tag.query.filter(Tag.name.in_(["zig", "nim"]))
+        with mock.patch.object(Tag, "query") as query:
+            query.filter.side_effect = [[], found]
+            tags = Tag.get_or_create_many(["zig", "nim"])
+        self.assertEqual([tag.name for tag in tags], ["zig", "nim"])
+        self.assertEqual(Tag.query.filter_by(name="zig").count(), 1)
+        found.with_for_update.assert_called_once_with()
+        db.Session.commit()
+
+        # only the tags inserted by this transaction are recorded as created
+        db.Session.execute(Tag.__table__.insert(), {"name": "kotlin"})
+        found = mock.Mock()
+        found.with_for_update.return_value = Tag.query.filter(Tag.name == "kotlin")
+        with mock.patch.object(Tag, "query") as query:
+            query.filter.side_effect = [[], found]
+            Tag.get_or_create_many(["kotlin"])
+        self.assertEqual(db.Session.info["created_tags"], [])
+        db.Session.rollback()
+
+        with self.assertRaises(ValueError):
+            Tag.get_or_create_many(["a" * (TAG_MAX + 1)])
+
     def test_search(self):
         for n in ("programming", "programmers"):
             BookmarkFactory.create(tags=[TagFactory.create(name=n)])
@@ -136,6 +373,225 @@ class TagTest(ModelTest):
         result = Tag.get_related(["search"])
         self.assertEqual(result[0].name, "web")
 
+    def test_get_related_matches_sql(self):
+        rng = random.Random(1)
+        names = ["tag%d" % i for i in range(12)]
+        for _ in range(60):
+            BookmarkFactory.create(
+                user=rng.choice((self.user1, self.user2)),
+                private=rng.random() < 0.3,
+                tags=[TagFactory.create(name=n) for n in rng.sample(names, rng.randint(1, 5))],
+            )
+            db.Session.commit()
+
+        # edits and deletions must keep the co-occurrences up to date
+        for bookmark in Bookmark.query.filter(Bookmark.id % 7 == 0):
+            bookmark.tags.pop()
+            bookmark.private = not bookmark.private
+        for bookmark in Bookmark.query.filter(Bookmark.id % 11 == 0):
+            db.Session.delete(bookmark)
+        db.Session.commit()
+        self.assertEqual(tag_pairs_drift(), 0)
+
+        queries = [[n] for n in names] + [names[:2], names[3:6], ["tag1", "nonexistent"]]
+        for tags in queries:
+            ids = [tag.id for tag in Tag.get_many(tags)]
+            for user in (None, self.user1):
+                for max_results in (3, 10):
+                    self.assertEqual(
+                        Tag.get_related(tags, max_results, user),
+                        Tag._get_related_sql(ids, max_results, user),
+                    )
+
+    def test_get_related_private(self):
+        result = Tag.get_related(["bing"], user=self.user1)
+        self.assertEqual([(tag.name, tag.tot) for tag in result], [("web", 1), ("search", 1)])
+        self.assertEqual(Tag.get_related(["bing"]), [])
+
+
+class TagCountersTest(ModelTest):
+    def counters(self, name):
+        tag = Tag.query.filter_by(name=name).one()
+        return tag.public_count, tag.total_count
+
+    def test_create(self):
+        self.assertEqual(self.counters("web"), (2, 3))
+        self.assertEqual(self.counters("search"), (1, 2))
+        self.assertEqual(self.counters("bing"), (0, 1))
+        self.assertEqual(tag_counters_drift(), [])
+
+    def test_edit(self):
+        bookmark = Bookmark.by_user(self.user2.id).one()
+        bookmark.tags.remove(Tag.query.filter_by(name="news").one())
+        bookmark.tags.append(Tag.query.filter_by(name="search").one())
+        db.Session.commit()
+        self.assertEqual(self.counters("search"), (2, 3))
+        self.assertEqual(self.counters("nerds"), (1, 1))
+
+        bookmark.private = True
+        db.Session.commit()
+        self.assertEqual(self.counters("search"), (1, 3))
+        self.assertEqual(self.counters("web"), (1, 3))
+
+        # change privacy and tags at once
+        bookmark.private = False
+        bookmark.tags.remove(Tag.query.filter_by(name="web").one())
+        db.Session.commit()
+        self.assertEqual(self.counters("web"), (1, 2))
+        self.assertEqual(self.counters("nerds"), (1, 1))
+        self.assertEqual(tag_counters_drift(), [])
+
+    def test_delete(self):
+        for bookmark in Bookmark.by_user(self.user1.id, include_private=True):
+            db.Session.delete(bookmark)
+        db.Session.commit()
+        self.assertEqual(self.counters("web"), (1, 1))
+        self.assertEqual(Tag.query.filter_by(name="search").count(), 0)
+        self.assertEqual(tag_counters_drift(), [])
+
+    def test_taglist(self):
+        taglist = Tag.taglist()
+        self.assertEqual(taglist[0][0].name, "web")
+        self.assertEqual(taglist[0][1], 2)
+        self.assertNotIn("bing", [tag.name for tag, count in taglist])
+        self.assertEqual(get_stats(), (2, 5))
+
+    def test_rebuild(self):
+        db.Session.execute(Tag.__table__.update().values(public_count=0, total_count=42))
+        db.Session.commit()
+        self.assertEqual(len(tag_counters_drift()), Tag.query.count())
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["tag-counters", "--check"])
+        self.assertEqual(result.exit_code, 1)
+
+        result = runner.invoke(args=["tag-counters"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(tag_counters_drift(), [])
+        self.assertEqual(self.counters("web"), (2, 3))
+
+
+class TagOrphansTest(ModelTest):
+    def test_delete_orphans(self):
+        bookmark = Bookmark.by_user(self.user2.id).one()
+        bookmark.tags.remove(Tag.query.filter_by(name="news").one())
+        bookmark.tags.remove(Tag.query.filter_by(name="web").one())
+        db.Session.commit()
+
+        self.assertEqual(Tag.query.filter_by(name="news").count(), 0)
+        # still used by other bookmarks
+        self.assertEqual(Tag.query.filter_by(name="web").count(), 1)
+
+    def test_unrelated_flush(self):
+        with count_statements() as statements:
+            self.user1.watched_users.append(self.user2)
+            db.Session.commit()
+        self.assertFalse(any(s.startswith("DELETE FROM tags") for s in statements))
+
+    def test_deferred_cleanup(self):
+        self.addCleanup(self.app.config.__setitem__, "DEFER_TAG_ORPHANS_CLEANUP", False)
+        self.app.config["DEFER_TAG_ORPHANS_CLEANUP"] = True
+
+        for bookmark in Bookmark.by_user(self.user1.id, include_private=True):
+            db.Session.delete(bookmark)
+        TagFactory.create(name="unused")
+        db.Session.commit()
+        for name in ("google", "bing", "search", "unused"):
+            self.assertEqual(Tag.query.filter_by(name=name).count(), 1)
+
+        self.assertEqual(sweep_tag_orphans(batch_size=2), 4)
+        self.assertEqual(Tag.query.count(), 3)
+        self.assertEqual(sweep_tag_orphans(), 0)
+
+
+class RetagTest(ModelTest):
+    def tags(self, user_id):
+        query = Bookmark.by_user(user_id, include_private=True)
+        return sorted(sorted(tag.name for tag in bookmark.tags) for bookmark in query)
+
+    def assertNoDrift(self):
+        self.assertEqual(tag_counters_drift(), [])
+        self.assertEqual(tag_pairs_drift(), 0)
+        self.assertEqual(link_tags_drift(), 0)
+
+    def test_rename(self):
+        with count_statements() as statements:
+            ids = retag_bookmarks("Web", "internet", self.user1.id)
+            db.Session.commit()
+        self.assertEqual(len(ids), 2)
+        # the same statements whatever the number of bookmarks
+        self.assertLess(len(statements), 25)
+
+        self.assertEqual(
+            self.tags(self.user1.id),
+            [["bing", "internet", "search"], ["google", "internet", "search"]],
+        )
+        self.assertEqual(self.tags(self.user2.id), [["nerds", "news", "web"]])
+        web = Tag.query.filter_by(name="web").one()
+        internet = Tag.query.filter_by(name="internet").one()
+        self.assertEqual((web.public_count, web.total_count), (1, 1))
+        self.assertEqual((internet.public_count, internet.total_count), (1, 2))
+        self.assertNoDrift()
+
+    def test_merge(self):
+        bookmark = Bookmark.by_user(self.user2.id).one()
+        bookmark.tags.append(Tag.query.filter_by(name="search").one())
+        db.Session.commit()
+
+        # the bookmarks of the first user are already tagged with both
+        self.assertEqual(len(retag_bookmarks("search", "web")), 3)
+        db.Session.commit()
+        self.assertEqual(self.tags(self.user1.id), [["bing", "web"], ["google", "web"]])
+        self.assertEqual(self.tags(self.user2.id), [["nerds", "news", "web"]])
+        self.assertEqual(Tag.query.filter_by(name="search").count(), 0)
+        self.assertNoDrift()
+
+        self.assertEqual(retag_bookmarks("missing", "web"), [])
+        with self.assertRaises(ValueError):
+            retag_bookmarks("web", "WEB")
+
+    def test_rename_shared_link(self):
+        # the counters are updated with the deltas of the moved bookmarks only
+        link = Bookmark.by_user(self.user2.id).one().link
+        for bookmark in Bookmark.by_user(self.user1.id, include_private=True):
+            bookmark.link = link
+            bookmark.tags.append(Tag.query.filter_by(name="news").one())
+        db.Session.commit()
+        self.assertNoDrift()
+
+        for old_name, new_name, user_id in (
+            ("news", "web", self.user1.id),
+            ("web", "news", self.user2.id),
+            ("search", "nerds", None),
+            ("nerds", "bing", self.user1.id),
+        ):
+            retag_bookmarks(old_name, new_name, user_id)
+            db.Session.commit()
+            self.assertNoDrift()
+
+    def test_rename_command(self):
+        user_id = self.user2.id
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["rename-tag", "web", "www", "--user", "pluto"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("1 bookmarks", result.output)
+        self.assertEqual(self.tags(user_id), [["nerds", "news", "www"]])
+
+        result = runner.invoke(args=["rename-tag", "web", "www"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(Tag.query.filter_by(name="web").count(), 0)
+        self.assertEqual(Tag.query.filter_by(name="www").one().total_count, 3)
+        self.assertNoDrift()
+
+        result = runner.invoke(args=["rename-tag", "www", "web", "--user", "nobody"])
+        self.assertEqual(result.exit_code, 1)
+
+        for name in ("#www", "w" * (TAG_MAX + 1)):
+            result = runner.invoke(args=["rename-tag", "www", name])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("Invalid tag name", result.output)
+        self.assertEqual(Tag.query.filter_by(name="www").one().total_count, 3)
+
 
 class BookmarkTest(ModelTest):
     def test_by_tags(self):
@@ -156,3 +612,125 @@ class BookmarkTest(ModelTest):
     def test_get_latest(self):
         rv = Bookmark.get_latest()
         self.assertEqual(rv.count(), 2)
+
+
+class LinkTest(ModelTest):
+    def test_normalize_url(self):
+        for url, expected in (
+            (" HTTP://Example.COM:80", "http://example.com/"),
+            ("https://user:pw@[::1]:443/a?b=1#c", "https://user:pw@[::1]/a?b=1#c"),
+            ("http://example.com:8080/Path", "http://example.com:8080/Path"),
+            ("not a url", "not a url"),
+            ("http://example.com:bad/", "http://example.com:bad/"),
+        ):
+            self.assertEqual(normalize_url(url), expected)
+
+    def test_get_or_create(self):
+        link = Link.get_or_create("http://example.com/page")
+        self.assertIsNotNone(link.id)
+        self.assertEqual(link.href_hash, url_hash("http://example.com/page"))
+        self.assertIs(Link.get_or_create("HTTP://EXAMPLE.com:80/page"), link)
+        db.Session.commit()
+
+        # a row inserted by a concurrent transaction after the lookup
+        href = "http://example.com/other"
+        db.Session.execute(Link.__table__.insert(), {"href": href, "href_hash": url_hash(href)})
+        found = mock.Mock()
+        found.with_for_update.return_value = Link.query.filter(Link.href_hash == url_hash(href))
+        with mock.patch.object(Link, "query") as query:
+            query.filter.side_effect = [[], found]
+            link = Link.get_or_create(href)
+        self.assertEqual(link.href, href)
+        # read back with a locking read
+        found.with_for_update.assert_called_once_with()
+        self.assertEqual(Link.query.filter(Link.href.like("%/other")).count(), 1)
+
+    def test_get_or_create_many(self):
+        existing = Link.get_or_create("http://example.com/a")
+        hrefs = ["http://example.com/b", "HTTP://example.com/a", "http://example.com/b"]
+        with count_statements() as statements:
+            links = Link.get_or_create_many(hrefs)
+        self.assertEqual(len(statements), 3)
+        self.assertIs(links[1], existing)
+        self.assertIs(links[0], links[2])
+        self.assertEqual(links[0].href, "http://example.com/b")
+
+        with self.assertRaises(ValueError):
+            Link.get_or_create_many(["http://example.com/" + "a" * URL_MAX])
+
+    def test_backfill(self):
+        bookmarks = Bookmark.query.order_by(Bookmark.id).all()
+        links = Link.__table__
+        # links created before the hash column existed
+        db.Session.execute(links.update().values(href_hash=None))
+        for bookmark, href in zip(bookmarks, ("http://a.com/", "HTTP://A.com", "http://b.com")):
+            bookmark.link_id = db.Session.execute(links.insert(), {"href": href}).lastrowid
+        db.Session.commit()
+        modified_on = bookmarks[1].modified_on
+
+        self.assertEqual(backfill_link_hashes(batch_size=2), (len(bookmarks) + 2, 1))
+        db.Session.expire_all()
+        self.assertEqual(bookmarks[1].link.href, "http://a.com/")
+        self.assertEqual(bookmarks[1].modified_on, modified_on)
+        self.assertIs(Link.get_or_create("http://b.com/"), bookmarks[2].link)
+        self.assertEqual(backfill_link_hashes(), (0, 0))
+
+    def test_link_tags(self):
+        link = Link.get_or_create("http://example.com/")
+        other = Link.get_or_create("http://example.org/")
+        python, web = TagFactory.create(name="python"), TagFactory.create(name="web")
+        b1 = BookmarkFactory.create(user=self.user1, link=link, tags=[python, web])
+        BookmarkFactory.create(user=self.user2, link=link, tags=[python])
+        BookmarkFactory.create(user=self.user2, link=link, private=True, tags=[web])
+        db.Session.commit()
+
+        # the tags of the bookmark of the user are left out
+        hints = link_hints("HTTP://example.com", self.user1.id)
+        self.assertEqual(hints, (b1.id, [("python", 1)]))
+        hints = link_hints("http://example.com/", self.user2.id, max_tags=1)
+        self.assertEqual(hints.tags, [("python", 1)])
+        hints = link_hints("http://example.com/", UserFactory.create().id)
+        self.assertEqual(hints.tags, [("python", 2), ("web", 1)])
+        self.assertEqual(link_hints("http://example.net/", self.user1.id), (None, []))
+
+        b1.link = other
+        db.Session.commit()
+        self.assertEqual(link_hints("http://example.com/", self.user1.id), (None, [("python", 1)]))
+        self.assertEqual(link_hints("http://example.org/", self.user1.id).tags, [])
+        hints = link_hints("http://example.org/", self.user2.id)
+        self.assertEqual(hints.tags, [("python", 1), ("web", 1)])
+
+        b1.private = True
+        db.Session.delete(Bookmark.by_user(self.user2.id).filter(Bookmark.link == link).one())
+        db.Session.commit()
+        self.assertEqual(link_hints("http://example.com/", self.user1.id).tags, [])
+        self.assertEqual(link_tags_drift(), 0)
+
+
+class RecordsTest(ModelTest):
+    def test_load_records(self):
+        bookmark = Bookmark.query.filter(Bookmark.private == True).one()  # noqa
+        bookmark.link = Link("https://Example.com:8080/page")
+        db.Session.commit()
+        ids = [b.id for b in Bookmark.query.order_by(Bookmark.id.desc())]
+
+        with count_statements() as statements:
+            records = load_records(ids + [9000])
+        self.assertEqual(len(statements), 2)
+        self.assertEqual([r.id for r in records], ids)
+
+        record = [r for r in records if r.id == bookmark.id][0]
+        self.assertEqual(record.to_dict(), bookmark.to_dict())
+        self.assertEqual(record.domain, "example.com")
+        self.assertEqual([tag.name for tag in record.tags], ["bing", "search", "web"])
+        self.assertEqual(record.user.username, "pippo")
+        # tags and users are shared among the records
+        self.assertIs(records[-1].user, records[-2].user)
+        self.assertIs(records[0].tags[-1], record.tags[-1])
+
+        with self.assertRaises(AttributeError):
+            record.title = "changed"
+
+        visible = load_records(ids, criterion=Bookmark.private == False)  # noqa
+        self.assertEqual(len(visible), 2)
+        self.assertEqual(load_records([]), [])
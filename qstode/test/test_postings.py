@@ -0,0 +1,198 @@
+"""
+    qstode.test.test_postings
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tag posting lists tests.
+
+    :copyright: (c) 2012 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import json
+import random
+import threading
+from unittest import mock
+from datetime import datetime, timedelta
+from flask import url_for
+from . import FlaskTestCase
+from .. import db, postings
+from ..model.bookmark import Bookmark, retag_bookmarks
+from .model_factory import UserFactory, TagFactory, BookmarkFactory
+
+
+class PostingsTest(FlaskTestCase):
+    def setUp(self):
+        super(PostingsTest, self).setUp()
+        self.user1 = UserFactory.create()
+        self.user2 = UserFactory.create()
+        db.Session.commit()
+
+        rng = random.Random(1)
+        self.names = ["tag%d" % i for i in range(8)]
+        start = datetime(2013, 1, 1)
+        for i in range(40):
+            BookmarkFactory.create(
+                user=rng.choice((self.user1, self.user2)),
+                private=rng.random() < 0.3,
+                # a few bookmarks share the same creation date
+                created_on=start + timedelta(hours=i // 2),
+                tags=[TagFactory.create(name=n) for n in rng.sample(self.names, rng.randint(1, 4))],
+            )
+            db.Session.commit()
+
+        self.path = os.path.join(self.tmp_dir, "postings")
+        self.addCleanup(setattr, postings.manager, "path", postings.manager.path)
+        postings.manager.path = self.path
+
+    def queries(self):
+        for name in self.names:
+            yield [name], []
+        yield ["tag1", "tag2"], []
+        yield ["tag1", "tag2", "tag3"], []
+        yield ["tag1"], ["tag2"]
+        yield ["tag1"], ["tag2", "tag3", "nonexistent"]
+        yield ["tag1", "nonexistent"], []
+
+    def assertSameAsSQL(self, engine):
+        for tags, exclude in self.queries():
+            for user_id in (None, self.user1.id):
+                expected = [b.id for b in Bookmark.by_tags(tags, exclude, user_id=user_id)]
+                self.assertEqual(engine.search(tags, exclude, user_id), expected)
+
+    def test_build(self):
+        self.assertSameAsSQL(postings.TagPostings.build())
+
+    def test_viewer(self):
+        engine = postings.TagPostings.build()
+        query = Bookmark.query.filter_by(user_id=self.user1.id).filter_by(private=True)
+        private = set(b.id for b in query)
+        self.assertTrue(private)
+
+        ids = set()
+        for name in self.names:
+            ids.update(engine.search([name], viewer_id=self.user1.id))
+            self.assertFalse(private & set(engine.search([name])))
+        self.assertTrue(private <= ids)
+
+    def test_snapshot(self):
+        postings.TagPostings.build(generation=3).save(self.path)
+        engine = postings.TagPostings.load(self.path)
+        self.assertEqual(engine.generation, 3)
+        self.assertIsInstance(engine.postings[engine.tags["tag1"]], memoryview)
+        self.assertSameAsSQL(engine)
+
+    def test_incremental(self):
+        postings.manager.save()
+        self.assertSameAsSQL(postings.manager.current())
+
+        BookmarkFactory.create(
+            user=self.user1, tags=[TagFactory.create(name=n) for n in ("tag1", "tag2", "new")]
+        )
+        db.Session.commit()
+        for bookmark in Bookmark.query.filter(Bookmark.id % 3 == 0):
+            bookmark.tags.pop()
+            tag = TagFactory.create(name="tag3")
+            if tag not in bookmark.tags:
+                bookmark.tags.append(tag)
+            bookmark.private = not bookmark.private
+        db.Session.commit()
+        for bookmark in Bookmark.query.filter(Bookmark.id % 5 == 0):
+            db.Session.delete(bookmark)
+        db.Session.commit()
+
+        engine = postings.manager.current()
+        self.assertIsNotNone(engine)
+        self.assertEqual(engine.search(["new"]), [b.id for b in Bookmark.by_tags(["new"])])
+        self.assertSameAsSQL(engine)
+
+    def test_replay_twice(self):
+        postings.manager.save()
+        BookmarkFactory.create(
+            user=self.user1, tags=[TagFactory.create(name=n) for n in ("tag1", "new")]
+        )
+        db.Session.commit()
+        bookmark = Bookmark.query.filter_by(user_id=self.user2.id).first()
+        bookmark.tags.append(TagFactory.create(name="new"))
+        db.Session.commit()
+
+        # a snapshot built after the commits, replaying their journal entries again
+        engine = postings.TagPostings.build()
+        with open(self.path + ".log", encoding="utf-8") as fd:
+            entries = [json.loads(line) for line in fd]
+        self.assertEqual(len(entries), 2)
+        for entry in entries:
+            self.assertTrue(engine.apply(entry["changes"]))
+        self.names.append("new")
+        self.assertSameAsSQL(engine)
+
+    def test_stale(self):
+        postings.manager.save()
+        self.assertIsNotNone(postings.manager.search(["tag1"]))
+
+        # a bookmark older than the newest one can't be appended
+        with mock.patch.object(postings.manager, "_schedule_rebuild") as schedule:
+            BookmarkFactory.create(
+                user=self.user1,
+                created_on=datetime(2000, 1, 1),
+                tags=[TagFactory.create(name="tag1")],
+            )
+            db.Session.commit()
+            self.assertIsNone(postings.manager.search(["tag1"]))
+            self.assertTrue(schedule.called)
+
+            # runs in its own thread, with its own session
+            thread = threading.Thread(
+                target=postings.manager._rebuild, args=(postings.manager._mtime,)
+            )
+            thread.start()
+            thread.join()
+            self.assertSameAsSQL(postings.manager.current())
+
+            postings.manager.invalidate()
+            self.assertIsNone(postings.manager.search(["tag1"]))
+
+    def test_background_rebuild(self):
+        postings.manager.save()
+        self.assertIsNotNone(postings.manager.current())
+
+        postings.manager.invalidate()
+        postings.manager.search(["tag1"])
+        postings.manager._rebuild_thread.join()
+        self.assertSameAsSQL(postings.manager.current())
+        # the journal was compacted
+        self.assertEqual(os.path.getsize(self.path + ".log"), 0)
+
+    def test_other_process(self):
+        postings.manager.save()
+        # another worker, sharing the snapshot
+        other = postings.PostingsManager()
+        other.path = self.path
+        self.assertIsNotNone(other.current())
+
+        BookmarkFactory.create(
+            user=self.user1, tags=[TagFactory.create(name=n) for n in ("tag1", "new")]
+        )
+        db.Session.commit()
+        for bookmark in Bookmark.query.filter(Bookmark.id % 4 == 0):
+            db.Session.delete(bookmark)
+        db.Session.commit()
+        retag_bookmarks("tag2", "tag1")
+        db.Session.commit()
+        retag_bookmarks("tag3", "renamed", user_id=self.user1.id)
+        db.Session.commit()
+
+        self.names += ["new", "renamed"]
+        engine = other.current()
+        self.assertIsNotNone(engine)
+        self.assertSameAsSQL(engine)
+        self.assertNotIn("tag2", engine.tags)
+
+    def test_tagged_view(self):
+        postings.manager.save()
+        expected = [b.id for b in Bookmark.by_tags(["tag1"])][:10]
+
+        rv = self.client.get(url_for("tagged", tags="tag1"))
+        self.assert200(rv)
+        bookmarks = self.get_context_variable("bookmarks")
+        self.assertEqual([b.id for b in bookmarks.items], expected)
+        self.assertEqual(bookmarks.total, Bookmark.by_tags(["tag1"]).count())
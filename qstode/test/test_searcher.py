@@ -0,0 +1,336 @@
+"""
+    qstode.test.test_searcher
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Full text search tests.
+
+    :copyright: (c) 2013 by Daniel Kertesz
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import json
+import mock
+from datetime import datetime
+from flask import url_for
+from . import FlaskTestCase
+from .. import db
+from ..searcher import WhooshSearcher, IndexWorker, OP_INDEX, OP_UPDATE, OP_DELETE
+from ..searcher import reindex_modified, rebuild_index, export_snapshot, import_snapshot
+from ..searcher import LockError
+from ..model.bookmark import Bookmark, Link, retag_bookmarks
+from .model_factory import UserFactory, TagFactory, BookmarkFactory
+
+
+class SearcherTest(FlaskTestCase):
+    def setUp(self):
+        super(SearcherTest, self).setUp()
+        self.app.config["WHOOSH_INDEX_PATH"] = os.path.join(self.tmp_dir, "index")
+        self.searcher = WhooshSearcher()
+        self.searcher.init_app(self.app)
+        self.addCleanup(self.app.extensions.pop, "searcher", None)
+
+        self.user = UserFactory.create()
+        self.b1 = BookmarkFactory.create(
+            user=self.user,
+            title="Python decorators explained",
+            notes="how to write a decorator",
+            tags=[TagFactory.create(name="python")],
+        )
+        db.Session.commit()
+        self.b2 = BookmarkFactory.create(
+            user=self.user,
+            title="Writing a decorator in Python",
+            notes="python decorators, python closures and more python",
+            tags=[TagFactory.create(name="python")],
+        )
+        self.b3 = BookmarkFactory.create(
+            user=self.user, title="Flask tutorial", tags=[TagFactory.create(name="web")]
+        )
+        db.Session.commit()
+
+    def queued(self):
+        items = []
+        while True:
+            item = self.searcher.queue.reserve(0)
+            if item is None:
+                break
+            items.append(item)
+        self.searcher.queue.ack([token for token, _ in items])
+        return sorted(tuple(json.loads(payload)) for _, payload in items)
+
+    def worker(self):
+        return IndexWorker(self.searcher, batch_size=100, interval=0)
+
+    def test_queue_after_commit(self):
+        self.assertEqual(
+            self.queued(), [(OP_INDEX, self.b1.id), (OP_INDEX, self.b2.id), (OP_INDEX, self.b3.id)]
+        )
+
+        self.b1.title = "Python decorators"
+        db.Session.flush()
+        self.assertEqual(self.queued(), [])
+        db.Session.commit()
+        self.assertEqual(self.queued(), [(OP_UPDATE, self.b1.id)])
+
+        db.Session.delete(self.b2)
+        db.Session.commit()
+        self.assertEqual(self.queued(), [(OP_DELETE, self.b2.id)])
+
+        self.b3.title = "Rolled back"
+        db.Session.flush()
+        db.Session.rollback()
+        self.assertEqual(self.queued(), [])
+
+        retag_bookmarks("python", "programming")
+        db.Session.commit()
+        self.assertEqual(self.queued(), [(OP_UPDATE, self.b1.id)])
+        retag_bookmarks("web", "www")
+        db.Session.rollback()
+        db.Session.commit()
+        self.assertEqual(self.queued(), [])
+
+    def test_worker(self):
+        modified_on = self.b1.modified_on
+        self.assertEqual(self.worker().run(once=True), 3)
+        self.assertEqual(len(self.searcher.queue), 0)
+        self.assertEqual(self.searcher.search("python").total, 2)
+
+        b1 = Bookmark.query.get(self.b1.id)
+        self.assertIsNotNone(b1.indexed_on)
+        self.assertEqual(b1.modified_on, modified_on)
+
+        b1.title = "Decorators in Flask"
+        db.Session.delete(Bookmark.query.get(self.b2.id))
+        db.Session.commit()
+        self.assertEqual(self.worker().run(once=True), 2)
+        self.assertEqual(self.searcher.search("python").total, 1)
+        self.assertEqual(sorted(self.searcher.search("flask").ids), [self.b1.id, self.b3.id])
+
+    def test_worker_batches(self):
+        self.searcher.push_operations([(OP_UPDATE, self.b1.id)] * 5)
+        self.assertEqual(self.worker().run(once=True), 3)
+        # a single commit, and a single segment, for the whole batch
+        self.assertEqual(len(self.searcher.ix._segments()), 1)
+
+    def test_worker_recovery(self):
+        # a worker died after reserving an item
+        self.searcher.queue.reserve(0)
+        self.assertEqual(len(self.searcher.queue.pending()), 1)
+
+        self.assertEqual(self.worker().run(once=True), 3)
+        self.assertEqual(self.searcher.queue.pending(), [])
+        self.assertEqual(self.searcher.search("python OR flask").total, 3)
+
+    def test_single_worker(self):
+        queue = self.searcher.queue
+        self.assertTrue(queue.lock())
+        with self.assertRaises(LockError):
+            self.worker().run(once=True)
+        queue.unlock()
+        self.assertEqual(self.worker().run(once=True), 3)
+
+    def test_reindex_modified(self):
+        self.assertEqual(reindex_modified(self.searcher, chunk_size=2, commit_every=2), 3)
+        self.assertEqual(self.searcher.search("python OR flask").total, 3)
+        self.assertIsNotNone(Bookmark.query.get(self.b1.id).indexed_on)
+        self.assertEqual(reindex_modified(self.searcher), 0)
+
+        Bookmark.query.get(self.b3.id).title = "Python web frameworks"
+        db.Session.commit()
+        self.assertEqual(reindex_modified(self.searcher), 1)
+        self.assertEqual(self.searcher.search("python").total, 3)
+
+    def test_rebuild(self):
+        for bookmark in (self.b1, self.b2, self.b3):
+            self.searcher.add_bookmark(bookmark)
+        db.Session.delete(self.b3)
+        db.Session.commit()
+        counts = []
+
+        total = rebuild_index(self.searcher, 1, 1, progress=lambda n, t: counts.append(n))
+        self.assertEqual(total, 2)
+        self.assertEqual(len(counts), 2)
+        self.assertTrue(os.path.islink(self.app.config["WHOOSH_INDEX_PATH"]))
+        self.assertEqual(self.searcher.search("python OR flask").total, 2)
+
+        self.b1.title = "Flask decorators"
+        db.Session.commit()
+        self.assertEqual(rebuild_index(self.searcher, procs=2), 2)
+        self.assertEqual(self.searcher.search("flask").ids, [self.b1.id])
+        # the previous index is gone
+        indexes = [name for name in os.listdir(self.tmp_dir) if name.startswith("index.")]
+        self.assertEqual(len(indexes), 1)
+
+    def test_rebuild_resume(self):
+        def interrupt(count, elapsed):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            rebuild_index(self.searcher, 1, 1, progress=interrupt)
+        self.assertFalse(os.path.islink(self.app.config["WHOOSH_INDEX_PATH"]))
+
+        counts = []
+        total = rebuild_index(self.searcher, 1, 1, progress=lambda n, t: counts.append(n))
+        self.assertEqual(total, 2)
+        self.assertEqual(counts, [1, 2])
+        self.assertEqual(self.searcher.search("python OR flask").total, 3)
+
+    def test_rebuild_resume_after_commit(self):
+        # interrupted after the second index commit, before saving its checkpoint
+        with mock.patch("qstode.searcher.mark_indexed") as mark_indexed:
+            mark_indexed.side_effect = [None, KeyboardInterrupt]
+            with self.assertRaises(KeyboardInterrupt):
+                rebuild_index(self.searcher, 1, 1)
+
+        self.assertEqual(rebuild_index(self.searcher, 1, 1), 2)
+        # the documents committed after the checkpoint are replaced, not duplicated
+        self.assertEqual(self.searcher.search("python OR flask").total, 3)
+
+    def test_snapshot(self):
+        self.worker().run(once=True)
+        b1_id, b3_id = self.b1.id, self.b3.id
+        past = datetime(2012, 1, 1)
+        table = Bookmark.__table__
+        db.Session.execute(table.update().values(modified_on=past, indexed_on=past))
+        db.Session.commit()
+
+        path = os.path.join(self.tmp_dir, "snapshot.tar.gz")
+        watermark = export_snapshot(self.searcher, path)
+        self.assertGreater(watermark, past)
+
+        # changes made after the snapshot
+        Bookmark.query.get(self.b1.id).title = "Flask decorators"
+        db.Session.delete(Bookmark.query.get(self.b2.id))
+        db.Session.commit()
+
+        # the index moved to another directory
+        self.app.config["WHOOSH_INDEX_PATH"] = os.path.join(self.tmp_dir, "moved")
+        node = WhooshSearcher()
+        node.init_app(self.app)
+        runner = self.app.test_cli_runner()
+        self.assertTrue(node.queue.lock())
+        result = runner.invoke(args=["index-import", path])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Stop the index worker", result.output)
+        node.queue.unlock()
+
+        result = runner.invoke(args=["index-import", path])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(watermark.isoformat(), result.output)
+        self.assertIn("indexed 1 bookmarks", result.output)
+        self.assertEqual(node.search("python").ids, [b1_id])
+        self.assertEqual(sorted(node.search("flask").ids), [b1_id, b3_id])
+        self.assertEqual(IndexWorker(node, interval=0).run(once=True), 0)
+
+        # a worker replays an interrupted import
+        self.assertEqual(import_snapshot(node, path), watermark)
+        self.assertEqual(node.search("python").total, 2)
+        self.assertEqual(IndexWorker(node, interval=0).run(once=True), 1)
+        self.assertEqual(node.search("python").ids, [b1_id])
+
+    def test_search(self):
+        for bookmark in (self.b1, self.b2, self.b3):
+            self.searcher.add_bookmark(bookmark)
+
+        results = self.searcher.search("python", page_len=1)
+        self.assertEqual(results.total, 2)
+        self.assertEqual(len(results.ids), 1)
+        second = self.searcher.search("python", page=2, page_len=1)
+        self.assertEqual(sorted(results.ids + second.ids), [self.b1.id, self.b2.id])
+        with self.assertRaises(ValueError):
+            self.searcher.search("python", page=3, page_len=1)
+        self.assertEqual(self.searcher.search("flask").ids, [self.b3.id])
+
+    def test_search_filters(self):
+        other = UserFactory.create()
+        secret = BookmarkFactory.create(
+            user=other,
+            private=True,
+            title="Secret python notes",
+            created_on=datetime(2012, 1, 1),
+            tags=[TagFactory.create(name="python")],
+        )
+        self.b3.link = Link("https://Flask.palletsprojects.com:443/tutorial/")
+        db.Session.commit()
+        for bookmark in (self.b1, self.b2, self.b3, secret):
+            self.searcher.add_bookmark(bookmark)
+
+        results = self.searcher.search("python", page_len=2)
+        self.assertEqual(results.total, 2)
+        self.assertEqual(sorted(results.ids), [self.b1.id, self.b2.id])
+        with self.assertRaises(ValueError):
+            self.searcher.search("python", page=2, page_len=2)
+
+        results = self.searcher.search("python", viewer_id=other.id)
+        self.assertEqual(results.total, 3)
+        self.assertEqual(results.tags, [("python", 3)])
+        results = self.searcher.search("python", viewer_id=other.id, user_id=other.id)
+        self.assertEqual(results.ids, [secret.id])
+        self.assertEqual(self.searcher.search("python", user_id=other.id).total, 0)
+
+        results = self.searcher.search("python", viewer_id=other.id, end=datetime(2012, 12, 31))
+        self.assertEqual(results.ids, [secret.id])
+        results = self.searcher.search("python", viewer_id=other.id, start=datetime(2013, 1, 1))
+        self.assertEqual(results.total, 2)
+
+        results = self.searcher.search("domain:flask.palletsprojects.com")
+        self.assertEqual(results.ids, [self.b3.id])
+
+    def test_search_cache(self):
+        for bookmark in (self.b1, self.b2):
+            self.searcher.add_bookmark(bookmark)
+
+        searcher, generation = self.searcher.get_searcher()
+        results = self.searcher.search("python")
+        self.assertIs(self.searcher.search("  python "), results)
+        self.assertIs(self.searcher.get_searcher()[0], searcher)
+        self.assertEqual(results.tags, [("python", 2)])
+
+        self.searcher.add_bookmark(self.b3)
+        self.assertNotEqual(self.searcher.get_searcher()[1], generation)
+        self.assertIsNot(self.searcher.search("python"), results)
+        results = self.searcher.search("python OR flask")
+        self.assertEqual(results.total, 3)
+        self.assertEqual(results.tags, [("python", 2), ("web", 1)])
+
+        # the tags are counted over the top hits only
+        with mock.patch.object(self.searcher, "facet_sample", 1):
+            results = self.searcher.search("python OR flask", page_len=1)
+        self.assertEqual(results.total, 3)
+        self.assertEqual(sum(count for _, count in results.tags), 1)
+
+    def test_by_ids_keeps_order(self):
+        ids = [self.b2.id, self.b3.id, self.b1.id]
+        self.assertEqual([b.id for b in Bookmark.by_ids(ids)], ids)
+        self.assertEqual(Bookmark.by_ids([]).all(), [])
+
+    def test_text_search_view(self):
+        for bookmark in (self.b1, self.b2, self.b3):
+            self.searcher.add_bookmark(bookmark)
+        expected = self.searcher.search("python").ids
+
+        rv = self.client.get(url_for("text_search", q="python"))
+        self.assert200(rv)
+        self.assertTemplateUsed("search_results.html")
+        bookmarks = self.get_context_variable("bookmarks")
+        self.assertEqual([b.id for b in bookmarks.items], expected)
+        self.assertEqual(bookmarks.total, 2)
+        refinements = self.get_context_variable("refinements")
+        self.assertEqual([(name, count) for name, count, url in refinements], [("python", 2)])
+
+        # made private, but not indexed again yet
+        Bookmark.query.get(self.b1.id).private = True
+        db.Session.commit()
+        rv = self.client.get(url_for("text_search", q="python"))
+        self.assertEqual([b.id for b in self.get_context_variable("bookmarks").items], [self.b2.id])
+        self.assertNotIn(b"Python decorators explained", rv.data)
+        self.assertEqual([b.id for b in Bookmark.by_ids(expected)], [self.b2.id])
+        self.assertEqual(len(Bookmark.by_ids(expected, self.user).all()), 2)
+
+        rv = self.client.get(url_for("text_search", q="python", user=self.user.id + 1))
+        self.assert200(rv)
+        self.assertEqual(self.get_context_variable("bookmarks").total, 0)
+
+        rv = self.client.get(url_for("text_search"))
+        self.assert200(rv)
+        self.assertTemplateUsed("advanced_search.html")
@@ -1,4 +1,9 @@
 import math
+import json
+import time
+import base64
+import threading
+from collections import OrderedDict
 
 try:
     # secrets is available from 3.6+ as is preferred over random for security purposes.
@@ -7,6 +12,10 @@ except ImportError:
     from random import SystemRandom
 
 
+# Directions encoded in keyset pagination cursors
+CURSOR_NEXT, CURSOR_PREV = "n", "p"
+
+
 # Code by: Armin Ronacher, Daniel Neuhäuser.
 # https://github.com/mitsuhiko/flask-sqlalchemy/blob/master/flask_sqlalchemy/__init__.py
 class Pagination(object):
@@ -17,7 +26,18 @@ class Pagination(object):
     no longer work.
     """
 
-    def __init__(self, query, page, per_page, total, items):
+    def __init__(
+        self,
+        query,
+        page,
+        per_page,
+        total,
+        items,
+        has_next=None,
+        keys=None,
+        keyset=False,
+        total_exact=True,
+    ):
         #: the unlimited query object that was used to create this
         #: pagination object.
         self.query = query
@@ -25,23 +45,54 @@ class Pagination(object):
         self.page = page
         #: the number of items to be displayed on a page.
         self.per_page = per_page
-        #: the total number of items matching the query
+        #: the total number of items matching the query; `None` when the
+        #: query was paginated without counting.
         self.total = total
+        #: False if `total` is unknown or is a lower bound of the real total
+        self.total_exact = total_exact and total is not None
         #: the items for the current page
         self.items = items
+        #: the columns used to build keyset cursors, ordered descending
+        self.keys = keys
+        #: True if this page was fetched by seeking a cursor instead of
+        #: using an offset.
+        self.keyset = keyset
+        self._has_next = has_next
 
     @property
     def pages(self):
-        """The total number of pages"""
+        """The total number of pages; when the total is unknown this is the
+        number of pages seen so far, plus the next one if it exists."""
+        if self.total is None:
+            return self.page + 1 if self.has_next else self.page
         if self.per_page == 0:
             pages = 0
         else:
             pages = int(math.ceil(self.total / self.per_page))
         return pages
 
+    def _cursor(self, direction, page, item):
+        return encode_cursor(direction, page, [getattr(item, key.key) for key in self.keys])
+
+    @property
+    def next_cursor(self):
+        """An opaque cursor pointing to the next page, or `None`"""
+        if not self.keys or not self.items or not self.has_next:
+            return None
+        return self._cursor(CURSOR_NEXT, self.page + 1, self.items[-1])
+
+    @property
+    def prev_cursor(self):
+        """An opaque cursor pointing to the previous page, or `None`"""
+        if not self.keys or not self.items or not self.has_prev:
+            return None
+        return self._cursor(CURSOR_PREV, self.page - 1, self.items[0])
+
     def prev(self, error_out=False):
         """Returns a :class:`Pagination` object for the previous page."""
         assert self.query is not None, "a query object is required " "for this method to work"
+        if self.keyset:
+            return self.query.seek(self.prev_cursor, self.per_page, self.keys, error_out)
         return self.query.paginate(self.page - 1, self.per_page, error_out)
 
     @property
@@ -57,11 +108,15 @@ class Pagination(object):
     def next(self, error_out=False):
         """Returns a :class:`Pagination` object for the next page."""
         assert self.query is not None, "a query object is required " "for this method to work"
+        if self.keyset:
+            return self.query.seek(self.next_cursor, self.per_page, self.keys, error_out)
         return self.query.paginate(self.page + 1, self.per_page, error_out)
 
     @property
     def has_next(self):
         """True if a next page exists."""
+        if self._has_next is not None:
+            return self._has_next
         return self.page < self.pages
 
     @property
@@ -106,6 +161,106 @@ class Pagination(object):
                 last = num
 
 
+class CountCache(object):
+    """A small thread safe in-process cache for pagination totals; entries
+    expire after `ttl` seconds and a `ttl` of 0 disables the cache.
+
+    `generation`, if given, is a function returning a counter shared by all
+    the processes and bumped by every change of the counted rows: it's part
+    of the keys returned by `key()`, so that the changes made by the other
+    processes invalidate the entries of this one.
+    """
+
+    def __init__(self, ttl=0, max_items=1024, generation=None):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.generation = generation
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, fingerprint):
+        """Returns the cache key of the total of a query with `fingerprint`;
+        it must be taken before counting the rows."""
+
+        if self.generation is None or self.ttl <= 0:
+            return fingerprint
+        return (self.generation(), fingerprint)
+
+    def get(self, key):
+        """Returns the value stored for `key` or `None` if it's missing or
+        expired"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+def encode_cursor(direction, page, values):
+    """Encodes a keyset pagination position into an opaque URL safe string.
+
+    :param direction: either `CURSOR_NEXT` or `CURSOR_PREV`
+    :param page: the number of the page the cursor points to
+    :param values: the key values of the last (or first) row seen
+    """
+    payload = [direction, page] + [v.isoformat() if hasattr(v, "isoformat") else v for v in values]
+    data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor created by :func:`encode_cursor`; datetime values
+    are returned as strings and must be converted by the caller.
+
+    Raises `ValueError` if `cursor` is not a valid cursor.
+
+    :returns: a tuple (direction, page, values)
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(data.decode("utf-8"))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+    if (
+        not isinstance(payload, list)
+        or len(payload) < 3
+        or payload[0] not in (CURSOR_NEXT, CURSOR_PREV)
+        or not isinstance(payload[1], int)
+        or payload[1] < 1
+    ):
+        raise ValueError("Invalid cursor")
+
+    return payload[0], payload[1], payload[2:]
+
+
+def chunks(seq, size):
+    """Yields successive chunks of `size` items from the list `seq`"""
+
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]
+
+
 def generate_password(length=9):
     """
     Generate a random password suitable to be typed using alternated hands.
@@ -7,13 +7,22 @@
     :copyright: (c) 2012 by Daniel Kertesz
     :license: BSD, see LICENSE for more details.
 """
-from flask import jsonify, request
+import hashlib
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from flask import jsonify, json, request, url_for, Response, stream_with_context
 from flask.views import MethodView
 from flask_login import current_user
-from sqlalchemy import and_
+from sqlalchemy import and_, or_
+from sqlalchemy.sql.expression import false
 from qstode.app import app
-from qstode import db
-from ..model.bookmark import Tag, Bookmark
+from qstode import db, completion, utils
+from qstode.views import helpers
+from ..model.bookmark import Tag, Bookmark, Link, link_hints, tag_name_re
+from ..model.bookmark import TAG_MIN, TAG_MAX, NOTES_MAX
+from ..forms.bookmark import TAGLIST_MAX
+from ..model.records import load_records
+from ..model.sync import iter_changes, latest_change, pruned_until, encode_token, decode_token
 from ..model.user import User, watched_users
 
 
@@ -42,12 +51,12 @@ def handle_api_error(error):
 
 class BookmarkView(MethodView):
     def get(self, bookmark_id):
-        rv = Bookmark.get_public().filter(Bookmark.id == bookmark_id).first()
+        records = load_records([bookmark_id], criterion=Bookmark.get_public().whereclause)
 
-        if rv is None:
+        if not records:
             raise APIError("Bookmark not found", status_code=404)
         else:
-            return jsonify(bookmark=rv.to_dict())
+            return jsonify(bookmark=records[0].to_dict())
 
 
 bookmark_view = BookmarkView.as_view("api_bookmark")
@@ -61,13 +70,16 @@ class BookmarkListView(MethodView):
         except ValueError:
             raise APIError("Invalid page requested", status_code=400)
 
-        bookmarks = Bookmark.get_latest().paginate(page, app.config["PER_PAGE"])
+        bookmarks = helpers.paginate_bookmarks(Bookmark.get_latest(), page)
         rv = {
             "meta": {
                 "cur_page": bookmarks.page,
                 "next_page": bookmarks.next_num,
                 "prev_page": bookmarks.prev_num,
                 "num_pages": bookmarks.pages,
+                "num_pages_exact": bookmarks.total_exact,
+                "next_cursor": bookmarks.next_cursor,
+                "prev_cursor": bookmarks.prev_cursor,
             },
             "bookmarks": [x.to_dict() for x in bookmarks.items],
         }
@@ -78,6 +90,252 @@ bookmark_list_view = BookmarkListView.as_view("api_bookmark_list")
 app.add_url_rule("/api/bookmarks/", view_func=bookmark_list_view, methods=["GET"])
 
 
+class BookmarkMultiView(MethodView):
+    def get(self):
+        try:
+            ids = [int(x) for x in request.args.get("ids", "").split(",") if x.strip()]
+        except ValueError:
+            raise APIError("Invalid bookmark ids")
+        if len(ids) > app.config["API_BATCH_MAX_ITEMS"]:
+            raise APIError("Too many bookmarks requested", status_code=413)
+
+        visible = Bookmark.private == false()
+        if current_user.is_authenticated:
+            visible = or_(visible, Bookmark.user_id == current_user.id)
+        records = load_records(list(dict.fromkeys(ids)), criterion=visible)
+
+        found = set(record.id for record in records)
+        return jsonify(
+            bookmarks=[record.to_dict() for record in records],
+            missing=[bookmark_id for bookmark_id in ids if bookmark_id not in found],
+        )
+
+
+bookmark_multi_view = BookmarkMultiView.as_view("api_bookmark_multi")
+app.add_url_rule("/api/bookmarks/multi", view_func=bookmark_multi_view, methods=["GET"])
+
+
+class BookmarkChangesView(MethodView):
+    """Streams the bookmarks of the current user created, modified or
+    deleted after the position encoded in the `since` token; the response
+    ends with the token to use in the next request."""
+
+    def get(self):
+        if not current_user.is_authenticated:
+            raise APIError("Authentication required", status_code=401)
+
+        since = request.args.get("since") or None
+        position = None
+        if since is not None:
+            try:
+                position = decode_token(since)
+            except ValueError:
+                raise APIError("Invalid token")
+            # the tombstones after the position have been pruned
+            horizon = pruned_until(current_user.id)
+            if horizon is not None and position[0] <= horizon:
+                raise APIError("Expired token, sync again from the start", status_code=410)
+
+        # the changes are returned once the transactions writing them have surely been committed,
+        # so that the changes committed late are never skipped by the next token
+        until = datetime.utcnow() - timedelta(seconds=app.config["SYNC_SETTLE_SECONDS"])
+        user_id = current_user.id
+        latest = latest_change(user_id, until)
+
+        # the next request starts where this scan ends, even if it found no changes
+        next_position = (until, 0) if position is None else max(position, (until, 0))
+
+        def generate():
+            yield '{"changes":['
+            for i, change in enumerate(iter_changes(user_id, position, until)):
+                if change.bookmark is None:
+                    item = {
+                        "id": change.bookmark_id,
+                        "deleted": True,
+                        "deleted_on": change.changed_on.isoformat(),
+                    }
+                else:
+                    item = {"id": change.bookmark_id, "bookmark": change.bookmark.to_dict()}
+                yield ("," if i else "") + json.dumps(item)
+            yield '],"next":%s}' % json.dumps(encode_token(*next_position))
+
+        rv = Response(stream_with_context(generate()), mimetype="application/json")
+        # an unchanged poll only costs the lookup of the latest change
+        etag = "%s:%s:%s" % (user_id, since, latest.isoformat() if latest else "")
+        rv.set_etag(hashlib.sha1(etag.encode("utf-8")).hexdigest())
+        if latest is not None:
+            rv.last_modified = latest
+        rv.cache_control.private = True
+        rv.cache_control.no_cache = True
+        return rv.make_conditional(request)
+
+
+bookmark_changes_view = BookmarkChangesView.as_view("api_bookmark_changes")
+app.add_url_rule("/api/bookmarks/changes", view_func=bookmark_changes_view, methods=["GET"])
+
+
+def _clean_bookmark(item, partial=False):
+    """Validates a bookmark of a batch request like `BookmarkForm` does,
+    returning a dict with the normalized values; when `partial` is True the
+    missing fields are left out."""
+
+    if not isinstance(item, dict):
+        raise APIError("A bookmark must be an object")
+
+    rv = {}
+    if "url" in item or not partial:
+        url = item.get("url")
+        if not isinstance(url, str) or not urlsplit(url.strip()).netloc:
+            raise APIError("Invalid url")
+        if len(url.strip()) > Link.href.type.length:
+            raise APIError("Url too long")
+        rv["url"] = url.strip()
+
+    if "title" in item or not partial:
+        title = item.get("title")
+        if not isinstance(title, str) or not title.strip():
+            raise APIError("Invalid title")
+        if len(title.strip()) > Bookmark.title.type.length:
+            raise APIError("Title too long")
+        rv["title"] = title.strip()
+
+    if "tags" in item or not partial:
+        tags = item.get("tags")
+        if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+            raise APIError("Invalid tags")
+        tags = list(dict.fromkeys(tag.strip().lower() for tag in tags if tag.strip()))
+        if not tags or len(tags) > TAGLIST_MAX:
+            raise APIError("A bookmark needs 1 to %d tags" % TAGLIST_MAX)
+        for tag in tags:
+            if not (TAG_MIN <= len(tag) <= TAG_MAX) or not tag_name_re.match(tag):
+                raise APIError("Invalid tag: %s" % tag)
+        rv["tags"] = tags
+
+    if "notes" in item or not partial:
+        notes = item.get("notes") or ""
+        if not isinstance(notes, str) or len(notes) > NOTES_MAX:
+            raise APIError("Invalid notes")
+        rv["notes"] = notes
+
+    if "private" in item or not partial:
+        private = item.get("private", False)
+        if not isinstance(private, bool):
+            raise APIError("Invalid private flag")
+        rv["private"] = private
+
+    return rv
+
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _error_result(error, **kwargs):
+    rv = error.to_dict()
+    rv.update(kwargs, status=error.status_code)
+    return rv
+
+
+class BookmarkBatchView(MethodView):
+    """Creates, updates and deletes many bookmarks of the current user in a
+    single transaction; the links and the tags of the whole batch are
+    resolved with a few bulk statements."""
+
+    def post(self):
+        if not current_user.is_authenticated:
+            raise APIError("Authentication required", status_code=401)
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise APIError("Expected a JSON object")
+        create, update, delete = (data.get(key, []) for key in ("create", "update", "delete"))
+        if not all(isinstance(items, list) for items in (create, update, delete)):
+            raise APIError("The create, update and delete members must be lists")
+        if len(create) + len(update) + len(delete) > app.config["API_BATCH_MAX_ITEMS"]:
+            raise APIError("Too many bookmarks in the batch", status_code=413)
+
+        results = {"create": [None] * len(create), "update": [None] * len(update), "delete": []}
+        user = current_user._get_current_object()
+
+        creating = []
+        for i, item in enumerate(create):
+            try:
+                creating.append((i, _clean_bookmark(item)))
+            except APIError as ex:
+                results["create"][i] = _error_result(ex)
+
+        updating = []
+        for i, item in enumerate(update):
+            bookmark_id = item.get("id") if isinstance(item, dict) else None
+            try:
+                if not _is_id(bookmark_id):
+                    raise APIError("Invalid bookmark id")
+                updating.append((i, bookmark_id, _clean_bookmark(item, partial=True)))
+            except APIError as ex:
+                results["update"][i] = _error_result(ex, id=bookmark_id)
+
+        # the bookmarks to change must belong to the current user
+        ids = [bookmark_id for _, bookmark_id, _ in updating]
+        ids.extend(bookmark_id for bookmark_id in delete if _is_id(bookmark_id))
+        owned = {}
+        for chunk in utils.chunks(list(set(ids)), 500):
+            query = Bookmark.query.filter(Bookmark.id.in_(chunk), Bookmark.user_id == user.id)
+            owned.update((bookmark.id, bookmark) for bookmark in query)
+
+        not_found = APIError("Bookmark not found", status_code=404)
+        for i, bookmark_id, _ in updating:
+            if bookmark_id not in owned:
+                results["update"][i] = _error_result(not_found, id=bookmark_id)
+        updating = [entry for entry in updating if entry[1] in owned]
+
+        values = [values for _, values in creating] + [values for _, _, values in updating]
+        urls = list(set(v["url"] for v in values if "url" in v))
+        links = dict(zip(urls, Link.get_or_create_many(urls)))
+        names = [name for v in values for name in v.get("tags", ())]
+        tags = {tag.name: tag for tag in Tag.get_or_create_many(names)}
+
+        created = []
+        for i, v in creating:
+            bookmark = Bookmark(title=v["title"], private=v["private"], notes=v["notes"])
+            bookmark.link = links[v["url"]]
+            bookmark.tags = [tags[name] for name in v["tags"]]
+            bookmark.user = user
+            db.Session.add(bookmark)
+            created.append((i, bookmark))
+
+        for i, bookmark_id, v in updating:
+            bookmark = owned[bookmark_id]
+            if "url" in v and links[v["url"]] is not bookmark.link:
+                bookmark.link = links[v["url"]]
+            for key in ("title", "notes", "private"):
+                if key in v:
+                    setattr(bookmark, key, v[key])
+            if "tags" in v:
+                new_tags = [tags[name] for name in v["tags"]]
+                if set(new_tags) != set(bookmark.tags):
+                    bookmark.tags = new_tags
+            results["update"][i] = {"id": bookmark_id, "status": 200}
+
+        for bookmark_id in delete:
+            if not _is_id(bookmark_id):
+                results["delete"].append(_error_result(APIError("Invalid bookmark id")))
+            elif bookmark_id in owned:
+                db.Session.delete(owned.pop(bookmark_id))
+                results["delete"].append({"id": bookmark_id, "status": 204})
+            else:
+                results["delete"].append(_error_result(not_found, id=bookmark_id))
+
+        db.Session.flush()
+        for i, bookmark in created:
+            results["create"][i] = {"id": bookmark.id, "status": 201}
+        db.Session.commit()
+        return jsonify(results)
+
+
+bookmark_batch_view = BookmarkBatchView.as_view("api_bookmark_batch")
+app.add_url_rule("/api/bookmarks/batch", view_func=bookmark_batch_view, methods=["POST"])
+
+
 class TaglistView(MethodView):
     def get(self):
         taglist = Tag.taglist()
@@ -95,10 +353,40 @@ def complete_tags():
     results = []
 
     if term:
-        tags = Tag.search(term).limit(app.config["TAG_AUTOCOMPLETE_MAX"]).all()
-        results.extend([dict(id=tag.id, label=tag.name, value=tag.name) for tag in tags])
+        tags = completion.completer.complete(term, app.config["TAG_AUTOCOMPLETE_MAX"])
+        results.extend([dict(id=tag_id, label=name, value=name) for tag_id, name in tags])
 
-    return jsonify(results=results)
+    # the results are the same for every user, let browsers and proxies reuse them
+    rv = jsonify(results=results)
+    if app.config.get("PUBLIC_ACCESS", True):
+        rv.cache_control.public = True
+    else:
+        rv.cache_control.private = True
+    rv.cache_control.max_age = app.config["TAG_AUTOCOMPLETE_CACHE_MAX_AGE"]
+    rv.add_etag()
+    return rv.make_conditional(request)
+
+
+@app.route("/_post/hints")
+def post_hints():
+    """JSON: tells the post form if the current user already bookmarked the
+    `url` argument, and the tags other users applied to it"""
+
+    if not current_user.is_authenticated:
+        raise APIError("Authentication required", status_code=401)
+
+    url = request.args.get("url", "", type=str).strip()
+    if not url:
+        raise APIError("Missing url")
+
+    hints = link_hints(url, current_user.id, app.config["SUGGESTED_TAGS_MAX"])
+    rv = {"bookmark": None, "tags": [dict(name=name, count=count) for name, count in hints.tags]}
+    if hints.bookmark_id is not None:
+        rv["bookmark"] = {
+            "id": hints.bookmark_id,
+            "edit_url": url_for("edit_bookmark", bId=hints.bookmark_id),
+        }
+    return jsonify(rv)
 
 
 @app.route("/api/is_following/<int:user_id>")
@@ -8,19 +8,23 @@
     :license: BSD, see LICENSE for more details.
 """
 import re
-from datetime import datetime
+from datetime import datetime, time
 from urllib.parse import urljoin
-from flask import render_template, redirect, request, flash, abort, url_for, make_response
+from flask import render_template, redirect, request, flash, abort, url_for, Response
+from flask import stream_with_context
 from flask_login import login_required, current_user
 from flask_babel import gettext, format_datetime
 from werkzeug.contrib.atom import AtomFeed
+from sqlalchemy.orm import lazyload, joinedload, defer
 
 from qstode.app import app
-from qstode import forms
-from ..model.bookmark import Tag, Bookmark, Link, get_stats
+from qstode import forms, export
+from ..model.bookmark import Tag, Bookmark, Link, get_stats, retag_bookmarks
+from ..model.records import load_records, iter_records
 from ..model.user import User
 from qstode import db
 from qstode.views import helpers
+from qstode.utils import Pagination
 
 
 @app.context_processor
@@ -32,13 +36,17 @@ def inject_globals():
     else:
         search_form = forms.SimpleSearchForm()
 
-    return dict(search_form=search_form, taglist=Tag.taglist(app.config["TAGLIST_ITEMS"]))
+    return dict(
+        search_form=search_form,
+        taglist=Tag.taglist(app.config["TAGLIST_ITEMS"]),
+        text_search_enabled="searcher" in app.extensions,
+    )
 
 
 @app.route("/", defaults={"page": 1})
 @app.route("/page/<int:page>")
 def index(page):
-    bookmarks = Bookmark.get_latest().paginate(page, app.config["PER_PAGE"])
+    bookmarks = helpers.paginate_bookmarks(Bookmark.get_latest(), page)
 
     return render_template("index.html", bookmarks=bookmarks)
 
@@ -58,11 +66,9 @@ def tagged(tags, page):
 
     # 'p' is for 'personal'
     if "p" in request.args and current_user.is_authenticated:
-        bookmarks = Bookmark.by_tags_user(tags, current_user.id)
+        bookmarks = helpers.paginate_bookmarks(Bookmark.by_tags_user(tags, current_user.id), page)
     else:
-        bookmarks = Bookmark.by_tags(tags)
-
-    bookmarks = bookmarks.paginate(page, app.config["PER_PAGE"])
+        bookmarks = helpers.paginate_tagged(tags, page)
 
     if app.config["ENABLE_RELATED_TAGS"]:
         if current_user.is_authenticated:
@@ -88,8 +94,8 @@ def user_bookmarks(username, page):
     else:
         include_private = False
 
-    results = Bookmark.by_user(user.id, include_private=include_private).paginate(
-        page, app.config["PER_PAGE"]
+    results = helpers.paginate_bookmarks(
+        Bookmark.by_user(user.id, include_private=include_private), page
     )
 
     try:
@@ -169,15 +175,13 @@ def edit_bookmark(bId):
         bookmark.title = form.title.data
         bookmark.private = form.private.data
 
-        tags_to_delete = [t for t in bookmark.tags if t.name not in form.tags.data]
-        for tag in tags_to_delete:
+        names = set(name.lower() for name in form.tags.data)
+        for tag in [t for t in bookmark.tags if t.name not in names]:
             bookmark.tags.remove(tag)
 
-        tag_names_to_add = [
-            name for name in form.tags.data if name not in [t.name for t in bookmark.tags]
-        ]
-        for tag_name in tag_names_to_add:
-            bookmark.tags.append(Tag.get_or_create(tag_name))
+        names.difference_update(t.name for t in bookmark.tags)
+        for tag in Tag.get_or_create_many(names):
+            bookmark.tags.append(tag)
 
         bookmark.notes = form.notes.data
 
@@ -210,29 +214,28 @@ def delete_bookmark(bId):
 
 
 @app.route("/bookmark/rename_tag", methods=["GET", "POST"])
+@login_required
 def rename_tag():
     form = forms.RenameTagForm()
 
     if form.validate_on_submit():
-        old_name = form.old_name.data
-        new_name = form.new_name.data
+        old_name = form.old_name.data.lower()
+        new_name = form.new_name.data.lower()
 
-        assert old_name != new_name
+        if old_name == new_name:
+            flash(gettext("The new tag name is the same as the old one"), "warning")
+            return redirect(url_for("rename_tag"))
 
         old_tag = Tag.query.filter_by(name=old_name).first()
         if old_tag is None:
             abort(404)
 
-        new_tag = Tag.get_or_create(new_name)
-        assert new_tag is not None
-
-        query = Bookmark.by_tags([old_name])
-        query = query.filter(Bookmark.user_id == current_user.id)
-
-        for bookmark in query:
-            bookmark.tags.remove(old_tag)
-            bookmark.tags.append(new_tag)
-
+        # only the administrators can rename the tags of everyone
+        if form.all_users.data and current_user.admin:
+            user_id = None
+        else:
+            user_id = current_user.id
+        retag_bookmarks(old_name, new_name, user_id)
         db.Session.commit()
 
         flash(gettext("Tag renamed successfully"), "success")
@@ -261,15 +264,7 @@ def simple_search():
 
     # Limit search to current_user's bookmarks if 'personal' query arg
     # was specified
-    if "personal" in request.args:
-        user_id = current_user.id
-    elif "user" in request.args:
-        try:
-            user_id = int(request.args.get("user"))
-        except ValueError:
-            abort(400)
-    else:
-        user_id = None
+    user_id = helpers.search_user_id()
 
     if form.validate_on_submit:
         page = helpers.validate_page(form.page.data)
@@ -287,9 +282,7 @@ def simple_search():
         results = []
         related = []
         if in_tags:
-            results = Bookmark.by_tags(in_tags, ex_tags, user_id=user_id).paginate(
-                page, app.config["PER_PAGE"]
-            )
+            results = helpers.paginate_tagged(in_tags, page, ex_tags, user_id=user_id)
             if app.config["ENABLE_RELATED_TAGS"]:
                 related = Tag.get_related(in_tags)
 
@@ -297,10 +290,61 @@ def simple_search():
     return redirect(url_for("index"))
 
 
+@app.route("/search/text/<int:page>")
+@app.route("/search/text", defaults={"page": 1})
+def text_search(page):
+    """Full text search on titles, notes and tags of bookmarks"""
+
+    searcher = app.extensions.get("searcher")
+    if searcher is None:
+        abort(404)
+
+    form = forms.TextSearchForm(request.args)
+    if not form.validate():
+        return render_template("advanced_search.html", form=form)
+
+    start = end = None
+    if form.start.data is not None:
+        start = datetime.combine(form.start.data, time.min)
+    if form.end.data is not None:
+        end = datetime.combine(form.end.data, time.max)
+    viewer = current_user if current_user.is_authenticated else None
+    viewer_id = viewer.id if viewer is not None else None
+
+    per_page = app.config["PER_PAGE"]
+    try:
+        results = searcher.search(
+            form.q.data,
+            page,
+            per_page,
+            viewer_id=viewer_id,
+            user_id=helpers.search_user_id(),
+            start=start,
+            end=end,
+        )
+    except ValueError:
+        abort(404)
+
+    # the index is updated asynchronously: a bookmark made private may still be found there
+    items = load_records(results.ids, criterion=Bookmark.visible_to(viewer))
+    bookmarks = Pagination(None, page, per_page, results.total, items)
+
+    # links narrowing the search to the bookmarks with one of the most common tags
+    args = request.args.to_dict()
+    refinements = []
+    for tag_name, count in results.tags:
+        args["q"] = "%s tags:'%s'" % (form.q.data, tag_name)
+        refinements.append((tag_name, count, url_for("text_search", **args)))
+
+    return render_template(
+        "search_results.html", bookmarks=bookmarks, query=form.q.data, refinements=refinements
+    )
+
+
 @app.route("/followed", defaults={"page": 1})
 @app.route("/followed/<int:page>")
 def followed(page):
-    bookmarks = Bookmark.by_followed().paginate(page, app.config["PER_PAGE"])
+    bookmarks = helpers.paginate_bookmarks(Bookmark.by_followed(), page)
 
     return render_template("followed.html", bookmarks=bookmarks)
 
@@ -311,7 +355,13 @@ def feed_recent():
         "QStode", feed_url=request.url, url=request.url_root, subtitle="Recent bookmarks"
     )
 
-    bookmarks = Bookmark.get_latest().limit(app.config["FEED_NUM_ENTRIES"]).all()
+    # only the columns and relationships shown by the feed
+    query = Bookmark.get_latest().options(
+        lazyload(Bookmark.tags),
+        joinedload(Bookmark.user).load_only("id", "username", "display_name"),
+        defer(Bookmark.indexed_on),
+    )
+    bookmarks = query.limit(app.config["FEED_NUM_ENTRIES"]).all()
 
     for bookmark in bookmarks:
         item_id = urljoin(request.url_root, url_for("single_bookmark", bookmark_id=bookmark.id))
@@ -334,12 +384,24 @@ def feed_recent():
 @app.route("/export_bookmarks")
 @login_required
 def export_bookmarks():
-    bookmarks = Bookmark.by_user(current_user.id, include_private=True)
-    today = datetime.now()
-    filename = "qstode-backup-%s.html" % format_datetime(today, "dd-MM-yyyy")
+    """Streams the bookmarks of the current user in the format given by the
+    `format` argument, compressed with gzip when `gzip` is 1"""
 
-    resp = make_response(render_template("_export.html", bookmarks=bookmarks, today=today))
-    resp.headers["Content-Type"] = "application/octet-stream"
+    name = request.args.get("format", "html")
+    if name not in export.FORMATS:
+        abort(404)
+    compress = request.args.get("gzip") == "1"
+
+    records = iter_records(Bookmark.user_id == current_user.id)
+    chunks = export.stream_export(name, records, compress)
+    fmt = export.FORMATS[name]
+    today = format_datetime(datetime.now(), "dd-MM-yyyy")
+    filename = "qstode-backup-%s.%s" % (today, fmt.extension)
+    if compress:
+        filename += ".gz"
+
+    resp = Response(stream_with_context(chunks))
+    resp.headers["Content-Type"] = "application/gzip" if compress else fmt.mimetype
     resp.headers["Cache-Control"] = "no-cache"
     resp.headers["Content-Disposition"] = "attachment;filename=" + filename
     return resp
@@ -48,7 +48,19 @@ def url_for_other_page(page):
     return url_for(request.endpoint, **args)
 
 
+def url_for_cursor(cursor):
+    """Get the URL for a keyset pagination cursor for Pagination menu"""
+
+    args = request.view_args.copy()
+    args.update(request.args)
+    if "page" in args:
+        args["page"] = 1
+    args["cursor"] = cursor
+    return url_for(request.endpoint, **args)
+
+
 app.jinja_env.globals["url_for_other_page"] = url_for_other_page
+app.jinja_env.globals["url_for_cursor"] = url_for_cursor
 
 
 @app.template_filter()
@@ -7,6 +7,13 @@
     :copyright: (c) 2012 by Daniel Kertesz
     :license: BSD, see LICENSE for more details.
 """
+from flask import request, abort
+from flask_login import current_user
+from qstode.app import app
+from qstode import db, postings
+from ..model.bookmark import Bookmark
+from ..model.records import load_records
+from ..utils import Pagination
 
 
 def validate_page(page):
@@ -18,3 +25,79 @@ def validate_page(page):
         rv = 1
 
     return rv
+
+
+def search_user_id():
+    """Returns the user id a search must be restricted to, from the
+    `personal` (the current user) or `user` request arguments"""
+
+    if "personal" in request.args:
+        if not current_user.is_authenticated:
+            abort(401)
+        return current_user.id
+    elif "user" in request.args:
+        try:
+            return int(request.args.get("user"))
+        except ValueError:
+            abort(400)
+    return None
+
+
+def paginate_bookmarks(query, page, per_page=None):
+    """Paginates a query of bookmarks according to the `PAGINATION_MODE`
+    configuration value; the items of the page are `BookmarkRecord`
+    objects, loaded by id once the page is known.
+
+    A `cursor` request argument always selects keyset pagination, so
+    links generated by a keyset paginated page keep working whatever the
+    configuration is.
+    """
+
+    # only the columns needed to paginate and to build cursors
+    query = query.with_entities(Bookmark.id, *Bookmark.sort_keys())
+    if per_page is None:
+        per_page = app.config["PER_PAGE"]
+    mode = app.config["PAGINATION_MODE"]
+    keys = Bookmark.sort_keys()
+    cursor = request.args.get("cursor")
+
+    if cursor or (mode == "keyset" and page == 1):
+        rv = query.seek(cursor, per_page, keys)
+    else:
+        rv = query.paginate(
+            page,
+            per_page,
+            count=(mode == "count"),
+            keys=keys,
+            count_cache=db.count_cache,
+            count_limit=app.config["PAGINATION_APPROXIMATE_COUNT"],
+        )
+    rv.items = load_records([row.id for row in rv.items])
+    return rv
+
+
+def paginate_tagged(tags, page, exclude=None, user_id=None, per_page=None):
+    """Paginates the bookmarks returned by `Bookmark.by_tags()`, finding
+    them in the tag posting lists when they are enabled and up to date;
+    SQL is then only used to load the bookmarks of the current page.
+    """
+
+    query = Bookmark.by_tags(tags, exclude, user_id=user_id)
+    if request.args.get("cursor") or app.config["PAGINATION_MODE"] == "keyset":
+        return paginate_bookmarks(query, page, per_page)
+
+    viewer_id = current_user.id if current_user.is_authenticated else None
+    ids = postings.manager.search(
+        [t.lower() for t in tags], [t.lower() for t in exclude or ()], user_id, viewer_id
+    )
+    if ids is None:
+        return paginate_bookmarks(query, page, per_page)
+
+    if per_page is None:
+        per_page = app.config["PER_PAGE"]
+    start = (page - 1) * per_page
+    if page < 1 or (page > 1 and start >= len(ids)):
+        abort(404)
+
+    items = load_records(ids[start : start + per_page])
+    return Pagination(query, page, per_page, len(ids), items)